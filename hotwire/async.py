@@ -19,27 +19,80 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import threading, Queue, logging
+import threading, Queue, logging, collections, time
 
 from hotwire.gutil import call_timeout,remove_idle
 from hotwire.externals.singletonmixin import Singleton
 
 _logger = logging.getLogger("hotwire.Async")
 
+# Maximum number of items taken from a queue under one lock acquisition
+_get_batch_size = 256
+
+# Priority lanes of MiniThreadPool, most urgent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+_lane_names = ('interactive', 'default', 'background')
+
+def _get_default_max_threads():
+    try:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError), e:
+        ncpus = 2
+    # Jobs are mostly blocked on I/O, so allow more threads than CPUs.
+    return min(max(ncpus * 2, 4), 16)
+
+class _LaneStats(object):
+    __slots__ = ['depth', 'submitted', 'completed', 'cancelled', 'total_wait', 'max_wait', 'total_run']
+    def __init__(self):
+        self.depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def as_dict(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__])
+
 class MiniThreadPool(Singleton):
-    """A Thread pool.  Seems like a missing battery from the Python standard library..."""
+    """A Thread pool.  Seems like a missing battery from the Python standard library...
+
+Jobs are queued in priority lanes; an idle thread always takes the oldest
+job from the most urgent lane which has one.  Queued jobs can be cancelled
+by the serial returned from run()."""
     def __init__(self):
         _logger.debug("Creating MiniThreadPool")
         self.__queue_cond = threading.Condition()
-        self.__queue = []
+        self.__lanes = [collections.deque() for name in _lane_names]
+        self.__stats = [_LaneStats() for name in _lane_names]
+        # serial -> queued job; a job is [serial, callable, args, queue time,
+        # priority], and cancelling clears its callable in place.
+        self.__jobs = {}
         self.__avail_threads = 0
         self.__thread_count = 0
-        self.__max_threads = 7
+        self.__max_threads = _get_default_max_threads()
         self.__async_serial = 0
 
-    def run(self, callable, args=()):
+    def set_max_threads(self, count):
+        """Set the maximum number of threads; idle threads beyond it exit."""
+        assert count > 0
+        self.__queue_cond.acquire()
+        self.__max_threads = count
+        self.__queue_cond.notifyAll()
+        self.__queue_cond.release()
+
+    def get_max_threads(self):
+        return self.__max_threads
+
+    def run(self, callable, args=(), priority=PRIORITY_DEFAULT):
         self.__queue_cond.acquire()
-        if not self.__avail_threads and self.__thread_count < self.__max_threads:
+        # Idle threads may not have taken already queued jobs yet
+        queued = sum([stats.depth for stats in self.__stats])
+        if queued >= self.__avail_threads and self.__thread_count < self.__max_threads:
             thr = threading.Thread(target=self.__worker, name="MiniThreadPool Thread")
             _logger.debug("Created thread %s", thr)
             thr.setDaemon(True)
@@ -47,44 +100,111 @@ class MiniThreadPool(Singleton):
             self.__thread_count += 1
         serial = self.__async_serial
         self.__async_serial += 1
-        self.__queue.append((serial, callable, args))
+        job = [serial, callable, args, time.time(), priority]
+        self.__jobs[serial] = job
+        self.__lanes[priority].append(job)
+        stats = self.__stats[priority]
+        stats.depth += 1
+        stats.submitted += 1
         self.__queue_cond.notify()
         self.__queue_cond.release()
         return serial
     
     def cancel(self, serial):
-        # FIXME implement
-        pass
-            
+        """Remove a job from the queue if it has not started; returns True
+        if it was removed."""
+        self.__queue_cond.acquire()
+        try:
+            job = self.__jobs.pop(serial, None)
+            if job is None:
+                return False
+            job[1] = None
+            stats = self.__stats[job[4]]
+            stats.depth -= 1
+            stats.cancelled += 1
+            return True
+        finally:
+            self.__queue_cond.release()
+
+    def get_stats(self):
+        """Return a dict of counters for each lane, keyed by lane name."""
+        self.__queue_cond.acquire()
+        try:
+            return dict([(name, stats.as_dict()) for (name, stats) in zip(_lane_names, self.__stats)])
+        finally:
+            self.__queue_cond.release()
+
+    def __pop_job(self):
+        for lane in self.__lanes:
+            while lane:
+                job = lane.popleft()
+                if job[1] is None:
+                    continue
+                del self.__jobs[job[0]]
+                stats = self.__stats[job[4]]
+                stats.depth -= 1
+                wait = time.time() - job[3]
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                return job
+        return None
+
     def __worker(self):
         while True:
             _logger.debug("thread %s waiting", threading.currentThread())
             self.__queue_cond.acquire()
             self.__avail_threads += 1
-            while not self.__queue:
+            while True:
+                if self.__thread_count > self.__max_threads:
+                    self.__avail_threads -= 1
+                    self.__thread_count -= 1
+                    self.__queue_cond.release()
+                    _logger.debug("thread %s exiting", threading.currentThread())
+                    return
+                job = self.__pop_job()
+                if job is not None:
+                    break
                 self.__queue_cond.wait()
-            (serial, cb, args) = self.__queue.pop(0)
+            (serial, cb, args, queued, priority) = job
             self.__avail_threads -= 1
             self.__queue_cond.release()
+            starttime = time.time()
             try:
                 _logger.debug("thread %s executing cb", threading.currentThread())
                 cb(*args)
             except:
                 logging.exception("Exception in thread pool worker")
+            self.__queue_cond.acquire()
+            stats = self.__stats[priority]
+            stats.completed += 1
+            stats.total_run += time.time() - starttime
+            self.__queue_cond.release()
 
 class IterableQueue(Queue.Queue):
-    def __init__(self):
-        Queue.Queue.__init__(self)
+    """A Queue which can notify a handler in the mainloop of new items.
+
+If a capacity is set, producers block while the queue is full.  A consumer
+which will read no more should call abandon(); producers are then woken,
+and their further items are discarded."""
+    def __init__(self, capacity=0):
+        Queue.Queue.__init__(self, capacity)
+        self.__abandoned = False
         self.__lock = threading.Lock()
         self.__handler_idle_id = 0
         self.__handler = None
         self.__handler_args = None
         self.__timeout_kwargs = None
+        self.__delay = 200
 
     def connect(self, handler, *args, **kwargs):
+        """Call handler(queue, *args) in the mainloop after items are queued.
+        If it returns True, it is called again as soon as the mainloop is
+        idle.  The delay keyword gives the time in milliseconds to wait for
+        more items first; remaining keywords are passed to call_timeout."""
         self.__lock.acquire()
         assert(self.__handler is None)
         self.__handler_args = args
+        self.__delay = kwargs.pop('delay', 200)
         self.__timeout_kwargs = kwargs
         self.__handler = handler
         self.__lock.release()
@@ -105,24 +225,101 @@ class IterableQueue(Queue.Queue):
         self.__handler_idle_id = 0
         handler = self.__handler
         self.__lock.release()
-        if handler:
-            return handler(self, *self.__handler_args)
+        if handler and handler(self, *self.__handler_args):
+            self.__add_idle(0)
+        return False
 
-    def __add_idle(self):
+    def __add_idle(self, delay=None):
         self.__lock.acquire()
         if self.__handler_idle_id == 0 and self.__handler:           
-            self.__handler_idle_id = call_timeout(200, self.__do_idle, **self.__timeout_kwargs)
+            if delay is None:
+                delay = self.__delay
+            self.__handler_idle_id = call_timeout(delay, self.__do_idle, **self.__timeout_kwargs)
         self.__lock.release()
 
-    def put(self, *args):
-        Queue.Queue.put(self, *args)
-        self.__add_idle()
+    def set_capacity(self, capacity):
+        """Set the maximum number of items held; 0 means unbounded."""
+        self.not_full.acquire()
+        self.maxsize = capacity
+        self.not_full.notifyAll()
+        self.not_full.release()
+
+    def abandon(self):
+        self.not_full.acquire()
+        self.__abandoned = True
+        self.not_full.notifyAll()
+        self.not_full.release()
+
+    def put(self, item, block=True, timeout=None):
+        self.put_many((item,), block=block, timeout=timeout)
+
+    def put_many(self, items, force=False, block=True, timeout=None):
+        """Append all of items, blocking while the queue is full.  They are
+        moved in as few lock acquisitions as the capacity allows.  If force
+        is given, capacity and abandonment are ignored.  As for Queue.put,
+        block and timeout limit the wait for room, raising Queue.Full; the
+        items before those without room stay queued."""
+        if not isinstance(items, (list, tuple)):
+            items = list(items)
+        if timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            endtime = time.time() + timeout
+        count = len(items)
+        i = 0
+        while i < count:
+            self.not_full.acquire()
+            try:
+                if force:
+                    n = count - i
+                else:
+                    while self.maxsize > 0 and self._qsize() >= self.maxsize and not self.__abandoned:
+                        if not block:
+                            raise Queue.Full
+                        if timeout is None:
+                            self.not_full.wait()
+                        else:
+                            remaining = endtime - time.time()
+                            if remaining <= 0.0:
+                                raise Queue.Full
+                            self.not_full.wait(remaining)
+                    if self.__abandoned:
+                        return
+                    if self.maxsize > 0:
+                        n = min(count - i, self.maxsize - self._qsize())
+                    else:
+                        n = count - i
+                self.queue.extend(items[i:i+n])
+                self.unfinished_tasks += n
+                i += n
+                self.not_empty.notify()
+            finally:
+                self.not_full.release()
+            self.__add_idle()
+
+    def get_many(self, maxitems, block=True):
+        """Remove and return a list of at most maxitems items.  If block is
+        true, wait until at least one is available; otherwise raise
+        Queue.Empty if there are none."""
+        self.not_empty.acquire()
+        try:
+            if not self._qsize():
+                if not block:
+                    raise Queue.Empty
+                while not self._qsize():
+                    self.not_empty.wait()
+            n = min(maxitems, self._qsize())
+            items = [self._get() for i in xrange(n)]
+            self.not_full.notifyAll()
+            return items
+        finally:
+            self.not_empty.release()
         
     def iter_avail(self):
         try:
             while True:
-                val = self.get(False)
-                yield val
+                for val in self.get_many(_get_batch_size, False):
+                    yield val
         except Queue.Empty, e:
             pass
 
@@ -130,15 +327,39 @@ class IterableQueue(Queue.Queue):
         for obj in QueueIterator(self):
             yield obj
 
+def iter_batches(source, maxitems=_get_batch_size):
+    """Generate lists of at most maxitems objects from an iterable or a
+queue which is terminated by None.  From a queue, each list holds what
+was available, waiting only for the first object."""
+    get_many = getattr(source, 'get_many', None)
+    if get_many is not None:
+        while True:
+            batch = get_many(maxitems)
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                if batch:
+                    yield batch
+                return
+            yield batch
+    batch = []
+    for obj in source:
+        batch.append(obj)
+        if len(batch) >= maxitems:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 class QueueIterator(object):
     def __init__(self, source):
         self._source = source
 
     def __iter__(self):
-        item = True
-        while not (item is None):
-            item = self._source.get()
-            if not (item is None):
+        get_many = getattr(self._source, 'get_many', None)
+        if get_many is None:
+            get_many = lambda n: [self._source.get()]
+        while True:
+            for item in get_many(_get_batch_size):
+                if item is None:
+                    return
                 yield item
-            else:
-                break
@@ -43,6 +43,11 @@ class OutputStreamSchema(ObjectStreamSchema):
         self.merge_default = merge_default
         self.typefunc = typefunc
 
+class OutputBatch(list):
+    """A list of objects which a builtin outputs at once, as if it had
+generated each of them in turn."""
+    pass
+
 class ArgSpec(object):
     __slots__ = ['name', 'opt']
     def __init__(self, name, opt=False):
@@ -56,6 +61,9 @@ class MultiArgSpec(object):
         self.name = name
         self.min = min
 
+# Added to the options of builtins which can run in worker processes
+_parallel_options = [['-P', '--parallel'], ['--unordered']]
+
 class Builtin(object):
     name = property(lambda self: self._name)
     input = property(lambda self: self._input)
@@ -79,6 +87,8 @@ class Builtin(object):
     locality = property(lambda self: self._locality)
     api_version = property(lambda self: self._api_version)
     singlevalue = property(lambda self: self._singlevalue)
+    parallel = property(lambda self: self._parallel, doc="""Supports running on a pool of worker processes with -P.""")
+    fusable = property(lambda self: self._fusable, doc="""Only computes from its input without blocking, so it may run in the thread of the next command.""")
     doc = property(lambda self: self._doc)
     execfunc = property(lambda self: self._execfunc)
     flattened_args = property(lambda self: self._flattened_args)
@@ -98,8 +108,12 @@ class Builtin(object):
                  locality='local',
                  doc=None,
                  api_version=0,
-                 singlevalue=False):
+                 singlevalue=False,
+                 parallel=False,
+                 fusable=False):
         self._input=input
+        if parallel:
+            options = options + _parallel_options
         self._output = isinstance(output, OutputStreamSchema) and output or OutputStreamSchema(output)
         self._options = options
         self._options_passthrough = options_passthrough
@@ -118,6 +132,8 @@ class Builtin(object):
         self._locality = locality
         self._api_version = api_version
         self._singlevalue = singlevalue
+        self._parallel = parallel
+        self._fusable = fusable
         if doc:
             self._doc = doc
         else:
@@ -250,6 +266,7 @@ def load():
     import hotwire.builtins.head    
     import hotwire.builtins.help
     import hotwire.builtins.history
+    import hotwire.builtins.index
     try:
         import simplejson
         have_simplejson = True
@@ -260,6 +277,7 @@ def load():
     import hotwire.builtins.httpget
     import hotwire.builtins.kill
     import hotwire.builtins.iter
+    import hotwire.builtins.jump
     import hotwire.builtins.ls
     import hotwire.builtins.mkdir
     import hotwire.builtins.mv
@@ -268,6 +286,7 @@ def load():
     import hotwire.builtins.pprint_builtin
     import hotwire.builtins.prop
     import hotwire.builtins.proc
+    import hotwire.builtins.profile_builtin
     import hotwire.builtins.pyeval
     import hotwire.builtins.pyfilter
     import hotwire.builtins.pymap
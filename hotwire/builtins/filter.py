@@ -23,6 +23,7 @@ import re
 
 from hotwire.text import MarkupText
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, ArgSpec
+from hotwire.procpool import parallel_filter
 
 class StringMatch(MarkupText):
     def __new__(cls, value, match):
@@ -31,6 +32,34 @@ class StringMatch(MarkupText):
         inst.add_markup('b', match.start(), match.end())
         return inst
 
+def _get_value(arg, target_prop, stringify):
+    if target_prop is not None:
+        target_propvalue = getattr(arg, target_prop)
+    else:
+        target_propvalue = arg
+    if not isinstance(target_propvalue, basestring):
+        if not stringify:
+            raise ValueError(_("Value not a string: %r" % (target_propvalue,)))
+        else:
+            target_propvalue = repr(target_propvalue)
+    elif not isinstance(target_propvalue, unicode):
+        target_propvalue = unicode(target_propvalue, 'utf-8')                
+    return target_propvalue
+
+def _match_value(compiled_re, target_propvalue, invert):
+    match = compiled_re.search(target_propvalue)
+    if invert:
+        match = not match
+    return match
+
+def _filter_chunk(data, values):
+    # Runs in a worker process, on the values to match rather than the
+    # objects, which may not pickle; match objects can't be pickled either,
+    # so just return the indices of those matching.
+    (regexp, flags, invert) = data
+    compiled_re = re.compile(regexp, flags)
+    return [i for (i, value) in enumerate(values) if _match_value(compiled_re, value, invert)]
+
 class FilterBuiltin(Builtin):
     __doc__ = _("""Filter input objects by regular expression, matching on a property (or repr)""")
     def __init__(self):
@@ -38,7 +67,9 @@ class FilterBuiltin(Builtin):
                                             input=InputStreamSchema('any'),
                                             output='identity',
                                             options=[['-s', '--stringify'], ['-i', '--ignore-case'],['-v', '--invert-match']],
-                                            argspec=('regexp', ArgSpec('property', opt=True)))
+                                            argspec=('regexp', ArgSpec('property', opt=True)),
+                                            parallel=True,
+                                            fusable=True)
 
     def execute(self, context, args, options=[]):     
         if len(args) == 2:
@@ -49,23 +80,22 @@ class FilterBuiltin(Builtin):
         target_prop = prop
         invert = '-v' in options
         stringify = '-s' in options
-        compiled_re = re.compile(regexp, (('-i' in options) and re.IGNORECASE or 0) | re.UNICODE)
-        for arg in context.input:
-            if target_prop is not None:
-                target_propvalue = getattr(arg, target_prop)
-            else:
-                target_propvalue = arg
-            if not isinstance(target_propvalue, basestring):
-                if not stringify:
-                    raise ValueError(_("Value not a string: %r" % (target_propvalue,)))
+        flags = (('-i' in options) and re.IGNORECASE or 0) | re.UNICODE
+        compiled_re = re.compile(regexp, flags)
+        if '-P' in options:
+            get_value = lambda arg: _get_value(arg, target_prop, stringify)
+            for arg in parallel_filter(_filter_chunk, (regexp, flags, invert), context.input, get_value,
+                                       ordered=('--unordered' not in options)):
+                if isinstance(arg, str):
+                    # Redo the match here for its markup
+                    target_propvalue = get_value(arg)
+                    yield StringMatch(target_propvalue, _match_value(compiled_re, target_propvalue, invert))
                 else:
-                    target_propvalue = repr(target_propvalue)
-            elif not isinstance(target_propvalue, unicode):
-                target_propvalue = unicode(target_propvalue, 'utf-8')                
-                        
-            match = compiled_re.search(target_propvalue)
-            if invert:
-                match = not match
+                    yield arg
+            return
+        for arg in context.input:
+            target_propvalue = _get_value(arg, target_prop, stringify)
+            match = _match_value(compiled_re, target_propvalue, invert)
             if match:
                 if isinstance(arg, str):
                     yield StringMatch(target_propvalue, match)
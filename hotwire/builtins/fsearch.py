@@ -19,16 +19,18 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, logging, re
+import os, sys, logging, re, stat, mmap, locale
+import sre_parse, sre_constants
 
 import hotwire
 import hotwire.fs
-from hotwire.fs import FilePath, file_is_valid_utf8, open_text_file
+from hotwire.fs import FilePath, path_join
 
-from hotwire.command import HotwireContext
 from hotwire.builtin import Builtin, BuiltinRegistry, ArgSpec
 from hotwire.builtins.fileop import FileOpBuiltin
 from hotwire.sysdep.fs import Filesystem, FileStatError
+from hotwire.contentindex import ContentIndex, sqlite3
+from hotwire.procpool import parallel_map
 
 _logger = logging.getLogger("hotwire.builtins.FSearch")
 
@@ -48,13 +50,147 @@ class FileStringMatch(object):
         self._match_start = match_start
         self._match_end = match_end
 
+# Like grep, a NUL byte in the first block means the file is binary.
+_binary_check_size = 8192
+# Number of files handed to a worker process at a time.
+_scan_chunk_size = 16
+
+def _required_literal(regexp, flags, casefold=False):
+    """Return the longest literal string every match of regexp must contain, or None.
+If casefold, the literal is returned even when matching ignores case."""
+    parsed = sre_parse.parse(regexp, flags)
+    # Includes flags set inline, like (?i)
+    if (parsed.pattern.flags & re.IGNORECASE) and not casefold:
+        return None
+    best = u''
+    run = []
+    # Only look at the top level; anything nested may be optional or alternated.
+    for (op, av) in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+            continue
+        if len(run) > len(best):
+            best = u''.join(run)
+        run = []
+    if len(run) > len(best):
+        best = u''.join(run)
+    return best or None
+
+def _search_text(text, regexp, flags):
+    """Generate (line, line number, match start, match end) for each line of text matching regexp."""
+    line_re = re.compile(regexp, flags)
+    if regexp.find('\\A') >= 0 or regexp.find('\\Z') >= 0:
+        # Anchors that mean something different for a whole buffer; go line by line.
+        for i,line in enumerate(text.splitlines(True)):
+            match = line_re.search(line)
+            if match:
+                yield (line.rstrip(u'\n'), i, match.start(), match.end())
+        return
+    # Search the whole buffer, and only split out the lines which contain a
+    # candidate match; the regexp is then rerun on the line alone so the
+    # semantics are the same as matching line by line.
+    buf_re = re.compile(regexp, flags | re.MULTILINE)
+    textlen = len(text)
+    pos = 0
+    line_num = 0
+    counted = 0
+    while pos < textlen:
+        match = buf_re.search(text, pos)
+        if not match:
+            break
+        start = text.rfind(u'\n', 0, match.start()) + 1
+        if start >= textlen:
+            break
+        end = text.find(u'\n', match.start())
+        if end < 0:
+            end = textlen
+        line_match = line_re.search(text[start:end+1])
+        if not line_match:
+            pos = match.start() + 1
+            continue
+        line_num += text.count(u'\n', counted, start)
+        counted = start
+        yield (text[start:end], line_num, line_match.start(), line_match.end())
+        pos = end + 1
+
+def _scan_file(path, regexp, flags, literal, encoding):
+    """Return a tuple (path, matches) where matches is a list of
+    (line, line number, match start, match end) for the file at path.
+    This is run in worker processes, so it must be a module-level function."""
+    matches = []
+    try:
+        if not stat.S_ISREG(os.stat(path).st_mode):
+            return (path, matches)
+        f = open(path, 'rb')
+    except EnvironmentError, e:
+        return (path, matches)
+    try:
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return (path, matches)
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                if buf[:_binary_check_size].find('\0') >= 0:
+                    return (path, matches)
+                if literal is not None and buf.find(literal) < 0:
+                    return (path, matches)
+                text = unicode(buf[:], encoding)
+            finally:
+                buf.close()
+        except (EnvironmentError, UnicodeDecodeError), e:
+            return (path, matches)
+    finally:
+        f.close()
+    matches.extend(_search_text(text, regexp, flags))
+    return (path, matches)
+
+def _scan_chunk(data, paths):
+    (regexp, flags, literal, encoding) = data
+    return [_scan_file(path, regexp, flags, literal, encoding) for path in paths]
+
 class FSearchBuiltin(FileOpBuiltin):
-    __doc__ = _("""Search directory tree for files matching a regular expression.""")
+    __doc__ = _("""Search directory tree for files matching a regular expression.
+Directories covered by the content index (see the index builtin) are searched
+using it; --index adds the directory to the index and brings it up to date.""")
     def __init__(self):
         super(FSearchBuiltin, self).__init__('fsearch',
                                              output=FileStringMatch,
                                              argspec=('regexp', ArgSpec('directory', opt=True)),                                             
-                                             options=[['-i', '--ignore-case']])
+                                             options=[['-i', '--ignore-case'], ['-I', '--index']])
+
+    @staticmethod
+    def __iter_closing(index, paths):
+        try:
+            for path in paths:
+                yield path
+        finally:
+            index.close()
+
+    def __indexed_paths(self, path, walker, regexp, flags, encoding, update=False):
+        """If path is inside a directory covered by the content index (or update is
+        True), return a generator for the paths from walker which may match regexp.
+        Otherwise, return None."""
+        try:
+            index = ContentIndex()
+            if index.get_root(path) is None:
+                if not update:
+                    index.close()
+                    return None
+                index.add_root(path)
+        except sqlite3.Error, e:
+            _logger.warn("Failed to open content index", exc_info=True)
+            return None
+        # The index is case-insensitive, so it can be used for both kinds of search.
+        literal = _required_literal(regexp, flags, casefold=True)
+        if literal is not None and (flags & re.IGNORECASE) and max(map(ord, literal)) > 127:
+            # Case folding for non-ASCII characters doesn't work on bytes
+            literal = None
+        if literal is not None and u'\n'.encode(encoding) == '\n':
+            literal = literal.encode(encoding)
+        else:
+            literal = None
+        return self.__iter_closing(index, index.filter(path, walker, literal, update=update))
 
     def execute(self, context, args, options=[]):       
         regexp = args[0]
@@ -62,21 +198,37 @@ class FSearchBuiltin(FileOpBuiltin):
             path = args[1]
         else:
             path = context.cwd
-        regexp = args[0]
-        comp_regexp = re.compile(regexp, (('-i' in options) and re.IGNORECASE or 0) | re.UNICODE)
-        walk_builtin = BuiltinRegistry.getInstance()['walk']
-        newctx = HotwireContext(context.cwd)
-        for fobj in walk_builtin.execute(newctx, [path]):
-            fp = None
-            try:
-                fp = open_text_file(fobj.path) 
-                for i,line in enumerate(fp):
-                    match = comp_regexp.search(line)
-                    if match:
-                        yield FileStringMatch(fobj.path, line[:-1], i, match.start(), match.end())
-                fp.close()
-            except OSError, e:
-                pass
-            except UnicodeDecodeError, e:
-                pass
+        flags = (('-i' in options) and re.IGNORECASE or 0) | re.UNICODE
+        # Compile here so an invalid expression is reported before we start;
+        # this also picks up flags set inline
+        flags = re.compile(regexp, flags).flags
+        (lcode, encoding) = locale.getdefaultlocale()
+        encoding = encoding or 'UTF-8'
+        literal = _required_literal(regexp, flags)
+        if literal is not None and u'\n'.encode(encoding) == '\n':
+            literal = literal.encode(encoding)
+        else:
+            # Not an ASCII-compatible encoding; can't prefilter on bytes
+            literal = None
+        fs = Filesystem.getInstance()
+        path = path_join(context.cwd, path)
+        walker = fs.walk(path)
+        context.attribs['walker'] = walker
+        paths = self.__indexed_paths(path, walker, regexp, flags, encoding, update=('-I' in options))
+        if paths is None:
+            paths = (fobj.path for fobj in walker)
+        results = parallel_map(_scan_chunk, (regexp, flags, literal, encoding), paths,
+                               ordered=False, chunksize=_scan_chunk_size)
+        try:
+            for (fpath, matches) in results:
+                for (line, line_num, start, end) in matches:
+                    yield FileStringMatch(fpath, line, line_num, start, end)
+        finally:
+            walker.cancel()
+
+    def cancel(self, context):
+        # Stopping the walk stops handing files to the worker processes
+        if 'walker' in context.attribs:
+            context.attribs['walker'].cancel()
+
 BuiltinRegistry.getInstance().register_hotwire(FSearchBuiltin())
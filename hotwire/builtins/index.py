@@ -0,0 +1,76 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os, sys, logging
+
+import hotwire
+from hotwire.fs import path_join
+
+from hotwire.builtin import Builtin, BuiltinRegistry, ArgSpec
+from hotwire.builtins.fileop import FileOpBuiltin
+from hotwire.sysdep.fs import Filesystem
+from hotwire.contentindex import ContentIndex
+
+_logger = logging.getLogger("hotwire.builtins.Index")
+
+class IndexBuiltin(FileOpBuiltin):
+    __doc__ = _("""Maintain the content index used by fsearch.
+Actions are "update" (add the directory to the index, or bring it up to date),
+"rebuild" (discard and recreate the directory's entries), and "remove".""")
+    def __init__(self):
+        super(IndexBuiltin, self).__init__('index',
+                                           hasstatus=True,
+                                           argspec=('action', ArgSpec('directory', opt=True)))
+
+    def execute(self, context, args, options=[]):
+        action = args[0]
+        if action not in ('update', 'rebuild', 'remove'):
+            raise ValueError(_("Unknown action: %s") % (action,))
+        if len(args) == 2:
+            path = path_join(context.cwd, args[1])
+        else:
+            path = context.cwd
+        index = ContentIndex()
+        try:
+            if action == 'remove':
+                index.remove_root(path)
+                return []
+            if index.get_root(path) is None:
+                index.add_root(path)
+            elif action == 'rebuild':
+                index.clear(path)
+            walker = Filesystem.getInstance().walk(path)
+            context.attribs['walker'] = walker
+            count = 0
+            for fpath in index.filter(path, walker, update=True):
+                count += 1
+                if count % 500 == 0:
+                    context.status_notify(_('%d files') % (count,))
+            context.status_notify(_('%d files') % (count,))
+        finally:
+            index.close()
+        return []
+
+    def cancel(self, context):
+        if 'walker' in context.attribs:
+            context.attribs['walker'].cancel()
+
+BuiltinRegistry.getInstance().register_hotwire(IndexBuiltin())
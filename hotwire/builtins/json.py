@@ -20,43 +20,99 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import os,sys,pickle,inspect,locale
-from StringIO import StringIO
 
 from hotwire.fs import FilePath
 
-from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema
+from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, OutputBatch
 
 import simplejson
 
+# class -> (types of public methods, names of other public attributes)
+_schema_cache = {}
+
+def _get_schema(cls):
+    schema = _schema_cache.get(cls)
+    if schema is not None:
+        return schema
+    methods = {}
+    attrs = []
+    for name in dir(cls):
+        if name.startswith('_'):
+            continue
+        try:
+            member = getattr(cls, name)
+        except AttributeError, e:
+            continue
+        # The type of a method is the same on every instance; properties
+        # and other attributes have to be looked up on each object.
+        if inspect.ismethod(member) or inspect.isbuiltin(member) or inspect.ismethoddescriptor(member):
+            methods[name] = str(type(member))
+        else:
+            attrs.append(name)
+    schema = _schema_cache[cls] = (methods, attrs)
+    return schema
+
 class LossyObjectJSONDumper(simplejson.JSONEncoder):
     def __init__(self, *args, **kwargs):
         super(LossyObjectJSONDumper, self).__init__(*args, **kwargs)
         
     def default(self, o):
-        name_repr = {}
-        for name,member in sorted(inspect.getmembers(o), lambda a,b: locale.strcoll(a[0],b[0])):
-            if name.startswith('_'):
+        (methods, attrs) = _get_schema(getattr(o, '__class__', type(o)))
+        name_repr = dict(methods)
+        for name in attrs:
+            try:
+                name_repr[name] = str(type(getattr(o, name)))
+            except AttributeError, e:
                 continue
-            name_repr[name] = str(type(member))
-        return self.encode(name_repr)
+        instdict = getattr(o, '__dict__', None)
+        if instdict:
+            for name,member in instdict.iteritems():
+                if not name.startswith('_'):
+                    name_repr[name] = str(type(member))
+        return name_repr
 
 class JsonBuiltin(Builtin):
-    __doc__ = _("""Convert object stream to JSON.""")
+    __doc__ = _("""Convert object stream to JSON.
+By default a JSON array is output; with -l, each object is output
+on its own line (JSON Lines).""")
     def __init__(self):
         super(JsonBuiltin, self).__init__('json',
-                                          output=str, # 'any'
+                                          output=OutputStreamSchema(str, opt_formats=['x-unix-redirect-file/special']), # 'any'
                                           input=InputStreamSchema('any'),
+                                          options=[['-l', '--lines']],
                                           idempotent=True,
                                           argspec=None)
 
-    def execute(self, context, args, options=[]):
-        out = StringIO()
+    def __iter_encoded(self, context, options):
+        # Each object is encoded as it arrives
+        if '-l' in options:
+            encoder = LossyObjectJSONDumper()
+            for o in context.input:
+                yield encoder.encode(o)
+            return
+        encoder = LossyObjectJSONDumper(indent=2)
+        first = True
+        yield '['
         for o in context.input:
-            simplejson.dump(o, out, indent=2, cls=LossyObjectJSONDumper)
-        # Should support binary streaming            
-        for line in StringIO(out.getvalue()):
-            if line.endswith('\n'):
-                yield line[0:-1]
+            if first:
+                first = False
+                yield encoder.encode(o)
             else:
-                yield line
+                yield ',\n' + encoder.encode(o)
+        yield ']'
+
+    def execute(self, context, args, options=[], out_opt_format=None):
+        if out_opt_format == 'x-unix-redirect-file/special':
+            outfile = context.output_file
+            for buf in self.__iter_encoded(context, options):
+                if isinstance(buf, unicode):
+                    buf = buf.encode('utf-8')
+                outfile.write(buf)
+                if '-l' in options:
+                    outfile.write('\n')
+            if '-l' not in options:
+                outfile.write('\n')
+            return
+        for buf in self.__iter_encoded(context, options):
+            yield OutputBatch(buf.split('\n'))
 BuiltinRegistry.getInstance().register_hotwire(JsonBuiltin())
@@ -0,0 +1,56 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os, sys
+
+from hotwire.script import script
+from hotwire.builtin import Builtin, BuiltinRegistry, MultiArgSpec
+from hotwire.sysdep.fs import File, Filesystem
+from hotwire.state import History
+
+if '_' not in globals(): globals()['_'] = lambda x: x
+
+class JumpBuiltin(Builtin):
+    __doc__ = _("""Change to the most frequently and recently used directory matching the arguments.""")
+    def __init__(self):
+        super(JumpBuiltin, self).__init__('jump',
+                                          output=File,
+                                          argspec=MultiArgSpec('terms'),
+                                          options=[['-l', '--list']])
+
+    def execute(self, context, args, options=[]):
+        query = ' '.join(args)
+        # Skip directories which have been removed, and where we already are
+        accept = lambda path: path != context.cwd and os.path.isdir(path)
+        if '-l' in options:
+            fs = Filesystem.getInstance()
+            for (path, score, positions) in History.getInstance().search_dir_usage(query, accept=accept):
+                yield fs.get_file_sync(path)
+            return
+        matches = History.getInstance().search_dir_usage(query, limit=1, accept=accept)
+        if not matches:
+            raise ValueError(_("No directory matching: %s") % (query,))
+        new_dir = context.hotwire.chdir(matches[0][0])
+        pipeline = script('ls', new_dir)
+        pipeline.execute_sync()
+        for result in pipeline.get_output():
+            yield result
+BuiltinRegistry.getInstance().register_hotwire(JumpBuiltin())
@@ -29,7 +29,8 @@ class NewlineBuiltin(Builtin):
         super(NewlineBuiltin, self).__init__('newline',
                                              input=InputStreamSchema('any'),
                                              output=str,
-                                             argspec=None)
+                                             argspec=None,
+                                             fusable=True)
 
     def execute(self, context, args, options=[]):
         for arg in context.input:
@@ -0,0 +1,68 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2008 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+from hotwire.builtin import Builtin, BuiltinRegistry, MultiArgSpec
+from hotwire.command import Pipeline, HotwireContext, CommandProfile
+from hotwire.externals.dispatch import dispatcher
+
+class ProfileBuiltin(Builtin):
+    __doc__ = _("""Execute a pipeline, discarding its output, and yield how each of its commands spent its time.
+Quote the pipeline if it has more than one command.""")
+    def __init__(self):
+        super(ProfileBuiltin, self).__init__('profile',
+                                             output=CommandProfile,
+                                             hasmeta=True,
+                                             options_passthrough=True,
+                                             argspec=MultiArgSpec('pipeline', min=1))
+
+    def execute(self, context, args, options=[]):
+        new_context = HotwireContext(initcwd=context.cwd)
+        if len(args) == 1:
+            pipeline = Pipeline.parse(args[0], new_context)
+        else:
+            pipeline = Pipeline.create(new_context, None, *args)
+        exceptions = []
+        def on_profile(profiles, sender=None):
+            context.metadata('hotwire.profile', 0, profiles)
+        def on_exception(e, cmd, sender=None):
+            exceptions.append(e)
+        dispatcher.connect(on_profile, 'profile', pipeline)
+        dispatcher.connect(on_exception, 'exception', pipeline)
+        context.attribs['pipeline'] = pipeline
+        try:
+            pipeline.execute(profile=True)
+            for obj in pipeline.get_output():
+                pass
+        finally:
+            dispatcher.disconnect(on_profile, 'profile', pipeline)
+            dispatcher.disconnect(on_exception, 'exception', pipeline)
+        if exceptions:
+            raise exceptions[0]
+        for profile in pipeline.get_profile():
+            yield profile
+
+    def cancel(self, context):
+        pipeline = context.attribs.get('pipeline')
+        if pipeline is not None:
+            pipeline.cancel()
+
+BuiltinRegistry.getInstance().register_hotwire(ProfileBuiltin())
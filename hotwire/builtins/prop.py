@@ -33,7 +33,8 @@ class PropBuiltin(Builtin):
                                           idempotent=True,
                                           argspec=(ArgSpec('name'),),
                                           options=[['-t', '--tuple']],
-                                          threaded=True)
+                                          threaded=True,
+                                          fusable=True)
 
     def execute(self, context, args, options=[]):
         prop = args[0]            
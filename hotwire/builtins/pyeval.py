@@ -27,6 +27,7 @@ from hotwire.builtin import builtin_hotwire, InputStreamSchema, OutputStreamSche
 from hotwire.fs import path_join
 from hotwire.sysdep.fs import Filesystem
 from hotwire.externals.rewrite import rewrite_and_compile
+from hotwire.codecache import CodeCache
 
 @builtin_hotwire(singlevalue=True,
                  input=InputStreamSchema('any', optional=True),
@@ -54,7 +55,7 @@ expressed as an iterable which yielded a single object.""")
         # Do we assume locale encoding or UTF-8 here?
         # We probably need to scan for a -*- coding -*-
         f = open(fpath)
-        compiled = compile(f.read(), fpath, 'exec')
+        compiled = CodeCache.getInstance().compile(f.read(), fpath, 'exec')
         f.close()
         exec compiled in locals
         try:
@@ -79,6 +80,7 @@ expressed as an iterable which yielded a single object.""")
             myself['result'] = args[-1]
         locals['_hotwire_handle_output'] = handle_output
         locals['_hotwire_handle_output_self'] = {'result': None}
-        (compiled, mutated) = rewrite_and_compile(args[0], output_func_name='_hotwire_handle_output', output_func_self='_hotwire_handle_output_self')
+        (compiled, mutated) = CodeCache.getInstance().get(('py-eval', args[0]),
+            lambda: rewrite_and_compile(args[0], output_func_name='_hotwire_handle_output', output_func_self='_hotwire_handle_output_self'))
         exec compiled in locals
         return locals['_hotwire_handle_output_self']['result']
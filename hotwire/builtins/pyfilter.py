@@ -19,12 +19,22 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,re,subprocess,sha,tempfile
+import os,sys,re,subprocess,sha,tempfile,itertools
 
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, ArgSpec
 
 from hotwire.fs import path_join
 from hotwire.sysdep.fs import Filesystem
+from hotwire.procpool import parallel_map
+from hotwire.builtins.pymap import _compile_execute, _compile_batch_func, _apply_batches
+
+def _filter_chunk(expression, chunk):
+    # Runs in a worker process, which has no command context
+    func = _compile_batch_func(expression)
+    if func is not None:
+        return filter(func, chunk)
+    execute = _compile_execute(PyFilterBuiltin.PYFILTER_CONTENT, expression)
+    return list(execute(None, chunk))
 
 class PyFilterBuiltin(Builtin):
     __doc__ = _("""Filter object list using Python code.""")
@@ -39,14 +49,22 @@ def execute(context, input):
         super(PyFilterBuiltin, self).__init__('py-filter',
                                               argspec=(ArgSpec('expression'),),
                                               input=InputStreamSchema('any'),
-                                              output='identity')
+                                              output='identity',
+                                              parallel=True,
+                                              fusable=True)
 
     def execute(self, context, args, options=[]):
-        buf = self.PYFILTER_CONTENT % (args[0],)
-        code = compile(buf, '<input>', 'exec')
-        locals = {}
-        exec code in locals
-        execute = locals['execute']
+        if '-P' in options:
+            for o in parallel_map(_filter_chunk, args[0], context.input,
+                                  ordered=('--unordered' not in options)):
+                yield o
+            return
+        func = _compile_batch_func(args[0])
+        if func:
+            for o in _apply_batches(itertools.ifilter, func, context.input):
+                yield o
+            return
+        execute = _compile_execute(self.PYFILTER_CONTENT, args[0])
         custom_out = execute(context, context.input)
         if custom_out is None:
             return
@@ -19,12 +19,64 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,re,subprocess,sha,tempfile
+import os,sys,re,subprocess,sha,tempfile,itertools
 
-from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, ArgSpec
+from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, ArgSpec, OutputBatch
 
 from hotwire.fs import path_join
 from hotwire.sysdep.fs import Filesystem
+from hotwire.procpool import parallel_map
+from hotwire.async import iter_batches
+from hotwire.codecache import CodeCache, is_pure_expression
+
+_BATCH_CONTENT = '''
+import os,sys,re
+batch_func = lambda it: (%s)'''
+
+def _compile_execute(content, expression):
+    code = CodeCache.getInstance().compile(content % (expression,))
+    locals = {}
+    exec code in locals
+    return locals['execute']
+
+def _compile_batch_func(expression):
+    """Return a function computing expression for one object, or None if
+    the expression may have side effects, and so can't be applied ahead
+    to a batch of objects."""
+    cache = CodeCache.getInstance()
+    try:
+        if not is_pure_expression(cache.compile(expression, '<input>', 'eval')):
+            return None
+        code = cache.compile(_BATCH_CONTENT % (expression,))
+    except SyntaxError, e:
+        return None
+    locals = {}
+    exec code in locals
+    return locals['batch_func']
+
+def _apply_batches(batchfunc, func, input):
+    """batchfunc is itertools.imap or itertools.ifilter."""
+    for batch in iter_batches(input):
+        results = []
+        try:
+            # extend keeps what was appended before an exception
+            results.extend(batchfunc(func, batch))
+        except Exception, e:
+            # Output the results before the failing object, evaluating
+            # each object only once
+            (exc_type, exc_value, exc_tb) = sys.exc_info()
+            if results:
+                yield OutputBatch(results)
+            raise exc_type, exc_value, exc_tb
+        yield OutputBatch(results)
+
+def _map_chunk(expression, chunk):
+    # Runs in a worker process, which has no command context
+    func = _compile_batch_func(expression)
+    if func is not None:
+        return map(func, chunk)
+    execute = _compile_execute(PyMapBuiltin.PYMAP_CONTENT, expression)
+    return list(execute(None, chunk))
 
 class PyMapBuiltin(Builtin):
     __doc__ = _("""Process objects using Python code.""")
@@ -38,14 +90,22 @@ def execute(context, input):
         super(PyMapBuiltin, self).__init__('py-map',
                                            argspec=(ArgSpec('expression'),),
                                            input=InputStreamSchema('any', optional=True),
-                                           output=OutputStreamSchema('any'))
+                                           output=OutputStreamSchema('any'),
+                                           parallel=True,
+                                           fusable=True)
 
     def execute(self, context, args, options=[]):
-        buf = self.PYMAP_CONTENT % (args[0],)
-        code = compile(buf, '<input>', 'exec')
-        locals = {}
-        exec code in locals
-        execute = locals['execute']
+        if '-P' in options and context.input:
+            for o in parallel_map(_map_chunk, args[0], context.input,
+                                  ordered=('--unordered' not in options)):
+                yield o
+            return
+        func = context.input and _compile_batch_func(args[0])
+        if func:
+            for o in _apply_batches(itertools.imap, func, context.input):
+                yield o
+            return
+        execute = _compile_execute(self.PYMAP_CONTENT, args[0])
         custom_out = execute(context, context.input)
         if custom_out is None:
             return
@@ -25,16 +25,27 @@ import hotwire
 from hotwire.builtin import builtin_hotwire, InputStreamSchema
 from hotwire.fs import FilePath
 from hotwire.sysdep.fs import Filesystem
+from hotwire.procpool import parallel_map
+
+def _hash_chunk(algname, values):
+    alg = (algname == 'md5') and md5 or sha
+    return [alg.new(value).hexdigest() for value in values]
 
 @builtin_hotwire(idempotent=True,
                  input=InputStreamSchema('any', optional=True),
                  output=str,                   
-                 options=[['-5', '--md5'],])
+                 options=[['-5', '--md5'],],
+                 parallel=True)
 def sechash(context, *files):
     _("""Create a secure hash (default SHA1) from objects or file arguments.""")
     alg = ('-5' in context.options) and md5 or sha  
     fs = Filesystem.getInstance()
-    if (not files) and context.input:
+    if (not files) and context.input and ('-P' in context.options):
+        # Only the strings go to the worker processes
+        for hexdigest in parallel_map(_hash_chunk, (alg is md5) and 'md5' or 'sha', context.input,
+                                      ordered=('--unordered' not in context.options), key=str):
+            yield hexdigest
+    elif (not files) and context.input:
         for val in context.input:
             valstr = str(val)
             hashval = alg.new()
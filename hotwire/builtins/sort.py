@@ -20,19 +20,68 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import heapq, operator, logging
+
 from hotwire.text import MarkupText
-from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, ArgSpec, MultiArgSpec 
+from hotwire.async import iter_batches
+from hotwire.spill import spill_run, iter_run_file, merge_runs
+from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, ArgSpec, MultiArgSpec, OutputBatch
+
+_logger = logging.getLogger("hotwire.builtin.Sort")
+
+# Objects sorted in memory before the run is written to a temporary file
+_run_size = 50000
+# Objects output at once
+_output_batch_size = 256
 
 class SortKey(object):
     def __init__(self, proplist):
         super(SortKey, self).__init__()
         self.proplist = proplist
+        self.__get = operator.attrgetter(*proplist)
 
     def __call__(self, x):
-        li = []
-        for prop in self.proplist:
-            li.append(getattr(x,prop))
-        return li
+        return self.__get(x)
+
+class NumericSortKey(object):
+    """Sorts values by their numeric value; others sort as zero."""
+    def __init__(self, keyfunc=None):
+        super(NumericSortKey, self).__init__()
+        self.__keyfunc = keyfunc
+
+    def __call__(self, x):
+        if self.__keyfunc is not None:
+            x = self.__keyfunc(x)
+        try:
+            return float(x)
+        except (TypeError, ValueError), e:
+            return 0.0
+
+def _get_following_head_count(context):
+    """If our output goes only to a head command, return its count."""
+    if context.pipeline is None:
+        return None
+    cmds = list(context.pipeline)
+    for i,cmd in enumerate(cmds[:-1]):
+        if cmd.context is context:
+            if cmd.out_redir:
+                return None
+            nextcmd = cmds[i+1]
+            break
+    else:
+        return None
+    if nextcmd.builtin.name != 'head' or nextcmd.in_redir:
+        return None
+    count = 10
+    for arg in nextcmd.args:
+        # Anything else is a file head reads too
+        if not arg.startswith('-'):
+            return None
+        try:
+            count = int(arg[1:])
+        except ValueError, e:
+            return None
+    return count
 
 class SortBuiltin(Builtin):
     __doc__ = _("""Sort input objects by property (if defined) or using default python sorting""")
@@ -40,19 +89,69 @@ class SortBuiltin(Builtin):
         super(SortBuiltin, self).__init__('sort',
                                             input=InputStreamSchema('any'),
                                             output='identity',
-                                            options=[['-r', '--reverse']],
+                                            options=[['-r', '--reverse'], ['-n', '--numeric']],
                                             argspec=MultiArgSpec('property', min=0))
 
     def execute(self, context, args, options=[]):     
         reversesearch = '-r' in options
-        outlist = list(context.input)
         if len(args) == 0:
-            outlist.sort(reverse = reversesearch)
+            keyfunc = None
         elif len(args) == 1:
-            outlist.sort(key = lambda x: getattr(x, args[0]), reverse = reversesearch)
+            keyfunc = operator.attrgetter(args[0])
         else:
-            outlist.sort(key = SortKey(args), reverse = reversesearch)
-        for arg in outlist:
-            yield arg
+            keyfunc = SortKey(args)
+        if '-n' in options:
+            keyfunc = NumericSortKey(keyfunc)
+
+        # Only the first few are wanted; keep just those in a heap
+        count = _get_following_head_count(context)
+        if count is not None:
+            _logger.debug("sorting top %d", count)
+            if reversesearch:
+                outlist = heapq.nlargest(count, context.input, key=keyfunc)
+            else:
+                outlist = heapq.nsmallest(count, context.input, key=keyfunc)
+            yield OutputBatch(outlist)
+            return
+
+        # Sort bounded runs of (key, object), spilling all but the last to
+        # disk, then merge them
+        runs = []
+        run = []
+        can_spill = True
+        for batch in iter_batches(context.input):
+            if keyfunc is None:
+                run.extend(zip(batch, batch))
+            else:
+                run.extend(zip(map(keyfunc, batch), batch))
+            if len(run) >= _run_size:
+                run.sort(key=operator.itemgetter(0), reverse=reversesearch)
+                f = can_spill and spill_run(run) or None
+                if f is None:
+                    # The rest of the input is most likely no different
+                    can_spill = False
+                runs.append(f or run)
+                run = []
+        run.sort(key=operator.itemgetter(0), reverse=reversesearch)
+        if not runs:
+            for i in xrange(0, len(run), _output_batch_size):
+                yield OutputBatch([obj for (key, obj) in run[i:i+_output_batch_size]])
+            return
+        runs.append(run)
+        _logger.debug("merging %d sort runs", len(runs))
+        sources = []
+        for run in runs:
+            if isinstance(run, list):
+                sources.append(run)
+            else:
+                sources.append(iter_run_file(run))
+        outlist = OutputBatch()
+        for obj in merge_runs(sources, reversesearch):
+            outlist.append(obj)
+            if len(outlist) >= _output_batch_size:
+                yield outlist
+                outlist = OutputBatch()
+        if outlist:
+            yield outlist
 
 BuiltinRegistry.getInstance().register_hotwire(SortBuiltin())
@@ -31,7 +31,7 @@ from hotwire.logutil import log_except
 from hotwire.text import MarkupText
 from hotwire.async import MiniThreadPool
 from hotwire.externals.singletonmixin import Singleton
-from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, MultiArgSpec
+from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, MultiArgSpec, OutputBatch
 from hotwire.sysdep import is_windows, is_unix
 from hotwire.sysdep.proc import ProcessManager
 
@@ -40,6 +40,9 @@ if is_unix():
 
 _logger = logging.getLogger("hotwire.builtin.Sys")
 
+# Bytes read from the subprocess at once when splitting output into lines
+_read_chunk_size = 64 * 1024
+
 class SystemCompleters(dict, Singleton):
     def __init__(self):
         super(SystemCompleters, self).__init__()
@@ -72,6 +75,7 @@ class SysBuiltin(Builtin):
         super(SysBuiltin, self).__init__(name,
                                          input=InputStreamSchema(str, optional=True, opt_formats=['x-unix-pipe-file-object/special']),
                                          output=OutputStreamSchema(str, opt_formats=['x-unix-pipe-file-object/special',
+                                                                                     'x-unix-redirect-file/special',
                                                                                      'x-filedescriptor/special', 
                                                                                      'bytearray/chunked']),
                                          hasstatus=True,
@@ -100,14 +104,28 @@ class SysBuiltin(Builtin):
             pass
 
     @staticmethod
-    def __unbuffered_readlines(stream):
+    def __read_line_batches(fd, translate_newlines=False):
+        # Each read returns whatever is available, so output still streams;
+        # we just split all the complete lines it contains at once.  Reading
+        # the fd directly bypasses universal_newlines, hence translate_newlines.
+        partial = []
         try:
-            line = stream.readline()
-            while line:
-                yield line
-                line = stream.readline()
-        except IOError, e:
+            buf = os.read(fd, _read_chunk_size)
+            while buf:
+                partial.append(buf)
+                if '\n' in buf:
+                    text = ''.join(partial)
+                    if translate_newlines:
+                        text = text.replace('\r\n', '\n')
+                    lines = text.split('\n')
+                    partial = [lines.pop()]
+                    yield OutputBatch([line + '\n' for line in lines])
+                buf = os.read(fd, _read_chunk_size)
+        except (IOError, OSError), e:
             pass
+        partial = ''.join(partial)
+        if partial:
+            yield OutputBatch([partial])
 
     @staticmethod
     def __unbuffered_read_pipe(fd=None, stream=None):
@@ -162,8 +180,13 @@ class SysBuiltin(Builtin):
         # (determined by bytearray/chunked).  There is also a special hack
         # x-filedescriptor/special where we pass along a file descriptor from
         # the subprocess; this is used in unicode.py to directly read the output.
+        # Finally, with x-unix-redirect-file/special the subprocess writes
+        # straight into the file it was redirected to, and with an input 
+        # redirection we get that file in place of a pipe; either way the
+        # data never passes through this process.
         
-        using_pty_out = pty_available and (out_opt_format not in (None, 'x-unix-pipe-file-object/special'))
+        using_pty_out = pty_available and (out_opt_format not in (None, 'x-unix-pipe-file-object/special',
+                                                                  'x-unix-redirect-file/special'))
         using_pty_in = pty_available and (in_opt_format is None) and \
                        context.input_is_first and hasattr(context.input, 'connect')
         _logger.debug("using pty in: %s out: %s", using_pty_in, using_pty_out)
@@ -201,7 +224,10 @@ class SysBuiltin(Builtin):
         else:
             _logger.debug("no pty available or non-chunked output, not allocating fds")
             (master_fd, slave_fd) = (None, None)
-            stdout_target = subprocess.PIPE
+            if out_opt_format == 'x-unix-redirect-file/special':
+                stdout_target = context.output_file
+            else:
+                stdout_target = subprocess.PIPE
             if context.input is None:
                 stdin_target = None
             elif in_opt_format == 'x-unix-pipe-file-object/special':
@@ -281,12 +307,14 @@ class SysBuiltin(Builtin):
         if using_pty_out:
             stdout_read = None
             stdout_fd = master_fd
+        elif out_opt_format == 'x-unix-redirect-file/special':
+            (stdout_read, stdout_fd) = (None, None)
         else:
             stdout_read = subproc.stdout
             stdout_fd = subproc.stdout.fileno()
         if out_opt_format is None:
-            for line in SysBuiltin.__unbuffered_readlines(stdout_read):
-                yield line
+            for lines in SysBuiltin.__read_line_batches(stdout_fd, is_windows()):
+                yield lines
         elif out_opt_format == 'bytearray/chunked':     
             try:
                 for buf in SysBuiltin.__unbuffered_read_pipe(stream=stdout_read, fd=stdout_fd):
@@ -298,6 +326,8 @@ class SysBuiltin(Builtin):
         elif out_opt_format == 'x-filedescriptor/special':
             context.attribs['master_fd_passed'] = True            
             yield stdout_fd
+        elif out_opt_format == 'x-unix-redirect-file/special':
+            pass
         else:
             assert(False)
         retcode = subproc.wait()
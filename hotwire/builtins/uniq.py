@@ -19,30 +19,103 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os, operator, itertools, cPickle, logging
+
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, ArgSpec
+from hotwire.spill import PartitionSpill, spill_run, iter_run_file, merge_runs
+from hotwire.sketch import ScalableBloomFilter, HyperLogLog, SpaceSaving
+
+_logger = logging.getLogger("hotwire.builtin.Uniq")
+
+# Distinct values kept in memory before exact modes spill to disk
+_max_memory_items = 1000000
+_spill_partitions = 64
+_default_error_rate = 0.001
+
+def _get_error_rate():
+    rate = os.environ.get('HOTWIRE_UNIQ_ERROR_RATE')
+    if rate is None:
+        return _default_error_rate
+    try:
+        rate = float(rate)
+    except ValueError, e:
+        rate = 0
+    if not (0 < rate < 1):
+        _logger.warn("ignoring invalid HOTWIRE_UNIQ_ERROR_RATE %r", os.environ['HOTWIRE_UNIQ_ERROR_RATE'])
+        return _default_error_rate
+    return rate
 
 class UniqBuiltin(Builtin):
-    __doc__ = _("""Let through only unique items dropping duplicates, optionally matching on a property.  The item/property being matched must be immutable (string, tuple etc).""")
+    __doc__ = _("""Let through only unique items dropping duplicates, optionally matching on a property.  The item/property being matched must be immutable (string, tuple etc).
+With -c, yield (count, item) pairs; with -d, only the number of unique items.
+Past a million unique items, those that can be pickled are kept in temporary files.
+With -a, use much less memory at the cost of exactness: a Bloom filter, which may
+drop some unique items; estimated counts of the most frequent items with -c;
+an estimated number with -d.  The error rate is read from HOTWIRE_UNIQ_ERROR_RATE
+(default 0.001).""")
     def __init__(self):
         super(UniqBuiltin, self).__init__('uniq',
                                             input=InputStreamSchema('any'),
                                             output='any',
-                                            options=[['-c', '--count']],
+                                            options=[['-c', '--count'], ['-d', '--distinct'],
+                                                     ['-a', '--approximate']],
                                             argspec=(ArgSpec('property', opt=True),))
 
     def execute(self, context, args, options=[]):     
         if len(args) == 1:
-            target_prop = args[0]
+            values = itertools.imap(operator.attrgetter(args[0]), context.input)
         else:
-            target_prop = None
+            values = context.input
         count_obj = '-c' in options
+        approximate = '-a' in options
+        if '-d' in options:
+            if count_obj:
+                raise ValueError(_("At most one of -c and -d can be specified"))
+            if approximate:
+                distinct = HyperLogLog(_get_error_rate())
+                for value in values:
+                    distinct.add(value)
+                return [len(distinct)]
+            return [sum(itertools.imap(lambda x: 1, self.__uniq(values, False)))]
+        if approximate and count_obj:
+            return self.__top(values)
+        elif approximate:
+            return self.__approximate(values)
+        return self.__uniq(values, count_obj)
+
+    def __approximate(self, values):
+        seen = ScalableBloomFilter(_get_error_rate())
+        for value in values:
+            if not seen.add(value):
+                yield value
+
+    def __top(self, values):
+        # Counts are within error rate * number of items of the real ones
+        counters = SpaceSaving(int(1 / _get_error_rate() + 0.5))
+        for value in values:
+            counters.add(value)
+        for (count, error, value) in counters.top():
+            yield (count, value)
+
+    def __uniq(self, values, count_obj):
         order_unique_items = []
         unique_items = {}
-        for arg in context.input:
-            if target_prop is not None:
-                value = getattr(arg, target_prop)
-            else:
-                value = arg
+        spill = None
+        can_spill = True
+        for value in values:
+            if spill is not None:
+                try:
+                    spill.add(value, (value, seq, 1))
+                    seq += 1
+                    continue
+                except (cPickle.PicklingError, TypeError), e:
+                    (order_unique_items, unique_items, unyielded, recorded) = self.__recover(spill, seq, count_obj)
+                    spill = None
+                    can_spill = False
+                    for item in unyielded:
+                        yield item
+                    if recorded:
+                        continue
             if value in unique_items:
                 if count_obj:
                     unique_items[value] += 1
@@ -53,9 +126,105 @@ class UniqBuiltin(Builtin):
                 order_unique_items.append(value)
             else:
                 yield value
-        if count_obj:
+            if can_spill and len(unique_items) >= _max_memory_items:
+                spill = self.__spill_items(unique_items, order_unique_items, count_obj)
+                if spill is not None:
+                    seq = len(unique_items)
+                    unique_items = order_unique_items = None
+                else:
+                    can_spill = False
+        if spill is not None:
+            try:
+                # Items are written in batches, so the last ones may not
+                # have been tried yet
+                spill.flush()
+            except (cPickle.PicklingError, TypeError), e:
+                (order_unique_items, unique_items, unyielded, recorded) = self.__recover(spill, seq, count_obj)
+                spill = None
+                for item in unyielded:
+                    yield item
+        if spill is not None:
+            for item in self.__iter_spilled(spill, count_obj):
+                yield item
+        elif count_obj:
             for item in order_unique_items:
                 yield (unique_items[item], item)
-                        
+
+    def __spill_items(self, unique_items, order_unique_items, count_obj):
+        """Move the items seen so far to disk, recording each as (value, order, count)
+where the order of items already yielded is -1."""
+        _logger.debug("spilling %d unique items", len(unique_items))
+        spill = PartitionSpill(_spill_partitions)
+        try:
+            if count_obj:
+                for i,value in enumerate(order_unique_items):
+                    spill.add(value, (value, i, unique_items[value]))
+            else:
+                for value in unique_items:
+                    spill.add(value, (value, -1, 1))
+        except (cPickle.PicklingError, TypeError), e:
+            _logger.warn("can't spill unique items, keeping them in memory", exc_info=True)
+            spill.close()
+            return None
+        return spill
+
+    def __recover(self, spill, seq, count_obj):
+        """Read the spilled items back into memory after one couldn't be written.
+Returns the unique items in order, their counts, those of them not yielded yet,
+and whether the item with order seq was recorded."""
+        _logger.warn("can't spill unique items, keeping them in memory", exc_info=True)
+        (entries, recorded) = self.__unspill(spill, seq)
+        order_unique_items = sorted(entries, key=lambda item: entries[item][0])
+        unique_items = dict([(item, entry[1]) for (item, entry) in entries.iteritems()])
+        if count_obj:
+            unyielded = []
+        else:
+            # Those spilled since the first spill haven't been yielded yet
+            unyielded = [item for item in order_unique_items if entries[item][0] >= 0]
+            order_unique_items = []
+        return (order_unique_items, unique_items, unyielded, recorded)
+
+    def __unspill(self, spill, seq):
+        """Read the spilled items back, returning a dict mapping each value to
+[order, count] and whether the item with order seq was recorded."""
+        entries = {}
+        recorded = False
+        for (value, item_seq, count) in spill.recover():
+            recorded = recorded or item_seq == seq
+            entry = entries.get(value)
+            if entry is None:
+                entries[value] = [item_seq, count]
+            else:
+                entry[0] = min(entry[0], item_seq)
+                entry[1] += count
+        return (entries, recorded)
+
+    def __iter_spilled(self, spill, count_obj):
+        # Find the first occurrence and count of each value a partition at a
+        # time, then merge the partitions back into input order
+        runs = []
+        for partition in spill.iter_partitions():
+            unique_items = {}
+            for (value, seq, count) in partition:
+                entry = unique_items.get(value)
+                if entry is None:
+                    unique_items[value] = [seq, count]
+                else:
+                    entry[1] += count
+            if count_obj:
+                run = [(seq, (count, value)) for (value, (seq, count)) in unique_items.iteritems()]
+            else:
+                run = [(seq, value) for (value, (seq, count)) in unique_items.iteritems() if seq >= 0]
+            unique_items = None
+            run.sort(key=operator.itemgetter(0))
+            runs.append(spill_run(run) or run)
+        sources = []
+        for run in runs:
+            if isinstance(run, list):
+                sources.append(run)
+            else:
+                sources.append(iter_run_file(run))
+        for item in merge_runs(sources):
+            yield item
 
 BuiltinRegistry.getInstance().register_hotwire(UniqBuiltin())
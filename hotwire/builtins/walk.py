@@ -32,12 +32,13 @@ from hotwire.sysdep.fs import Filesystem, File, FileStatError
 _logger = logging.getLogger("hotwire.builtins.Walk")
 
 class WalkBuiltin(FileOpBuiltin):
-    __doc__ = _("""Recursively traverse directory tree.""")
+    __doc__ = _("""Recursively traverse directory tree.  Directories are scanned in parallel,
+so results are in no particular order unless --sorted is given.""")
     def __init__(self):
         super(WalkBuiltin, self).__init__('walk',
                                           output=File,
                                           argspec=(ArgSpec('directory', opt=True),),
-                                          options=[['-a', '--all']])
+                                          options=[['-a', '--all'], ['-s', '--sorted']])
 
     def execute(self, context, args, options=[]):
         fs = Filesystem.getInstance()
@@ -45,27 +46,14 @@ class WalkBuiltin(FileOpBuiltin):
             path = path_join(context.cwd, args[0])
         else:
             path = context.cwd
-        if '-a' not in options:
-            ignorecheck = True
-        else:
-            ignorecheck = False 
-        for (dirpath, subdirs, fnames) in os.walk(path):
-            filtered_dirs = []
-            if ignorecheck:
-                for i,dpath in enumerate(subdirs):
-                    try:
-                        dstat = fs.get_file_sync(dpath)
-                        if dstat.hidden:
-                            filtered_dirs.append(i)
-                    except FileStatError, e:
-                        continue
-                for c,i in enumerate(filtered_dirs):
-                    del subdirs[i-c]
-            for fname in fnames:
-                fpath = path_join(dirpath, fname)                
-                fobj = fs.get_file_sync(fpath)
-                if ignorecheck and fobj.hidden:
-                    continue
-                yield fobj
+        walker = fs.walk(path, show_all=('-a' in options),
+                         threads=(('-s' in options) and 1 or None))
+        context.attribs['walker'] = walker
+        for fobj in walker:
+            yield fobj
+
+    def cancel(self, context):
+        if 'walker' in context.attribs:
+            context.attribs['walker'].cancel()
 
 BuiltinRegistry.getInstance().register_hotwire(WalkBuiltin())
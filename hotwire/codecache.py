@@ -0,0 +1,93 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading, logging
+
+from hotwire.externals.singletonmixin import Singleton
+
+_logger = logging.getLogger("hotwire.CodeCache")
+
+_default_max_entries = 256
+
+# Names whose use suggests an expression does more than compute a value;
+# such expressions must see objects one at a time, in order.
+_side_effect_names = frozenset(['context', 'hot_context', 'print', 'open', 'file', 'input', 'raw_input',
+                                'write', 'writelines', 'flush', 'send', 'put', 'append', 'extend',
+                                'insert', 'remove', 'pop', 'popitem', 'clear', 'update', 'setdefault',
+                                'add', 'discard', 'next', 'exec', 'execfile', 'eval', 'reload',
+                                '__import__', 'setattr', 'delattr', 'globals', 'locals', 'vars',
+                                'os', 'sys', 'subprocess', 'shutil'])
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names.update(_code_names(const))
+    return names
+
+def is_pure_expression(code):
+    """Return whether compiled expression code appears free of side effects,
+    judged by the names it uses."""
+    return not (_code_names(code) & _side_effect_names)
+
+class CodeCache(Singleton):
+    """A bounded cache of compiled Python code, keyed by source text, so that
+expressions run repeatedly from scripts are compiled once.  Least recently
+used entries are evicted first."""
+    def __init__(self):
+        super(CodeCache, self).__init__()
+        self.__maxentries = _default_max_entries
+        self.__lock = threading.Lock()
+        # key -> [last used tick, value]
+        self.__entries = {}
+        self.__ticks = 0
+
+    def get(self, key, compilefunc):
+        """Return the value cached for key, first storing compilefunc() if
+        there is none.  Exceptions from compilefunc are not cached."""
+        self.__lock.acquire()
+        try:
+            self.__ticks += 1
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry[0] = self.__ticks
+                return entry[1]
+        finally:
+            self.__lock.release()
+        value = compilefunc()
+        self.__lock.acquire()
+        try:
+            if len(self.__entries) >= self.__maxentries:
+                self.__evict()
+            self.__entries[key] = [self.__ticks, value]
+        finally:
+            self.__lock.release()
+        return value
+
+    def compile(self, source, filename='<input>', mode='exec'):
+        return self.get((source, filename, mode), lambda: compile(source, filename, mode))
+
+    def __evict(self):
+        # Called with the lock held; drop the older half at once, so the
+        # sort is amortized over many insertions
+        entries = sorted(self.__entries.iteritems(), key=lambda (k, v): v[0])
+        for (key, entry) in entries[:len(entries) // 2 + 1]:
+            del self.__entries[key]
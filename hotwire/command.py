@@ -27,10 +27,10 @@ import hotwire.fs
 from hotwire.fs import path_normalize, unix_basename, FilePath, open_text_file
 from hotwire.sysdep.fs import Filesystem, File
 from hotwire.async import IterableQueue, MiniThreadPool
-from hotwire.builtin import BuiltinRegistry, Builtin, ArgSpec, MultiArgSpec
+from hotwire.builtin import BuiltinRegistry, Builtin, ArgSpec, MultiArgSpec, OutputBatch
 import hotwire.util
 from hotwire.util import quote_arg, assert_strings_equal, class_is_assignable
-from hotwire.gutil import call_idle,call_timeout
+from hotwire.gutil import call_idle,call_timeout,remove_idle
 import hotwire.script
 import hotwire.externals.shlex as shlex
 from hotwire.externals.singletonmixin import Singleton
@@ -38,6 +38,32 @@ from hotwire.externals.dispatch import dispatcher
 
 _logger = logging.getLogger("hotwire.Command")
 
+# Maximum number of objects a threaded command may have queued for its consumer
+default_queue_capacity = 4096
+# Number of objects moved per lock acquisition from a precomputed result
+_put_batch_size = 256
+
+# A builtin accepting this output format writes its bytes directly to the
+# file object in context.output_file; used for redirections.
+REDIRECT_OUT_FORMAT = 'x-unix-redirect-file/special'
+# Input redirections are passed as a file object in this format
+_REDIRECT_IN_FORMAT = 'x-unix-pipe-file-object/special'
+# Milliseconds between profile signals from an executing pipeline
+_profile_interval = 500
+
+try:
+    import resource
+    _RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+    if _RUSAGE_THREAD is None and sys.platform.startswith('linux'):
+        _RUSAGE_THREAD = 1
+    have_thread_cputime = _RUSAGE_THREAD is not None
+except ImportError, e:
+    have_thread_cputime = False
+
+def _thread_cputime():
+    usage = resource.getrusage(_RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
 class PipelineTypeData(object):
     """Represents a snapshot of metadata from a pipeline execution."""
     type = property(lambda self: self._type)
@@ -115,6 +141,8 @@ class CommandContext(object):
         self.hotwire = hotwire
         self.__auxstreams = {}
         self.__metadata_handler = None
+        # Target of a redirection, with REDIRECT_OUT_FORMAT output
+        self.output_file = None
         # Private attributes to be used by the builtin
         self.attribs = {}
         self.options = []
@@ -157,10 +185,94 @@ class CommandContext(object):
         if self.__metadata_handler:
             self.__metadata_handler(metatype, flags, value)
 
+class CommandProfile(object):
+    """Where a command spent its time, recorded when its pipeline is executed
+with profiling.  Times are in seconds; a fused command runs in the thread
+of its reader, which is charged for its CPU time."""
+    wall_time = property(lambda self: self.__get_wall_time(), doc="""Time since the command started.""")
+    busy_time = property(lambda self: max(self.wall_time - self.input_wait - self.output_wait, 0), doc="""Time not spent waiting for other commands.""")
+    input_rate = property(lambda self: self.__get_rate(self.objects_in), doc="""Objects read per second.""")
+    output_rate = property(lambda self: self.__get_rate(self.objects_out), doc="""Objects written per second.""")
+    complete = property(lambda self: self.end_time is not None)
+
+    def __init__(self, command, index):
+        super(CommandProfile, self).__init__()
+        self.command = unicode(command)
+        self.name = command.builtin.name
+        self.index = index
+        self.fused = command.fused
+        self.objects_in = 0
+        self.objects_out = 0
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self.cpu_time = None
+        self.peak_queue_depth = 0
+        self.start_time = None
+        self.end_time = None
+        self.__start_cputime = None
+
+    def __get_wall_time(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def __get_rate(self, count):
+        wall_time = self.wall_time
+        if wall_time <= 0:
+            return 0.0
+        return count / wall_time
+
+    def start(self):
+        self.start_time = time.time()
+        if have_thread_cputime and not self.fused:
+            self.__start_cputime = _thread_cputime()
+
+    def finish(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        if self.__start_cputime is not None:
+            self.cpu_time = _thread_cputime() - self.__start_cputime
+
+    def note_input(self, items, wait):
+        self.objects_in += len(items) - items.count(None)
+        self.input_wait += wait
+
+    def note_output(self, items, wait, depth):
+        self.objects_out += len(items) - items.count(None)
+        self.output_wait += wait
+        if depth > self.peak_queue_depth:
+            self.peak_queue_depth = depth
+
+    def __str__(self):
+        return '%s: %d in, %d out, %.2fs' % (self.command, self.objects_in, self.objects_out, self.wall_time)
+
 class CommandQueue(IterableQueue):
-    def __init__(self):
-        IterableQueue.__init__(self)
+    def __init__(self, capacity=0):
+        IterableQueue.__init__(self, capacity)
         self.opt_type = None
+        # CommandProfile of each end, if profiling
+        self.producer_profile = None
+        self.consumer_profile = None
+
+    def put_many(self, items, force=False, block=True, timeout=None):
+        profile = self.producer_profile
+        if profile is None:
+            return IterableQueue.put_many(self, items, force=force, block=block, timeout=timeout)
+        if not isinstance(items, (list, tuple)):
+            items = list(items)
+        start = time.time()
+        IterableQueue.put_many(self, items, force=force, block=block, timeout=timeout)
+        profile.note_output(items, time.time() - start, self.qsize())
+
+    def get_many(self, maxitems, block=True):
+        profile = self.consumer_profile
+        if profile is None:
+            return IterableQueue.get_many(self, maxitems, block=block)
+        start = time.time()
+        items = IterableQueue.get_many(self, maxitems, block=block)
+        profile.note_input(items, time.time() - start)
+        return items
 
     def negotiate(self, out_fmts, in_fmts):
         _logger.debug("negotiating stream; out_fmts: %s in_fmts: %s", out_fmts, in_fmts)
@@ -171,7 +283,8 @@ class CommandQueue(IterableQueue):
                 break
             
     def cancel(self):
-        self.put(None)
+        # The consumer must see the end, even if the producer was abandoned
+        self.put_many((None,), force=True)
         
 class CommandFileQueue(object):
     """Implements command queue protocol, yielding lines from a file."""
@@ -193,6 +306,68 @@ class CommandFileQueue(object):
         self.__f.close()
         self.__f = None
 
+class CommandRawFileQueue(CommandFileQueue):
+    """Implements command queue protocol, yielding a file object opened on
+the input redirection; the builtin reads it directly."""
+    def __init__(self, f):
+        super(CommandRawFileQueue, self).__init__(f)
+        self.__f = f
+
+    def __iter__(self):
+        yield self.__f
+
+class CommandFusedQueue(object):
+    """Implements command queue protocol by running the command producing
+the input in the reader's thread, yielding its output directly."""
+    def __init__(self, command):
+        self.command = command
+        self.opt_type = None
+        self.consumer_profile = None
+        self.__batches = None
+        self.__pending = []
+
+    def negotiate(self, out_fmts, in_fmts):
+        pass
+
+    def __get_batches(self):
+        if self.__batches is None:
+            self.__batches = self.command.iter_fused_batches(self.consumer_profile)
+        return self.__batches
+
+    def __iter__(self):
+        for item in self.__pending:
+            yield item
+        self.__pending = []
+        for batch in self.__get_batches():
+            for item in batch:
+                yield item
+
+    def get_many(self, maxitems, block=True):
+        """Return a list of at most maxitems items, running the command until
+it outputs some; as from a queue, None ends the stream.  Running the command
+may block, so unless block is true, raise Queue.Empty instead."""
+        if not self.__pending:
+            if not block:
+                raise Queue.Empty
+            for batch in self.__get_batches():
+                self.__pending = batch
+                break
+            else:
+                return [None]
+        items = self.__pending[:maxitems]
+        self.__pending = self.__pending[maxitems:]
+        return items
+
+    def cancel(self):
+        self.command.cancel()
+
+    def close(self):
+        if self.__batches is not None:
+            self.__batches.close()
+            self.__batches = None
+        # Even if we never read from it
+        self.command.finish_fused()
+
 class CommandAuxStream(object):
     def __init__(self, command, schema):
         self.command = command
@@ -233,11 +408,16 @@ class Command(object):
         self.in_redir = in_redir and FilePath(os.path.expanduser(in_redir), self.context.cwd)
         self.out_redir = out_redir and FilePath(os.path.expanduser(out_redir), self.context.cwd)
         self.out_append = out_append
+        # Whether we run in the thread of the command reading our output
+        self.fused = False
+        # CommandProfile, if profiling
+        self.profile = None
         
         self.__thread = None
         self.__executing_sync = None
         self._cancelled = False
         self.__tokens = tokens
+        self.__fused_finished = False
 
     def set_pipeline(self, pipeline):
         self.context.set_pipeline(pipeline)
@@ -261,6 +441,9 @@ class Command(object):
         self.context.cancelled = True
         if self.context.input:
             self.context.input.cancel()
+        # Unblock our thread if it's waiting for the consumer
+        if isinstance(self.output, CommandQueue):
+            self.output.abandon()
         self.builtin.cancel(self.context)
 
     def get_input_opt_formats(self):
@@ -270,13 +453,20 @@ class Command(object):
         return self.builtin.output_opt_formats
 
     def execute(self, force_sync, **kwargs):
-        if force_sync or not self.builtin.threaded:
+        if self.fused:
+            _logger.debug("executing fused: %s", self)
+            self.__executing_sync = force_sync
+        elif force_sync or not self.builtin.threaded:
             _logger.debug("executing sync: %s", self)
             self.__executing_sync = True
             self.__run(**kwargs)
         else:         
             _logger.debug("executing async: %s", self)              
             self.__executing_sync = False             
+            # Only a threaded producer can wait for its consumer; bound the
+            # queue so it can't get arbitrarily far ahead.
+            if isinstance(self.output, CommandQueue):
+                self.output.set_capacity(default_queue_capacity)
             self.__thread = threading.Thread(target=self.__run)
             self.__thread.setDaemon(True)            
             self.__thread.start()
@@ -293,62 +483,67 @@ class Command(object):
         return self.__tokens
 
     def __run(self, *args, **kwargs):
+        if self.profile is not None:
+            self.profile.start()
         if self._cancelled:
             _logger.debug("%s cancelled, returning", self)
-            self.output.put(self.map_fn(None))
+            if self.profile is not None:
+                self.profile.finish()
+            self.output.put_many((self.map_fn(None),), force=True)
             return
         try:
-            matched_files = []
-            oldlen = 0
-            for globarg_in in self.args:
-                if isinstance(globarg_in, CommandArgument) and globarg_in.isquoted:
-                    globarg = globarg_in
-                    newlen = oldlen                    
-                else:
-                    globarg = os.path.expanduser(globarg_in)
-                    matched_files.extend(hotwire.fs.dirglob(self.context.cwd, globarg))
-                    _logger.debug("glob on %s matched is: %s", globarg_in, matched_files) 
-                    newlen = len(matched_files)
-                if oldlen == newlen:
-                    matched_files.append(globarg)
-                    newlen += 1
-                oldlen = newlen
-            target_args = [matched_files]
-            _logger.info("Execute '%s' args: %s options: %s", self.builtin, target_args, self.context.options)
-            kwargs = {}
-            if self.context.options and not self.builtin.flattened_args:
-                kwargs['options'] = self.context.options
-            if self.input is not None and self.input.opt_type and not self.in_redir:
-                kwargs['in_opt_format'] = self.input.opt_type                
-            if self.output.opt_type and not self.out_redir:
-                kwargs['out_opt_format'] = self.output.opt_type
-            if self.in_redir:
+            (target_args, kwargs) = self.__get_exec_args()
+            if self.in_redir and _REDIRECT_IN_FORMAT in self.builtin.input_opt_formats:
+                # Let the builtin hand the file to its subprocess
+                _logger.debug("input redirected, passing %s", self.in_redir)
+                self.context.input = CommandRawFileQueue(open(self.in_redir, 'rb'))
+                kwargs['in_opt_format'] = _REDIRECT_IN_FORMAT
+            elif self.in_redir:
                 _logger.debug("input redirected, opening %s", self.in_redir)
                 self.context.input = CommandFileQueue(open_text_file(self.in_redir, 'r'))
-            if self.out_redir:
+            if self.out_redir and REDIRECT_OUT_FORMAT in self.builtin.output_opt_formats:
+                _logger.debug("output redirected, passing %s", self.out_redir)
+                self.context.output_file = open(self.out_redir, self.out_append and 'ab' or 'wb')
+                kwargs['out_opt_format'] = REDIRECT_OUT_FORMAT
+                outfile = self.context.output_file
+            elif self.out_redir:
                 _logger.debug("output redirected, opening %s", self.out_redir)
                 outfile = open_text_file(self.out_redir, self.out_append and 'a+' or 'w')
             else:
                 outfile = None
             try:
-                exectarget = self.builtin.execfunc
-                if self.builtin.flattened_args:
-                    target_args = target_args[0]
-                execresult = exectarget(self.context, *target_args, **kwargs)                
+                execresult = self.builtin.execfunc(self.context, *target_args, **kwargs)
                 if self.builtin.singlevalue:
                     if outfile:
                         outfile.write(unicode(execresult))
                     else:
                         self.output.put(execresult)
+                elif isinstance(execresult, (list, tuple)) and not outfile:
+                    # Already computed; move it over in chunks
+                    map_fn = self.map_fn
+                    for i in xrange(0, len(execresult), _put_batch_size):
+                        if self._cancelled and not self.builtin.hasstatus:
+                            break
+                        self.output.put_many([map_fn(x) for x in execresult[i:i+_put_batch_size]])
                 else:
                     for result in execresult:
                         # if it has status, let it do its own cleanup
                         if self._cancelled and not self.builtin.hasstatus:
                             _logger.debug("%s cancelled, returning", self)
-                            self.output.put(self.map_fn(None))
+                            if self.profile is not None:
+                                self.profile.finish()
+                            self.output.put_many((self.map_fn(None),), force=True)
                             dispatcher.send('complete', self)
                             return
-                        if outfile and (result is not None):
+                        if isinstance(result, OutputBatch):
+                            if outfile:
+                                for item in result:
+                                    if item is not None:
+                                        outfile.write(unicode(item))
+                            else:
+                                map_fn = self.map_fn
+                                self.output.put_many([map_fn(x) for x in result])
+                        elif outfile and (result is not None):
                             result = unicode(result)
                             outfile.write(result)
                         else:                        
@@ -363,7 +558,102 @@ class Command(object):
                 raise
             else:
                 dispatcher.send('exception', self, e)
-        self.output.put(self.map_fn(None))
+        finally:
+            self.__release_input()
+        if self.profile is not None:
+            self.profile.finish()
+        # Always terminate the stream, even if we were cancelled
+        self.output.put_many((self.map_fn(None),), force=True)
+        dispatcher.send('complete', self)
+
+    def __get_exec_args(self):
+        matched_files = []
+        oldlen = 0
+        for globarg_in in self.args:
+            if isinstance(globarg_in, CommandArgument) and globarg_in.isquoted:
+                globarg = globarg_in
+                newlen = oldlen                    
+            else:
+                globarg = os.path.expanduser(globarg_in)
+                matched_files.extend(hotwire.fs.dirglob(self.context.cwd, globarg))
+                _logger.debug("glob on %s matched is: %s", globarg_in, matched_files) 
+                newlen = len(matched_files)
+            if oldlen == newlen:
+                matched_files.append(globarg)
+                newlen += 1
+            oldlen = newlen
+        target_args = [matched_files]
+        _logger.info("Execute '%s' args: %s options: %s", self.builtin, target_args, self.context.options)
+        kwargs = {}
+        if self.context.options and not self.builtin.flattened_args:
+            kwargs['options'] = self.context.options
+        if self.input is not None and self.input.opt_type and not self.in_redir:
+            kwargs['in_opt_format'] = self.input.opt_type                
+        if self.output.opt_type and not self.out_redir:
+            kwargs['out_opt_format'] = self.output.opt_type
+        if self.builtin.flattened_args:
+            target_args = target_args[0]
+        return (target_args, kwargs)
+
+    def __release_input(self):
+        # We won't read any more input; don't leave the producer waiting
+        if isinstance(self.input, CommandQueue):
+            self.input.abandon()
+        elif isinstance(self.input, CommandFusedQueue):
+            self.input.close()
+
+    def iter_fused_batches(self, reader_profile=None):
+        """Run the builtin in the calling thread, yielding a list of the
+objects in each of its results as soon as it is computed; used by the reader
+of a fused command instead of our output queue."""
+        profile = self.profile
+        if profile is not None:
+            profile.start()
+        try:
+            if self._cancelled:
+                _logger.debug("%s cancelled, returning", self)
+                return
+            (target_args, kwargs) = self.__get_exec_args()
+            try:
+                for result in self.builtin.execfunc(self.context, *target_args, **kwargs):
+                    if self._cancelled and not self.builtin.hasstatus:
+                        _logger.debug("%s cancelled, returning", self)
+                        return
+                    if isinstance(result, OutputBatch):
+                        batch = list(result)
+                    else:
+                        batch = [result]
+                    # As through a queue, None ends the stream
+                    ended = None in batch
+                    if ended:
+                        batch = batch[:batch.index(None)]
+                    if batch:
+                        if profile is not None:
+                            profile.objects_out += len(batch)
+                            reader_profile.objects_in += len(batch)
+                        yield batch
+                    if ended:
+                        return
+            except Exception, e:
+                # Ours, not our reader's
+                _logger.debug("Caught exception from command: %s", e, exc_info=True)
+                if self.__executing_sync:
+                    raise
+                dispatcher.send('exception', self, e)
+            finally:
+                self.builtin.cleanup(self.context)
+        finally:
+            self.finish_fused()
+
+    def finish_fused(self):
+        """Called when the reader of a fused command is done with it, whether
+or not it ran."""
+        if self.__fused_finished:
+            return
+        self.__fused_finished = True
+        self.__release_input()
+        if self.profile is not None:
+            self.profile.finish()
         dispatcher.send('complete', self)
         
     def get_executing_sync(self):
@@ -497,6 +787,7 @@ class Pipeline(object):
         self.__cmd_complete_count = 0
         self.__state = 'waiting'
         self.__completion_time = None
+        self.__profile_timeout_id = 0
         
     def get_state(self):
         return self.__state     
@@ -505,8 +796,72 @@ class Pipeline(object):
         for cmd in self.__components:
             cmd.disconnect()
     
-    def __execute_internal(self, force_sync, opt_formats=[], assert_all_threaded=False):
+    @staticmethod
+    def __can_fuse(prev, cmd):
+        if prev.fused:
+            return True
+        # A parallel command mostly waits for its worker processes, and
+        # must be able to check for input without blocking
+        return prev.builtin.fusable and prev.builtin.threaded \
+                and cmd.builtin.fusable and cmd.builtin.threaded \
+                and not (cmd.builtin.parallel and '-P' in cmd.context.options) \
+                and cmd.input is prev.output and not prev.out_redir
+
+    def get_plan(self):
+        """Return the commands as a list of stages; each stage runs in one
+thread, its commands passing objects directly instead of through queues."""
+        stages = []
+        prev = None
+        for cmd in self.__components:
+            if prev is not None and Pipeline.__can_fuse(prev, cmd):
+                stages[-1].append(cmd)
+            else:
+                stages.append([cmd])
+            prev = cmd
+        return stages
+
+    def format_plan(self):
+        """Return a string showing the stages of the pipeline, for debugging."""
+        return ' | '.join([' + '.join(map(unicode, stage)) for stage in self.get_plan()])
+
+    def __fuse_stages(self):
+        for stage in self.get_plan():
+            for prev,cmd in zip(stage[:-1], stage[1:]):
+                if not prev.fused:
+                    prev.fused = True
+                    cmd.set_input(CommandFusedQueue(prev), is_first=cmd.context.input_is_first)
+
+    def __enable_profile(self):
+        for i,cmd in enumerate(self.__components):
+            cmd.profile = CommandProfile(cmd, i)
+        for cmd in self.__components:
+            if isinstance(cmd.output, CommandQueue):
+                cmd.output.producer_profile = cmd.profile
+            if isinstance(cmd.input, (CommandQueue, CommandFusedQueue)):
+                cmd.input.consumer_profile = cmd.profile
+
+    def get_profile(self):
+        """Return a CommandProfile for each command, or None if the pipeline
+was not executed with profiling."""
+        if self.__components[0].profile is None:
+            return None
+        return [cmd.profile for cmd in self.__components]
+
+    def __emit_profile(self):
+        if self.__profile_timeout_id == 0:
+            return False
+        dispatcher.send('profile', self, self.get_profile())
+        return True
+
+    def __execute_internal(self, force_sync, opt_formats=[], assert_all_threaded=False, profile=False):
         _logger.debug("Executing %s", self)
+        self.__fuse_stages()
+        _logger.debug("Execution plan: %s", self.format_plan())
+        if profile:
+            # Signals 'profile' with get_profile() while executing
+            self.__enable_profile()
+            if not force_sync:
+                self.__profile_timeout_id = call_timeout(_profile_interval, self.__emit_profile)
         self.__set_state('executing')
         meta_idx = 0          
         for i,cmd in enumerate(self.__components):
@@ -563,6 +918,10 @@ class Pipeline(object):
         self.__state = state
         if self.is_complete():
             self.__completion_time = time.time()         
+            if self.__profile_timeout_id > 0:
+                remove_idle(self.__profile_timeout_id)
+                self.__profile_timeout_id = 0
+                dispatcher.send('profile', self, self.get_profile())
         dispatcher.send('state-changed', self)
 
     def execute(self, **kwargs):
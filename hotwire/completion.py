@@ -25,7 +25,7 @@ import posixpath
 import hotwire
 from hotwire.builtin import BuiltinRegistry
 from hotwire.cmdalias import Alias, AliasRegistry
-from hotwire.async import MiniThreadPool
+from hotwire.async import MiniThreadPool, PRIORITY_INTERACTIVE
 from hotwire.fs import FilePath,iterd,iterd_sorted,path_normalize,path_expanduser,unix_basename
 from hotwire.sysdep.fs import Filesystem
 from hotwire.externals.singletonmixin import Singleton
@@ -95,20 +95,16 @@ class PathCompleter(Completer):
             isdir = False
         fs = Filesystem.getInstance()
         if isdir and fullpath.endswith('/'):
-            for fpath in iterd_sorted(fullpath, fpath=True):
-                yield _mkfile_completion(text, fpath)
+            for fobj in fs.stat_files(fs.list_dir(fullpath)):
+                yield _mkfile_completion(text, fobj.path, fobj)
             return
         (src_dpath, src_prefix) = os.path.split(fullpath)
         try:
-            for fpath in iterd_sorted(src_dpath, fpath=True):
-                fname = unix_basename(fpath)
-                if fname.startswith(src_prefix):
-                    try:
-                        yield _mkfile_completion(text, fpath)
-                    except OSError, e:
-                        pass
+            fobjs = [fobj for fobj in fs.list_dir(src_dpath) if fobj.basename.startswith(src_prefix)]
         except OSError, e:
-            pass
+            return
+        for fobj in fs.stat_files(fobjs):
+            yield _mkfile_completion(text, fobj.path, fobj)
 
 class BuiltinCompleter(Completer):
     def __init__(self):
@@ -145,16 +141,8 @@ class VerbCompleter(Completer):
                     yield completion
         else:
             fs = Filesystem.getInstance()           
-            for dpath in fs.get_path_generator():
-                if not os.access(dpath, os.X_OK):
-                    continue
-                for fpath in iterd_sorted(dpath):
-                    fname = unix_basename(fpath)
-                    if not fname.startswith(text_prefix):
-                        continue
-                    fobj = fs.get_file_sync(fpath)
-                    if fobj.is_executable:
-                        yield _mkfile_completion(text, fpath, fobj)
+            for fobj in fs.get_path_executables(text_prefix):
+                yield _mkfile_completion(text, fobj.path, fobj)
 
 class TokenCompleter(Completer):
     def __init__(self):
@@ -197,7 +185,12 @@ class CompletionSystem(object):
         return self.__get_completions(*args)
 
     def async_complete(self, *args):
-        return MiniThreadPool.getInstance().run(self.__do_async_complete, args=args)
+        return MiniThreadPool.getInstance().run(self.__do_async_complete, args=args,
+                                              priority=PRIORITY_INTERACTIVE)
+
+    def cancel(self, serial):
+        """Drop an asynchronous completion request if it has not started."""
+        return MiniThreadPool.getInstance().cancel(serial)
     
     def __get_completions(self, completer, text, cwd):
         return CompletionResults(list(completer.completions(text, cwd)))
@@ -0,0 +1,240 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os, sys, logging, mmap, datetime, array
+try:
+    import sqlite3
+except:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from hotwire.sysdep.fs import Filesystem
+
+_logger = logging.getLogger("hotwire.ContentIndex")
+
+# Larger files are recorded but not indexed; fsearch always scans them.
+_max_indexed_size = 1024*1024
+# Like grep, a NUL byte in the first block means the file is binary.
+_binary_check_size = 8192
+# Number of trigrams from a literal used to look it up.
+_max_query_trigrams = 8
+# Number of files (re)indexed into each segment of posting lists.
+_segment_files = 1000
+
+def _get_index_path():
+    dirname = Filesystem.getInstance().make_conf_subdir('index')
+    return os.path.join(dirname, 'trigram.sqlite')
+
+def _path_range(path):
+    """Return (low, high) bounds on the paths of files inside directory path."""
+    path = path.rstrip('/')
+    return (path + '/', path + '0')
+
+def _trigram_key(tri):
+    return (ord(tri[0]) << 16) | (ord(tri[1]) << 8) | ord(tri[2])
+
+def get_trigrams(buf):
+    """Return the set of trigram keys of the byte string buf, folded to lower case."""
+    buf = buf.lower()
+    return set(map(_trigram_key, set(buf[i:i+3] for i in xrange(len(buf)-2))))
+
+def _read_trigrams(path):
+    """Return the trigram keys of the file at path; binary files have none.
+    Returns None if the file couldn't be read."""
+    try:
+        f = open(path, 'rb')
+    except EnvironmentError, e:
+        return None
+    try:
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return set()
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                if buf[:_binary_check_size].find('\0') >= 0:
+                    return set()
+                return get_trigrams(buf[:])
+            finally:
+                buf.close()
+        except EnvironmentError, e:
+            return None
+    finally:
+        f.close()
+
+class _SegmentWriter(object):
+    """Accumulates the posting lists (trigram => file ids) for a batch of
+    files, and writes them out as one segment."""
+    def __init__(self, cursor, segment):
+        super(_SegmentWriter, self).__init__()
+        self.__cursor = cursor
+        self.segment = segment
+        self.__postings = {}
+        self.count = 0
+
+    def add(self, fid, trigrams):
+        postings = self.__postings
+        for tri in trigrams:
+            try:
+                postings[tri].append(fid)
+            except KeyError, e:
+                postings[tri] = array.array('i', (fid,))
+        self.count += 1
+
+    def flush(self):
+        self.__cursor.executemany('''INSERT INTO Postings VALUES (?, ?, ?)''',
+                                  ((self.segment, tri, sqlite3.Binary(fids.tostring()))
+                                   for (tri, fids) in self.__postings.iteritems()))
+        self.__postings = {}
+        self.count = 0
+        self.segment += 1
+
+class ContentIndex(object):
+    """A persistent trigram index of the contents of files below a set of root directories.
+fsearch uses it to skip files which can't contain a literal required by the search
+expression.  Entries whose modification time or size no longer match the file are
+treated as unknown, so a stale index only costs speed, not results.
+
+Posting lists are written in segments as files are indexed, and are never updated;
+when a file is reindexed its old file id just stops being valid.  Rebuilding a
+directory compacts its segments."""
+    def __init__(self, path=None):
+        super(ContentIndex, self).__init__()
+        self.__path = path or _get_index_path()
+        _logger.debug("opening connection to content index: %s", self.__path)
+        # The index may be consumed from a generator running in another thread, but
+        # is only ever used by one thread at a time.
+        self.__conn = sqlite3.connect(self.__path, isolation_level=None, check_same_thread=False)
+        cursor = self.__conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Roots (path TEXT UNIQUE, modtime DATETIME)''')
+        # segment is NULL for files which aren't indexed (too large, unreadable)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Files (fid INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE, mtime INTEGER, size INTEGER, segment INTEGER)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Postings (segment INTEGER, tri INTEGER, fids BLOB)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS PostingsIndex on Postings (tri)''')
+
+    def close(self):
+        self.__conn.close()
+        self.__conn = None
+
+    def get_root(self, path):
+        """Return the indexed root directory containing path, or None."""
+        cursor = self.__conn.cursor()
+        for (root,) in cursor.execute('''SELECT path FROM Roots'''):
+            if path == root or path.startswith(_path_range(root)[0]):
+                return root
+        return None
+
+    def add_root(self, path):
+        cursor = self.__conn.cursor()
+        cursor.execute('''INSERT OR REPLACE INTO Roots VALUES (?, ?)''', (path, datetime.datetime.now()))
+
+    def __remove_orphan_segments(self, cursor):
+        cursor.execute('''DELETE FROM Postings WHERE segment NOT IN (SELECT DISTINCT segment FROM Files WHERE segment IS NOT NULL)''')
+
+    def clear(self, path):
+        """Remove all entries for files inside path."""
+        cursor = self.__conn.cursor()
+        cursor.execute('''BEGIN TRANSACTION''')
+        cursor.execute('''DELETE FROM Files WHERE path >= ? AND path < ?''', _path_range(path))
+        self.__remove_orphan_segments(cursor)
+        cursor.execute('''COMMIT''')
+
+    def remove_root(self, path):
+        self.clear(path)
+        cursor = self.__conn.cursor()
+        cursor.execute('''DELETE FROM Roots WHERE path = ?''', (path,))
+
+    def __add_file(self, cursor, writer, fobj):
+        trigrams = None
+        if (not fobj.is_link) and fobj.size is not None and fobj.size <= _max_indexed_size:
+            trigrams = _read_trigrams(fobj.path)
+        vals = (fobj.path, fobj.mtime, fobj.size, trigrams is not None and writer.segment or None)
+        cursor.execute('''INSERT INTO Files VALUES (NULL, ?, ?, ?, ?)''', vals)
+        if trigrams is not None:
+            writer.add(cursor.lastrowid, trigrams)
+        return trigrams
+
+    def __query_fids(self, cursor, query):
+        result = None
+        for tri in query:
+            fids = array.array('i')
+            for (buf,) in cursor.execute('''SELECT fids FROM Postings WHERE tri = ?''', (tri,)):
+                fids.fromstring(str(buf))
+            if result is None:
+                result = set(fids)
+            else:
+                result.intersection_update(fids)
+            if not result:
+                break
+        return result
+
+    def filter(self, path, walker, literal=None, update=False):
+        """Generate the paths of the File objects from walker (a TreeWalker for path)
+which may contain the byte string literal, compared case-insensitively.  Files which
+are unknown to the index or have changed since they were indexed are always generated.
+If update is True they are (re)indexed as they are seen, and once the walk completes,
+entries for files which no longer exist are removed."""
+        cursor = self.__conn.cursor()
+        known = {}
+        for (fid, fpath, mtime, size, segment) in cursor.execute('''SELECT fid, path, mtime, size, segment FROM Files WHERE path >= ? AND path < ?''', _path_range(path)):
+            known[fpath] = (fid, mtime, size, segment)
+        query = None
+        fids = None
+        if literal is not None and len(literal) >= 3:
+            keys = sorted(get_trigrams(literal))
+            step = max(1, len(keys) // _max_query_trigrams)
+            query = set(keys[::step][:_max_query_trigrams])
+            fids = self.__query_fids(cursor, query)
+        _logger.debug("filtering %s with %d known files, query %r", path, len(known), query)
+        writer = None
+        if update:
+            cursor.execute('''BEGIN TRANSACTION''')
+            (segment,) = cursor.execute('''SELECT MAX(segment) FROM Postings''').fetchone()
+            writer = _SegmentWriter(cursor, (segment or 0) + 1)
+        complete = False
+        try:
+            for fobj in walker:
+                entry = known.pop(fobj.path, None)
+                if entry is not None and entry[1:3] == (fobj.mtime, fobj.size):
+                    if fids is None or entry[3] is None or entry[0] in fids:
+                        yield fobj.path
+                    continue
+                if not update:
+                    yield fobj.path
+                    continue
+                if entry is not None:
+                    cursor.execute('''DELETE FROM Files WHERE fid = ?''', (entry[0],))
+                trigrams = self.__add_file(cursor, writer, fobj)
+                if writer.count >= _segment_files:
+                    writer.flush()
+                    cursor.execute('''COMMIT''')
+                    cursor.execute('''BEGIN TRANSACTION''')
+                if query is None or trigrams is None or query.issubset(trigrams):
+                    yield fobj.path
+            complete = not walker.cancelled
+        finally:
+            if update:
+                if writer.count:
+                    writer.flush()
+                if complete:
+                    for (fid, mtime, size, segment) in known.itervalues():
+                        cursor.execute('''DELETE FROM Files WHERE fid = ?''', (fid,))
+                self.__remove_orphan_segments(cursor)
+                cursor.execute('''COMMIT''')
@@ -0,0 +1,141 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os,sys,math,time,datetime,heapq
+
+# A visit is worth half as much after each half-life.  Rather than decaying
+# stored scores as time passes, each visit is weighted by how long after a
+# fixed epoch it happened; scores then decay together, so their order never
+# changes and can be indexed.  Scores are base 2 logarithms so they don't
+# overflow.
+_halflife = 7 * 24 * 60 * 60 # seconds
+_epoch = 1167609600 # 2007-01-01
+
+def _log2_add(a, b):
+    """Return log2(2**a + 2**b)."""
+    if a < b:
+        (a, b) = (b, a)
+    return a + math.log(1 + 2 ** (b - a), 2)
+
+def _timestamp(when):
+    if isinstance(when, basestring):
+        # As stored by sqlite3 for datetime
+        when = datetime.datetime.strptime(when[:19], '%Y-%m-%d %H:%M:%S')
+    if isinstance(when, datetime.datetime):
+        when = time.mktime(when.timetuple())
+    return when
+
+def frecency_visit(score, when, count=1):
+    """Return score after count visits at when (a datetime, or seconds since
+the Unix epoch).  score is None for a first visit."""
+    visit = (_timestamp(when) - _epoch) / float(_halflife) + math.log(count, 2)
+    if score is None:
+        return visit
+    return _log2_add(score, visit)
+
+def frecency_now(score, now=None):
+    """Return score as a number of visits made now."""
+    if now is None:
+        now = time.time()
+    return 2 ** (score - (now - _epoch) / float(_halflife))
+
+class FuzzyPathMatcher(object):
+    """Matches paths against a query of whitespace-separated terms.  The terms
+must appear in order, each as a subsequence of the path.  Contiguous terms,
+terms starting a path component, and a last term in the final component score
+higher."""
+    # Upper bound of the bonus returned by match, in the units of frecency
+    max_bonus = 4.5
+
+    def __init__(self, query):
+        super(FuzzyPathMatcher, self).__init__()
+        self.__terms = query.lower().split()
+        if not self.__terms:
+            self.max_bonus = 0
+
+    def get_like_pattern(self):
+        """Return a LIKE pattern (with \\ as escape) matching a superset of the
+paths which match, or None if all paths do."""
+        chars = ''.join(self.__terms)
+        if not chars:
+            return None
+        escape = lambda c: c in '\\%_' and ('\\' + c) or c
+        return '%' + '%'.join(map(escape, chars)) + '%'
+
+    def match(self, path):
+        """Return (bonus, positions of matched characters), or None if path
+does not match."""
+        if not self.__terms:
+            return (0, [])
+        lowpath = path.lower()
+        pos = 0
+        positions = []
+        bonus = 0
+        for term in self.__terms:
+            idx = lowpath.find(term, pos)
+            if idx >= 0:
+                bonus += 1
+                if idx == 0 or lowpath[idx-1] == '/':
+                    bonus += 0.5
+                positions.extend(xrange(idx, idx + len(term)))
+                pos = idx + len(term)
+                continue
+            for c in term:
+                idx = lowpath.find(c, pos)
+                if idx < 0:
+                    return None
+                positions.append(idx)
+                pos = idx + 1
+        bonus /= float(len(self.__terms))
+        basename_start = lowpath.rstrip('/').rfind('/') + 1
+        if positions[-1] >= basename_start:
+            bonus += 2
+            if lowpath[basename_start:].rstrip('/') == self.__terms[-1]:
+                bonus += 1
+        return (bonus, positions)
+
+def top_matches(rows, matcher, limit, accept=None):
+    """Return the best limit of rows matching matcher, as a list of
+(score, path, positions) with the best first.  rows is a sequence of (path,
+frecency), ordered by decreasing frecency; it is only read until no later row
+could be among the best.  If given, accept(path) must also be true."""
+    best = []
+    for (path, frecency) in rows:
+        if len(best) == limit and frecency + matcher.max_bonus <= best[0][0]:
+            break
+        result = matcher.match(path)
+        if result is None:
+            continue
+        (bonus, positions) = result
+        score = frecency + bonus
+        if len(best) == limit and score <= best[0][0]:
+            continue
+        if accept is not None and not accept(path):
+            continue
+        item = (score, path, positions)
+        if len(best) == limit:
+            heapq.heapreplace(best, item)
+        else:
+            heapq.heappush(best, item)
+    best.sort(reverse=True)
+    return best
+
+__all__ = ['frecency_visit', 'frecency_now', 'FuzzyPathMatcher', 'top_matches']
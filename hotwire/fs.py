@@ -26,6 +26,11 @@ import hotwire
 from hotwire.async import MiniThreadPool
 from hotwire.externals.glob2 import iglob
 from hotwire.sysdep import is_windows, is_unix
+try:
+    import scandir
+    have_scandir = True
+except ImportError, e:
+    have_scandir = False
 
 def dirglob(dir, pat):
     for result in iglob(pat, dir):
@@ -153,6 +158,23 @@ def iterd_sorted(dpath, **kwargs):
     for v in sorted(iterd(dpath, **kwargs), locale.strcoll):
         yield v
 
+def iterd_typed(dpath):
+    """Generate (full path, is_directory) pairs for entries in directory dpath.
+    When the scandir module is available, the directory entry type is used
+    and symbolic links are not followed; otherwise is_directory is None, and
+    the caller must stat the entry to find out."""
+    dpath = unicode(dpath)
+    if have_scandir:
+        for entry in scandir.scandir(dpath):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError, e:
+                is_dir = None
+            yield (path_join(dpath, entry.name), is_dir)
+    else:
+        for fname in os.listdir(dpath):
+            yield (path_join(dpath, fname), None)
+
 def atomic_rename(oldp, newp):
     # FIXME - not really atomic on Windows =/
     if is_windows():
@@ -0,0 +1,158 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os,sys,re,logging,datetime
+
+_logger = logging.getLogger("hotwire.HistImport")
+
+class HistoryImporter(object):
+    """Reads the history file of another shell as (command, exectime) pairs,
+where exectime is None if the shell did not record it."""
+    name = None
+
+    def __init__(self, path):
+        super(HistoryImporter, self).__init__()
+        self.__path = path
+        self.__position = 0
+
+    path = property(lambda self: self.__path)
+    position = property(lambda self: self.__position, doc="""Bytes read so far.""")
+
+    def exists(self):
+        return os.path.isfile(self.__path)
+
+    def get_size(self):
+        return os.path.getsize(self.__path)
+
+    def get_mtime(self):
+        return datetime.datetime.fromtimestamp(int(os.path.getmtime(self.__path)))
+
+    def _iter_lines(self):
+        self.__position = 0
+        f = open(self.__path)
+        try:
+            for line in f:
+                self.__position += len(line)
+                yield line.rstrip('\n')
+        finally:
+            f.close()
+
+    def _parse(self, lines):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        for (cmd, when) in self._parse(self._iter_lines()):
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            if when is not None:
+                when = datetime.datetime.fromtimestamp(when)
+            yield (cmd.decode('utf-8', 'replace'), when)
+
+class BashHistoryImporter(HistoryImporter):
+    """Reads bash history, with the #<time> comments written when
+HISTTIMEFORMAT is set."""
+    name = 'bash'
+
+    def __init__(self, path=None):
+        super(BashHistoryImporter, self).__init__(path or os.path.expanduser('~/.bash_history'))
+
+    def _parse(self, lines):
+        when = None
+        for line in lines:
+            if line.startswith('#') and line[1:].isdigit():
+                when = int(line[1:])
+                continue
+            yield (line, when)
+            when = None
+
+# : <start>:<elapsed>;<command>
+_zsh_extended_re = re.compile(r'^: *(\d+):\d+;(.*)$', re.DOTALL)
+# zsh escapes bytes it uses internally with this, and xors the next byte with 32
+_zsh_meta = '\x83'
+
+def _zsh_unmetafy(line):
+    if _zsh_meta not in line:
+        return line
+    parts = line.split(_zsh_meta)
+    return parts[0] + ''.join([part and (chr(ord(part[0]) ^ 32) + part[1:]) for part in parts[1:]])
+
+class ZshHistoryImporter(HistoryImporter):
+    """Reads zsh history, in either the plain or EXTENDED_HISTORY format."""
+    name = 'zsh'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.expanduser('~/.zsh_history')
+            if not os.path.isfile(path):
+                path = os.path.expanduser('~/.histfile')
+        super(ZshHistoryImporter, self).__init__(path)
+
+    def _parse(self, lines):
+        pending = []
+        for line in lines:
+            line = _zsh_unmetafy(line)
+            # Newlines in a command are saved as a backslash at the end of the line
+            if line.endswith('\\'):
+                pending.append(line[:-1])
+                continue
+            pending.append(line)
+            entry = '\n'.join(pending)
+            pending = []
+            match = _zsh_extended_re.match(entry)
+            if match:
+                yield (match.group(2), int(match.group(1)))
+            else:
+                yield (entry, None)
+
+def _fish_unescape(text):
+    return re.sub(r'\\(.)', lambda m: m.group(1) == 'n' and '\n' or m.group(1), text)
+
+class FishHistoryImporter(HistoryImporter):
+    """Reads fish history, which is a subset of YAML."""
+    name = 'fish'
+
+    def __init__(self, path=None):
+        if path is None:
+            datadir = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+            path = os.path.join(datadir, 'fish', 'fish_history')
+        super(FishHistoryImporter, self).__init__(path)
+
+    def _parse(self, lines):
+        cmd = None
+        when = None
+        for line in lines:
+            if line.startswith('- cmd: '):
+                if cmd is not None:
+                    yield (cmd, when)
+                cmd = _fish_unescape(line[7:])
+                when = None
+            elif line.startswith('  when: ') and line[8:].strip().isdigit():
+                when = int(line[8:])
+        if cmd is not None:
+            yield (cmd, when)
+
+def get_importers():
+    """Return importers for the history files of other shells which exist."""
+    return filter(lambda importer: importer.exists(),
+                  [BashHistoryImporter(), ZshHistoryImporter(), FishHistoryImporter()])
+
+__all__ = ['HistoryImporter', 'BashHistoryImporter', 'ZshHistoryImporter', 'FishHistoryImporter', 'get_importers']
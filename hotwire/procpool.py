@@ -0,0 +1,188 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os, collections, threading, logging, Queue, cPickle
+
+from hotwire.async import iter_batches
+
+try:
+    import multiprocessing, multiprocessing.pool
+    have_multiprocessing = True
+except ImportError, e:
+    have_multiprocessing = False
+
+_logger = logging.getLogger("hotwire.ProcPool")
+
+# Maximum number of input objects sent to a worker process at once
+_chunk_size = 512
+# Chunks submitted but not yet collected, per worker process
+_chunks_per_process = 4
+# While chunks are running and there is no input, how often to check for
+# input again
+_result_wait = 0.05 # seconds
+
+def _close_inherited_fds(keep_fds):
+    # Runs in each new worker process.  Forked from a command's thread, a
+    # worker inherits every file descriptor open at the time, such as our
+    # end of a subprocess's stdin pipe; holding it, the worker would keep the
+    # subprocess from ever seeing EOF.
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError, e:
+        try:
+            fds = xrange(os.sysconf('SC_OPEN_MAX'))
+        except (ValueError, OSError), e:
+            fds = xrange(256)
+    for fd in fds:
+        if fd > 2 and fd not in keep_fds:
+            try:
+                os.close(fd)
+            except OSError, e:
+                pass
+
+if have_multiprocessing:
+    class _WorkerPool(multiprocessing.pool.Pool):
+        """A multiprocessing Pool whose workers keep only the pipes they read
+tasks from and write results to."""
+        def __init__(self, processes):
+            self.__keep_fds = []
+            multiprocessing.pool.Pool.__init__(self, processes, _close_inherited_fds, (self.__keep_fds,))
+
+        def _setup_queues(self):
+            multiprocessing.pool.Pool._setup_queues(self)
+            self.__keep_fds.extend([self._inqueue._reader.fileno(), self._outqueue._writer.fileno()])
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+def _get_pool():
+    global _pool, _pool_size
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            try:
+                _pool_size = multiprocessing.cpu_count()
+            except NotImplementedError, e:
+                _pool_size = 2
+            _logger.debug("creating pool of %d processes", _pool_size)
+            _pool = _WorkerPool(_pool_size)
+        return (_pool, _pool_size)
+    finally:
+        _pool_lock.release()
+
+def _run_chunk(func, data, payload):
+    return func(data, cPickle.loads(payload))
+
+def _iter_chunk_results(func, data, input, ordered, chunksize, key):
+    """Generate (chunk, func(data, values)) for chunks of objects from input,
+where values holds key(obj) for each object in the chunk, or the objects if
+key is None."""
+    if have_multiprocessing:
+        (pool, nprocs) = _get_pool()
+        max_pending = nprocs * _chunks_per_process
+    else:
+        pool = None
+        max_pending = 1
+    # (chunk, AsyncResult) pairs
+    pending = collections.deque()
+    get_many = getattr(input, 'get_many', None)
+    if get_many is None:
+        batches = iter_batches(input, chunksize)
+    ended = False
+    while pending or not ended:
+        # Hand over finished chunks before waiting for anything
+        while pending:
+            item = _pop_ready(pending, ordered)
+            if item is None:
+                break
+            (chunk, result) = item
+            yield (chunk, result.get())
+        if ended or len(pending) >= max_pending:
+            if pending:
+                pending[0][1].wait(_result_wait)
+            continue
+        if get_many is None:
+            chunk = next(batches, None)
+            ended = chunk is None
+        else:
+            # Only block on input when no chunk could finish meanwhile
+            try:
+                chunk = get_many(chunksize, not pending)
+            except Queue.Empty, e:
+                pending[0][1].wait(_result_wait)
+                continue
+            if None in chunk:
+                chunk = chunk[:chunk.index(None)]
+                ended = True
+        if not chunk:
+            continue
+        if key is not None:
+            values = map(key, chunk)
+        else:
+            values = chunk
+        if pool is not None:
+            # Pickle here rather than in the pool's thread, so failures
+            # can be handled
+            try:
+                payload = cPickle.dumps(values, cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError, TypeError), e:
+                _logger.debug("can't pickle input, continuing in this thread", exc_info=True)
+                pool = None
+        if pool is None:
+            while pending:
+                (pending_chunk, result) = pending.popleft()
+                yield (pending_chunk, result.get())
+            yield (chunk, func(data, values))
+        else:
+            pending.append((chunk, pool.apply_async(_run_chunk, (func, data, payload))))
+
+def parallel_map(func, data, input, ordered=True, chunksize=_chunk_size, key=None):
+    """Generate the objects in the lists returned by func(data, values), for
+chunks of objects from input, computed in a pool of worker processes.  values
+holds key(obj) for each object in the chunk, computed in this thread, or the
+objects themselves if key is None.
+
+func must be a module-level function, and data and the output objects must be
+picklable.  Unless ordered is true, the results for each chunk are generated
+as soon as they are ready.  Without multiprocessing, or once values can't be
+pickled, chunks are processed in this thread."""
+    for (chunk, results) in _iter_chunk_results(func, data, input, ordered, chunksize, key):
+        for obj in results:
+            yield obj
+
+def parallel_filter(func, data, input, key, ordered=True, chunksize=_chunk_size):
+    """Like parallel_map, but generate the objects from input at the indices
+in values returned by func(data, values).  Only the values are sent to the
+worker processes, not the objects."""
+    for (chunk, indices) in _iter_chunk_results(func, data, input, ordered, chunksize, key):
+        for i in indices:
+            yield chunk[i]
+
+def _pop_ready(pending, ordered):
+    if ordered:
+        if pending[0][1].ready():
+            return pending.popleft()
+        return None
+    for (i, item) in enumerate(pending):
+        if item[1].ready():
+            del pending[i]
+            return item
+    return None
@@ -0,0 +1,177 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math, heapq, itertools
+
+_MASK64 = (1 << 64) - 1
+
+def _hash64(value):
+    """Return a well-mixed 64 bit hash of a hashable value."""
+    h = hash(value) & _MASK64
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & _MASK64
+    return h ^ (h >> 33)
+
+class BloomFilter(object):
+    """A set of fixed capacity which may claim to contain values it does not,
+at the given rate, but never the reverse."""
+    def __init__(self, capacity, error_rate):
+        super(BloomFilter, self).__init__()
+        self.capacity = capacity
+        nbits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.__nbits = max(nbits, 8)
+        self.__probes = range(max(1, int(round(float(self.__nbits) / capacity * math.log(2)))))
+        self.__bits = bytearray((self.__nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, h):
+        h1 = int(h & 0xffffffff)
+        h2 = int(h >> 32) | 1
+        nbits = self.__nbits
+        return [(h1 + i * h2) % nbits for i in self.__probes]
+
+    def _contains_hash(self, h):
+        bits = self.__bits
+        for pos in self._positions(h):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _add_hash(self, h):
+        bits = self.__bits
+        present = True
+        for pos in self._positions(h):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                present = False
+                bits[pos >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, value):
+        return self._contains_hash(_hash64(value))
+
+    def add(self, value):
+        """Add a value, returning whether it was (probably) present."""
+        return self._add_hash(_hash64(value))
+
+class ScalableBloomFilter(object):
+    """A Bloom filter which grows as values are added, adding filters with
+tighter error rates so that the overall rate stays within the one given."""
+    def __init__(self, error_rate, initial_capacity=65536, growth=4, tightening=0.5):
+        super(ScalableBloomFilter, self).__init__()
+        self.__error_rate = error_rate
+        self.__capacity = initial_capacity
+        self.__growth = growth
+        self.__tightening = tightening
+        self.__filters = []
+
+    def __contains__(self, value):
+        h = _hash64(value)
+        for f in self.__filters:
+            if f._contains_hash(h):
+                return True
+        return False
+
+    def add(self, value):
+        """Add a value, returning whether it was (probably) present."""
+        h = _hash64(value)
+        filters = self.__filters
+        # Older filters are full; only the newest takes values
+        for f in filters[:-1]:
+            if f._contains_hash(h):
+                return True
+        if not filters or filters[-1].count >= filters[-1].capacity:
+            if filters and filters[-1]._contains_hash(h):
+                return True
+            rate = self.__error_rate * (1 - self.__tightening) * (self.__tightening ** len(filters))
+            capacity = self.__capacity * (self.__growth ** len(filters))
+            filters.append(BloomFilter(capacity, rate))
+        return filters[-1]._add_hash(h)
+
+class HyperLogLog(object):
+    """Estimates the number of distinct values added, with a relative standard
+error near the one given, in a few kilobytes."""
+    def __init__(self, error_rate):
+        super(HyperLogLog, self).__init__()
+        p = int(math.ceil(math.log((1.04 / error_rate) ** 2, 2)))
+        self.__p = p = min(max(p, 4), 18)
+        self.__m = m = 1 << p
+        self.__registers = bytearray(m)
+        self.__alpha = 0.7213 / (1 + 1.079 / m)
+
+    def add(self, value):
+        h = _hash64(value)
+        p = self.__p
+        idx = h >> (64 - p)
+        rank = (64 - p) - (h & ((1 << (64 - p)) - 1)).bit_length() + 1
+        if rank > self.__registers[idx]:
+            self.__registers[idx] = rank
+
+    def __len__(self):
+        m = self.__m
+        registers = self.__registers
+        estimate = self.__alpha * m * m / sum([2.0 ** -r for r in registers])
+        zeros = registers.count('\0')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+class SpaceSaving(object):
+    """Tracks the most frequent values of a stream using a fixed number of
+counters.  Counts are upper bounds, overestimating by at most the error
+recorded for each value."""
+    def __init__(self, capacity):
+        super(SpaceSaving, self).__init__()
+        self.__capacity = capacity
+        # value -> [count, error]
+        self.__counters = {}
+        # (count, serial, value), one per counter; counts may be stale
+        self.__heap = []
+        self.__serial = itertools.count()
+
+    def add(self, value):
+        counter = self.__counters.get(value)
+        if counter is not None:
+            counter[0] += 1
+            return
+        heap = self.__heap
+        if len(self.__counters) < self.__capacity:
+            self.__counters[value] = [1, 0]
+            heapq.heappush(heap, (1, self.__serial.next(), value))
+            return
+        # Replace the least frequent value, refreshing stale entries first
+        while True:
+            (count, serial, minvalue) = heap[0]
+            current = self.__counters[minvalue][0]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, serial, minvalue))
+        del self.__counters[minvalue]
+        self.__counters[value] = [count + 1, count]
+        heapq.heapreplace(heap, (count + 1, self.__serial.next(), value))
+
+    def top(self):
+        """Return a list of (count, error, value), most frequent first."""
+        result = [(count, error, value) for (value, (count, error)) in self.__counters.iteritems()]
+        result.sort(key=lambda x: x[0], reverse=True)
+        return result
@@ -0,0 +1,165 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import heapq, tempfile, cPickle, logging
+
+_logger = logging.getLogger("hotwire.Spill")
+
+# Items pickled together; the pickle memo is reset after each batch
+_batch_size = 1000
+
+def spill_run(items):
+    """Write a list of items to a temporary file, returning it ready for
+iter_run_file; or None if the items can't be pickled."""
+    f = tempfile.TemporaryFile(prefix='hotwire-spill')
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    try:
+        for i in xrange(0, len(items), _batch_size):
+            pickler.dump(items[i:i+_batch_size])
+            pickler.clear_memo()
+    except (cPickle.PicklingError, TypeError), e:
+        _logger.debug("failed to spill run", exc_info=True)
+        f.close()
+        return None
+    f.seek(0)
+    return f
+
+def iter_run_file(f):
+    """Yield the items in a file written by spill_run, closing it after."""
+    unpickler = cPickle.Unpickler(f)
+    try:
+        while True:
+            try:
+                batch = unpickler.load()
+            except EOFError, e:
+                break
+            for item in batch:
+                yield item
+    finally:
+        f.close()
+
+class _ReversedKey(object):
+    __slots__ = ['key']
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+def merge_runs(runs, reverse=False):
+    """Merge iterables of (key, object) pairs, each sorted by key, yielding
+the objects.  Ties go to the earlier run, so the merge is stable."""
+    wrap = reverse and _ReversedKey or (lambda k: k)
+    heap = []
+    for i,run in enumerate(runs):
+        it = iter(run)
+        for (key, obj) in it:
+            heap.append((wrap(key), i, obj, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        (key, i, obj, it) = heap[0]
+        yield obj
+        for (key, obj) in it:
+            heapq.heapreplace(heap, (wrap(key), i, obj, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+class PartitionSpill(object):
+    """Distributes items over temporary files by the hash of a key, so that
+each partition can later be processed in memory on its own."""
+    def __init__(self, count):
+        super(PartitionSpill, self).__init__()
+        self.__files = []
+        self.__picklers = []
+        for i in xrange(count):
+            f = tempfile.TemporaryFile(prefix='hotwire-spill')
+            self.__files.append(f)
+            self.__picklers.append(cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL))
+        self.__pending = [[] for i in xrange(count)]
+
+    def add(self, key, item):
+        """Add an item; raises cPickle.PicklingError or TypeError if it, or
+another item written with it, can't be written.  The items are kept, and can
+still be read back with recover."""
+        idx = hash(key) % len(self.__pending)
+        pending = self.__pending[idx]
+        pending.append(item)
+        if len(pending) >= _batch_size:
+            self.__flush(idx)
+
+    def __flush(self, idx):
+        f = self.__files[idx]
+        pickler = self.__picklers[idx]
+        pos = f.tell()
+        try:
+            pickler.dump(self.__pending[idx])
+        except:
+            # Drop whatever part of the batch was written
+            f.seek(pos)
+            f.truncate()
+            raise
+        pickler.clear_memo()
+        self.__pending[idx] = []
+
+    def flush(self):
+        """Write the items not written yet; raises like add if they can't be."""
+        for idx in xrange(len(self.__pending)):
+            if self.__pending[idx]:
+                self.__flush(idx)
+
+    def iter_partitions(self):
+        """Yield an iterator over the items of each partition in turn."""
+        self.flush()
+        files = self.__files
+        self.__files = []
+        self.__picklers = []
+        for f in files:
+            f.seek(0)
+            yield iter_run_file(f)
+
+    def recover(self):
+        """Yield all the items added, without writing any more; for when an
+item can't be written.  The spill is closed after."""
+        files = self.__files
+        pending = self.__pending
+        self.__files = []
+        self.__picklers = []
+        self.__pending = []
+        for (f, items) in zip(files, pending):
+            f.seek(0)
+            for item in iter_run_file(f):
+                yield item
+            for item in items:
+                yield item
+
+    def close(self):
+        for f in self.__files:
+            f.close()
+        self.__files = []
+        self.__picklers = []
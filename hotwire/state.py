@@ -19,7 +19,7 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,logging,time,datetime,threading
+import os,sys,logging,time,datetime,threading,Queue,atexit,itertools
 try:
     import sqlite3
 except:
@@ -30,6 +30,8 @@ import gobject
 from hotwire.externals.singletonmixin import Singleton
 from hotwire.sysdep.fs import Filesystem
 from hotwire.logutil import log_except
+from hotwire.externals.dispatch import dispatcher
+from hotwire.frecency import frecency_visit, frecency_now, FuzzyPathMatcher, top_matches
 #import processing
 
 _logger = logging.getLogger("hotwire.State")
@@ -38,6 +40,123 @@ def _get_state_path(name):
     dirname = Filesystem.getInstance().make_conf_subdir('state')
     return os.path.join(dirname, name)
 
+def _probe_fts():
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('''CREATE VIRTUAL TABLE Probe USING fts5(text, tokenize='trigram')''')
+        return True
+    except sqlite3.Error, e:
+        return False
+    finally:
+        conn.close()
+# Whether sqlite has FTS5 with the trigram tokenizer (3.34 and newer), which
+# indexes substrings; otherwise history searches scan with LIKE.
+have_fts = _probe_fts()
+
+# Full-text indexes of history tables: (table, key column, text column)
+_text_indexes = {'CommandsText': ('Commands', 'bid', 'cmd'),
+                 'CmdInputText': ('CmdInput', 'dbid', 'line')}
+# Recorded in Meta once the search indexes are built
+_search_index_version = have_fts and 'fts5-trigram-1' or 'basic-1'
+# Trigram indexes can't find shorter terms
+_min_text_index_term = 3
+# Past this many matches, the most recent are found sooner by scanning in
+# time order, which stops at the limit
+_max_text_index_matches = 2000
+
+# How long a state writer waits for more writes before committing a batch
+_writer_batch_delay = 0.1 # seconds
+_writer_max_batch = 1000
+# Give pending writes this long to commit at exit
+_writer_exit_timeout = 5 # seconds
+
+# Imported history is inserted this many entries at a time
+_import_chunk_size = 1000
+
+def _setup_history_connection(conn):
+    conn.create_function('frecency_visit', 2, frecency_visit)
+    conn.create_function('frecency_visit', 3, frecency_visit)
+
+class StateWriter(object):
+    """Owns the connection used to write a state database.  Writes are
+queued from any thread and applied by a single thread, which commits them in
+batches.  The database is in WAL mode, so readers never wait on it."""
+    def __init__(self, path, setup=None):
+        super(StateWriter, self).__init__()
+        self.__path = path
+        self.__setup = setup
+        self.__queue = Queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, name='StateWriter %s' % (os.path.basename(path),))
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def submit(self, func, *args):
+        """Queue func(cursor, *args) to run in the writer's transaction.
+func must not begin or end transactions itself."""
+        self.__queue.put((func, args))
+
+    def after_commit(self, func, *args):
+        """Call func(*args) in the writer thread once every write submitted
+so far has been committed."""
+        self.__queue.put((None, lambda: func(*args)))
+
+    def flush(self, timeout=None):
+        """Wait until every write submitted so far has been committed."""
+        event = threading.Event()
+        self.after_commit(event.set)
+        event.wait(timeout)
+
+    def __get_batch(self):
+        batch = [self.__queue.get()]
+        deadline = time.time() + _writer_batch_delay
+        while len(batch) < _writer_max_batch and batch[-1][0] is not None:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.__queue.get(timeout=remaining))
+                else:
+                    batch.append(self.__queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    @log_except(_logger)
+    def __run(self):
+        conn = sqlite3.connect(self.__path, isolation_level=None)
+        if self.__setup:
+            self.__setup(conn)
+        conn.execute('''PRAGMA journal_mode=WAL''')
+        # In WAL mode this is still safe against corruption; only the last
+        # commits can be lost on power failure
+        conn.execute('''PRAGMA synchronous=NORMAL''')
+        cursor = conn.cursor()
+        while True:
+            batch = self.__get_batch()
+            cursor.execute('''BEGIN TRANSACTION''')
+            committed = []
+            for (func, args) in batch:
+                if func is None:
+                    committed.append(args)
+                    continue
+                try:
+                    func(cursor, *args)
+                except:
+                    _logger.exception("failed write to %s: %r", self.__path, func)
+            try:
+                cursor.execute('''COMMIT''')
+            except sqlite3.Error, e:
+                _logger.exception("failed to commit %d writes to %s", len(batch), self.__path)
+                try:
+                    cursor.execute('''ROLLBACK''')
+                except sqlite3.Error, e:
+                    pass
+            _logger.debug("committed %d writes to %s", len(batch) - len(committed), self.__path)
+            for func in committed:
+                try:
+                    func()
+                except:
+                    _logger.exception("failed to handle commit to %s", self.__path)
+
 class CommandHistoryEntry(object):
     __slots__ = ['command', 'exectime']
     def __init__(self, cmd, exectime):
@@ -52,7 +171,13 @@ class History(Singleton):
         have_history = os.path.exists(path)
         _logger.debug("opening connection to history db: %s", path)
         self.__conn = sqlite3.connect(path, isolation_level=None)
+        _setup_history_connection(self.__conn)
+        # Connections can't be shared between threads; others get their own
+        self.__readers = threading.local()
+        self.__readers.conn = self.__conn
         cursor = self.__conn.cursor()
+        # Lets this connection read while the writer commits
+        cursor.execute('''PRAGMA journal_mode=WAL''')
         # Commands is the primary text input history table
         cursor.execute('''CREATE TABLE IF NOT EXISTS Commands (bid INTEGER PRIMARY KEY AUTOINCREMENT, cmd TEXT, exectime DATETIME, dirpath TEXT)''')     
         # Is there a way to do ALTER TABLE IF NOT DONE?
@@ -70,6 +195,16 @@ class History(Singleton):
         
         # Records frequently used directories
         cursor.execute('''CREATE TABLE IF NOT EXISTS Directories (dbid INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE, count INTEGER, modtime DATETIME)''')
+        try:
+            # Count with decay over time; see hotwire.frecency
+            cursor.execute('''ALTER TABLE Directories ADD frecency REAL''')
+        except sqlite3.OperationalError, e:
+            if 'duplicate column' not in str(e):
+                raise
+        # Older visits weren't recorded, so count them all as the last.  This
+        # also catches rows written by a version without frecency.
+        cursor.execute('''UPDATE Directories SET frecency = frecency_visit(NULL, modtime, count) WHERE frecency IS NULL''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS DirectoriesFrecencyIndex on Directories (frecency)''')
         
         # Nothing in CmdInput yet...need to fix this.
         cursor.execute('''CREATE TABLE IF NOT EXISTS CmdInput (dbid INTEGER PRIMARY KEY AUTOINCREMENT, cmd TEXT, line TEXT, modtime DATETIME)''')
@@ -77,64 +212,138 @@ class History(Singleton):
         
         # Currently just used to note which persist tables have been converted        
         cursor.execute('''CREATE TABLE IF NOT EXISTS Meta (keyName TEXT UNIQUE, keyValue)''')
-        
-        if not have_history and os.path.exists(os.path.expanduser("~/.bash_history")):
-            self.__run_async(self.__import_bash_history)
 
-    def __import_bash_history(self, conn):
-        try:
-            f = open(os.path.expanduser("~/.bash_history"))
-            now = datetime.datetime.now()
-            cursor = conn.cursor()
+        # Until the search indexes are built, searches use LIKE
+        result = cursor.execute('''SELECT keyValue FROM Meta WHERE keyName = ?''', ('search_index',)).fetchone()
+        self.__search_indexed = result is not None and result[0] == _search_index_version
+        if not self.__search_indexed and not have_history:
             cursor.execute('''BEGIN TRANSACTION''')
-            for line in f:
-                line = line.rstrip() # strip the newline
-                vals = (line, now, "/", "62270c40-a94a-44dd-aaa0-689f882acf34")
-                _logger.debug("doing insert of %s", vals)
-                cursor.execute('''INSERT INTO Commands VALUES (NULL, ?, ?, ?, ?)''', vals)
+            self.__create_search_indexes(cursor)
             cursor.execute('''COMMIT''')
-        finally:
-            f.close()
+            self.__search_indexed = True
+
+        # All further writes go through here
+        self.__writer = StateWriter(path, setup=_setup_history_connection)
+        atexit.register(self.__writer.flush, _writer_exit_timeout)
+        if not self.__search_indexed:
+            # Indexing a long history takes a while; don't block startup
+            self.__writer.submit(self.__create_search_indexes)
+            self.__writer.after_commit(self.__search_indexes_created)
+        
+        if not have_history:
+            self.import_shell_history()
+
+    def __create_search_indexes(self, cursor):
+        _logger.debug("creating history search indexes: %s", _search_index_version)
+        # Let the most recent entries be found without sorting
+        cursor.execute('''CREATE INDEX IF NOT EXISTS CommandsTimeIndex on Commands (exectime)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS CmdInputTimeIndex on CmdInput (cmd, modtime)''')
+        for (indexname, (tablename, keycol, textcol)) in _text_indexes.iteritems():
+            names = {'index': indexname, 'table': tablename, 'key': keycol, 'text': textcol}
+            if not have_fts:
+                # The triggers would make every insert fail without the module
+                for suffix in ('Insert', 'Delete', 'Update'):
+                    cursor.execute('''DROP TRIGGER IF EXISTS %s%s''' % (indexname, suffix))
+                continue
+            # Stores only the index; the text stays in the table
+            cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS %(index)s USING fts5(%(text)s, content='%(table)s', content_rowid='%(key)s', tokenize='trigram')''' % names)
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS %(index)sInsert AFTER INSERT ON %(table)s BEGIN
+  INSERT INTO %(index)s (rowid, %(text)s) VALUES (new.%(key)s, new.%(text)s);
+END''' % names)
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS %(index)sDelete AFTER DELETE ON %(table)s BEGIN
+  INSERT INTO %(index)s (%(index)s, rowid, %(text)s) VALUES ('delete', old.%(key)s, old.%(text)s);
+END''' % names)
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS %(index)sUpdate AFTER UPDATE OF %(text)s ON %(table)s BEGIN
+  INSERT INTO %(index)s (%(index)s, rowid, %(text)s) VALUES ('delete', old.%(key)s, old.%(text)s);
+  INSERT INTO %(index)s (rowid, %(text)s) VALUES (new.%(key)s, new.%(text)s);
+END''' % names)
+            # Index existing rows
+            cursor.execute('''INSERT INTO %(index)s (%(index)s) VALUES ('rebuild')''' % names)
+        cursor.execute('''INSERT OR REPLACE INTO Meta VALUES ('search_index', ?)''', (_search_index_version,))
+
+    def __search_indexes_created(self):
+        self.__search_indexed = True
+        _logger.debug("history search indexes created")
+
+    def import_shell_history(self, importers=None):
+        """Import the history of other shells in the background.  While it
+runs, the 'import-progress' signal is sent with the name of the shell and the
+fraction done; 'import-complete' is sent with the number of commands added."""
+        from hotwire.histimport import get_importers
+        if importers is None:
+            importers = get_importers()
+        if importers:
+            self.__writer.submit(self.__import_shell_history, importers)
+
+    def __import_shell_history(self, cursor, importers):
+        # Entries are staged so duplicates can be dropped in one pass,
+        # without holding the history in memory
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS ImportedCommands (seq INTEGER PRIMARY KEY, cmd TEXT, exectime DATETIME)''')
+        cursor.execute('''DELETE FROM ImportedCommands''')
+        sizes = [importer.get_size() for importer in importers]
+        total = float(sum(sizes)) or 1.0
+        done = 0
+        for (importer, size) in zip(importers, sizes):
+            # Entries without a time are ordered by the file
+            mtime = importer.get_mtime()
+            entries = ((cmd, when or mtime) for (cmd, when) in importer)
+            while True:
+                chunk = list(itertools.islice(entries, _import_chunk_size))
+                if not chunk:
+                    break
+                cursor.executemany('''INSERT INTO ImportedCommands (cmd, exectime) VALUES (?, ?)''', chunk)
+                dispatcher.send('import-progress', self, importer.name, (done + importer.position) / total)
+            _logger.info("read %s history from %s", importer.name, importer.path)
+            done += size
+        cursor.execute('''INSERT INTO Commands (cmd, exectime, dirpath, lang_uuid)
+  SELECT cmd, exectime, '/', ? FROM ImportedCommands AS i
+  WHERE NOT EXISTS (SELECT 1 FROM Commands AS c WHERE c.cmd = i.cmd AND c.exectime = i.exectime)
+  GROUP BY cmd, exectime ORDER BY exectime, MAX(seq)''', ('62270c40-a94a-44dd-aaa0-689f882acf34',))
+        count = cursor.rowcount
+        cursor.execute('''DROP TABLE ImportedCommands''')
+        _logger.info("imported %d commands", count)
+        self.__writer.after_commit(lambda: dispatcher.send('import-complete', self, count))
 
     def set_no_save(self):
         self.__no_save = True
 
-    @log_except(_logger)
-    def __do_run_async(self, func, args, kwargs):
-        _logger.debug("in async run of %r", func)
-        conn = sqlite3.connect(self.__path, isolation_level=None)
-        try:
-            func(conn, *args, **kwargs)
-        finally:
-            conn.close()
+    def flush(self, timeout=None):
+        """Wait until all recorded history has been written."""
+        self.__writer.flush(timeout)
 
-    def __run_async(self, func, *args, **kwargs):
-        from hotwire.async import MiniThreadPool
-        tp = MiniThreadPool.getInstance()
-        tp.run(self.__do_run_async, args=(func, args, kwargs))
+    def __get_conn(self):
+        conn = getattr(self.__readers, 'conn', None)
+        if conn is None:
+            _logger.debug("opening reader connection to history db in %s", threading.currentThread().getName())
+            conn = self.__readers.conn = sqlite3.connect(self.__path, isolation_level=None)
+            _setup_history_connection(conn)
+        return conn
         
-    def __do_append_command(self, conn, lang_uuid, cmd, cwd):
-        cursor = conn.cursor()
-        cursor.execute('''BEGIN TRANSACTION''')
-        vals = (cmd, datetime.datetime.now(), cwd, lang_uuid)
+    def __do_append_command(self, cursor, lang_uuid, cmd, cwd, exectime):
+        vals = (cmd, exectime, cwd, lang_uuid)
         _logger.debug("doing insert of %s", vals)
         cursor.execute('''INSERT INTO Commands VALUES (NULL, ?, ?, ?, ?)''', vals)
-        cursor.execute('''COMMIT''')
-        self.__append_countitem('Directories', 'path', cwd, conn=conn)
+        self.__record_dir_visit(cursor, cwd, exectime)
 
     def append_command(self, lang_uuid, cmd, cwd):
         if self.__no_save:
             return
-        # Run this in a timeout, because for some reason we seem to stutter while executing it;
-        # This might be because sqlite is holding the Python lock so we can't do any processing.
-        gobject.timeout_add(250, lambda: self.__run_async(self.__do_append_command, lang_uuid, cmd, cwd))
+        self.__writer.submit(self.__do_append_command, lang_uuid, cmd, cwd, datetime.datetime.now())
         
-    def __search_limit_query(self, tablename, column, orderval, searchterm, limit, countmin=0, filters=[], distinct=False):
+    def __search_limit_query(self, tablename, column, orderval, searchterm, limit, countmin=0, filters=[], distinct=False,
+                             textindex=None):
         queryclauses = []
         args = []        
-        if searchterm:
-            queryclauses.append(column + " LIKE ? ESCAPE '%'")
-            args.append('%' + searchterm.replace('%', '%%') + '%')            
+        keys = None
+        if searchterm and textindex and have_fts and self.__search_indexed \
+                and len(searchterm) >= _min_text_index_term:
+            keys = self.__search_text_index(textindex, searchterm)
+        if keys is not None:
+            keycol = _text_indexes[textindex][1]
+            queryclauses.append('%s IN (%s)' % (keycol, ','.join(map(str, keys))))
+        elif searchterm:
+            queryclauses.append(column + " LIKE ? ESCAPE '\\'")
+            args.append('%' + searchterm.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
         if countmin > 0:
             queryclauses.append("count > %d " % (countmin,))
         queryclauses.extend(map(lambda x: x[0], filters))
@@ -149,37 +358,56 @@ class History(Singleton):
         _logger.debug("generated search query: %s", sql)
         return sql
         
+    def __search_text_index(self, textindex, searchterm):
+        """Return the keys of rows containing searchterm, or None if there are
+too many to be worth using."""
+        cursor = self.__get_conn().cursor()
+        # A phrase matches as a substring with the trigram tokenizer
+        phrase = '"' + searchterm.replace('"', '""') + '"'
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH ? LIMIT %d' % (textindex, textindex, _max_text_index_matches + 1)
+        keys = [row[0] for row in cursor.execute(sql, (phrase,))]
+        if len(keys) > _max_text_index_matches:
+            return None
+        return keys
+
     def search_commands(self,  lang_uuid, searchterm, limit=50, **kwargs):
-        cursor = self.__conn.cursor()
+        cursor = self.__get_conn().cursor()
         if lang_uuid is not None:
             kwargs['filters'] = [(' lang_uuid = ? ', lang_uuid)]
         (sql, args) = self.__search_limit_query('Commands', 'cmd', 'exectime', searchterm, limit,
-                                                **kwargs)
+                                                textindex='CommandsText', **kwargs)
         _logger.debug("execute using args %s: %s", args, sql)
         for v in cursor.execute(sql, args):
             yield v[1]
         
-    def __append_countitem(self, tablename, colname, value, conn=None):
-        src_conn = conn or self.__conn
-        cursor = src_conn.cursor()
-        cursor.execute('''BEGIN TRANSACTION''')
-        cursor.execute('''SELECT * FROM %s WHERE %s = ?''' % (tablename, colname), (value,))
-        result = cursor.fetchone()
-        if not result:
-            current_count = 0
-        else:
-            current_count = result[2]
-        _logger.debug("incrementing count %s", current_count)
-        vals = (value, current_count+1, datetime.datetime.now())
-        _logger.debug("doing insert of %s", vals)
-        cursor.execute('''INSERT OR REPLACE INTO %s VALUES (NULL, ?, ?, ?)''' % (tablename,), vals)
-        cursor.execute('''COMMIT''')
+    def __record_dir_visit(self, cursor, path, when):
+        # An upsert; only the writer thread changes counts, so nothing can
+        # insert the row between the two statements.  (ON CONFLICT DO UPDATE
+        # needs sqlite 3.24.)
+        _logger.debug("recording visit to %s", path)
+        cursor.execute('''UPDATE Directories SET count = count + 1, modtime = ?, frecency = frecency_visit(frecency, ?) WHERE path = ?''',
+                       (when, when, path))
+        if cursor.rowcount == 0:
+            cursor.execute('''INSERT INTO Directories VALUES (NULL, ?, 1, ?, frecency_visit(NULL, ?))''', (path, when, when))
         
-    def search_dir_usage(self, searchterm, limit=20):
-        cursor = self.__conn.cursor()
-        (sql, args) = self.__search_limit_query('Directories', 'path', 'count', searchterm, limit, countmin=4)
-        for v in cursor.execute(sql, args):
-            yield v[1:]
+    def search_dir_usage(self, searchterm, limit=20, accept=None):
+        """Return up to limit directories fuzzily matching searchterm, the
+most frequently and recently used first, as a list of (path, score, positions)
+where positions are the indexes of the characters that matched.  If given,
+accept(path) must be true of the results."""
+        cursor = self.__get_conn().cursor()
+        matcher = FuzzyPathMatcher(searchterm or '')
+        pattern = matcher.get_like_pattern()
+        sql = '''SELECT path, frecency FROM Directories'''
+        args = []
+        if pattern:
+            sql += ''' WHERE path LIKE ? ESCAPE '\\' '''
+            args.append(pattern)
+        # Read in index order, only as far as needed
+        sql += ''' ORDER BY frecency DESC'''
+        now = time.time()
+        return [(path, frecency_now(score, now), positions) 
+                for (score, path, positions) in top_matches(cursor.execute(sql, args), matcher, limit, accept=accept)]
         
     def append_usage(self, colkey, *args, **kwargs):
         getattr(self, 'append_%s_usage' % (colkey,))(*args, **kwargs)
@@ -188,20 +416,20 @@ class History(Singleton):
         return getattr(self, 'search_%s_usage' % (colkey,))(*args, **kwargs)
 
     def search_command_input(self, cmd, searchterm, limit=20):
-        cursor = self.__conn.cursor()
+        cursor = self.__get_conn().cursor()
         (sql, args) = self.__search_limit_query('CmdInput', 'line', 'modtime', searchterm, limit,
-                                                filters=[('cmd = ?', cmd)])         
+                                                filters=[('cmd = ?', cmd)], textindex='CmdInputText')
         _logger.debug("execute using args %s: %s", args, sql)
         for v in cursor.execute(sql, args):
             yield v[2]
         
-    def record_command_input(self, cmd, input):
-        cursor = self.__conn.cursor()
-        cursor.execute('''BEGIN TRANSACTION''')
-        vals = (cmd, input, datetime.datetime.now())
+    def __do_record_command_input(self, cursor, cmd, input, modtime):
+        vals = (cmd, input, modtime)
         _logger.debug("doing insert of %s", vals)
         cursor.execute('''INSERT INTO CmdInput VALUES (NULL, ?, ?, ?)''', vals)
-        cursor.execute('''COMMIT''')
+        
+    def record_command_input(self, cmd, input):
+        self.__writer.submit(self.__do_record_command_input, cmd, input, datetime.datetime.now())
     
 _prefinstance = None
 class Preferences(gobject.GObject):
@@ -209,27 +437,65 @@ class Preferences(gobject.GObject):
         super(Preferences, self).__init__()
         path = _get_state_path('prefs.sqlite')
         _logger.debug("opening connection to prefs db: %s", path)
-        self.__conn = sqlite3.connect(path, isolation_level=None)
+        conn = sqlite3.connect(path, isolation_level=None)
         self.__monitors = []
         
-        cursor = self.__conn.cursor()
+        cursor = conn.cursor()
         cursor.execute('''CREATE TABLE IF NOT EXISTS Prefs (dbid INTEGER PRIMARY KEY AUTOINCREMENT, keyName TEXT UNIQUE, keyValue, modtime DATETIME)''')
+        # Reads are served from here; the table is only written after startup
+        self.__prefs = dict(cursor.execute('''SELECT keyName, keyValue FROM Prefs'''))
+        conn.close()
+        # Values set but not yet written, by key; only the latest is kept
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+        self.__writer = StateWriter(path)
+        atexit.register(self.__writer.flush, _writer_exit_timeout)
+        self.__convert_conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.__convert_lock = threading.Lock()
  
     def get_pref(self, key, default=None):
-        cursor = self.__conn.cursor()        
-        result = cursor.execute('''SELECT keyValue from Prefs where keyName = ?''', (key,)).fetchone()
-        if result is None:
-            return default
-        return result[0]
+        return self.__prefs.get(key, default)
+
+    def __convert(self, value):
+        # Keep the value as sqlite will return it after a restart, e.g. bools
+        # as integers and str as unicode; this also raises here for values
+        # which can't be stored at all.
+        self.__convert_lock.acquire()
+        try:
+            return self.__convert_conn.execute('''SELECT ?''', (value,)).fetchone()[0]
+        finally:
+            self.__convert_lock.release()
  
     def set_pref(self, key, value):
         (root, other) = key.split('.', 1)
-        cursor = self.__conn.cursor()
-        cursor.execute('''BEGIN TRANSACTION''')
-        cursor.execute('''INSERT OR REPLACE INTO Prefs VALUES (NULL, ?, ?, ?)''', [key, value, datetime.datetime.now()])
-        cursor.execute('''COMMIT''')
+        stored = self.__convert(value)
+        self.__prefs[key] = stored
+        self.__pending_lock.acquire()
+        try:
+            # A write is already queued if anything is pending
+            need_write = not self.__pending
+            self.__pending[key] = (stored, datetime.datetime.now())
+        finally:
+            self.__pending_lock.release()
+        if need_write:
+            self.__writer.submit(self.__write_pending)
         self.__notify(key, value)
         
+    def __write_pending(self, cursor):
+        self.__pending_lock.acquire()
+        try:
+            pending = self.__pending
+            self.__pending = {}
+        finally:
+            self.__pending_lock.release()
+        _logger.debug("writing %d preferences", len(pending))
+        cursor.executemany('''INSERT OR REPLACE INTO Prefs VALUES (NULL, ?, ?, ?)''', 
+                           [(key, value, modtime) for (key, (value, modtime)) in pending.iteritems()])
+
+    def flush(self, timeout=None):
+        """Wait until all preferences set have been written."""
+        self.__writer.flush(timeout)
+        
     def __notify(self, key, value):
         _logger.debug("doing notify for key %s new value: %s", key, value)
         for prefix, handler, args in self.__monitors:
@@ -295,4 +561,4 @@ class ViewState(gobject.GObject):
             _viewstateinstance = ViewState()
         return _viewstateinstance
 
-__all__ = ['History','Preferences', 'ViewState']      
+__all__ = ['History', 'StateWriter', 'Preferences', 'ViewState']      
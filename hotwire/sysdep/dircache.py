@@ -0,0 +1,406 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os,sys,stat,time,struct,threading,logging,select,errno
+
+from hotwire.fs import iterd_sorted
+from hotwire.gutil import call_idle, call_timeout, remove_idle
+from hotwire.logutil import log_except
+from hotwire.sysdep import is_linux
+
+_logger = logging.getLogger("hotwire.sysdep.DirCache")
+
+try:
+    if not is_linux():
+        raise ImportError()
+    import ctypes, ctypes.util, fcntl
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+    _libc.inotify_rm_watch
+    have_inotify = True
+except:
+    have_inotify = False
+
+# From <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+                  | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF)
+# Events which only affect the metadata of the named entry
+_IN_ENTRY_CHANGED = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE
+_event_header = struct.Struct('iIII')
+
+_max_cached_dirs = 64
+# Without inotify, the directory mtime tells us whether the listing changed,
+# but not whether the entries themselves did; stat data is trusted this long.
+_poll_stat_lifetime = 2.0
+_poll_monitor_interval = 2000
+_monitor_delay = 300
+
+class Inotify(object):
+    """Dispatches Linux inotify events from a single descriptor.  Callbacks
+are invoked as cb(mask, name) in a private thread, and so must be brief and
+thread-safe."""
+    def __init__(self):
+        super(Inotify, self).__init__()
+        self.__fd = _libc.inotify_init()
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        fcntl.fcntl(self.__fd, fcntl.F_SETFL, fcntl.fcntl(self.__fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.__lock = threading.Lock()
+        # Held while reading and dispatching, so sync() can't return while
+        # the reader thread holds undispatched events
+        self.__read_lock = threading.Lock()
+        self.__watches = {}
+        t = threading.Thread(target=self.__read_events)
+        t.setDaemon(True)
+        t.start()
+
+    def add_watch(self, path, cb):
+        """Watch path, returning a watch descriptor, or None on failure."""
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        self.__lock.acquire()
+        try:
+            wd = _libc.inotify_add_watch(self.__fd, path, _IN_WATCH_MASK)
+            if wd < 0:
+                _logger.debug("Failed to watch '%s': errno %d", path, ctypes.get_errno())
+                return None
+            self.__watches.setdefault(wd, []).append(cb)
+            return wd
+        finally:
+            self.__lock.release()
+
+    def remove_watch(self, wd, cb):
+        self.__lock.acquire()
+        try:
+            cbs = self.__watches.get(wd)
+            if not cbs or cb not in cbs:
+                return
+            cbs.remove(cb)
+            if not cbs:
+                del self.__watches[wd]
+                _libc.inotify_rm_watch(self.__fd, wd)
+        finally:
+            self.__lock.release()
+
+    def sync(self):
+        """Dispatch any events already queued by the kernel, so that changes
+        made before this call have been seen when it returns."""
+        self.__read_lock.acquire()
+        try:
+            while self.__read_available():
+                pass
+        finally:
+            self.__read_lock.release()
+
+    @log_except(_logger)
+    def __read_events(self):
+        while True:
+            try:
+                select.select([self.__fd], [], [])
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.__read_lock.acquire()
+            try:
+                self.__read_available()
+            finally:
+                self.__read_lock.release()
+
+    def __read_available(self):
+        # Called with the read lock held; returns whether events were read
+        try:
+            buf = os.read(self.__fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return True
+            if e.errno == errno.EAGAIN:
+                return False
+            raise
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, cookie, namelen) = _event_header.unpack_from(buf, offset)
+            offset += _event_header.size
+            name = unicode(buf[offset:offset+namelen].rstrip('\0'), sys.getfilesystemencoding() or 'utf-8', 'replace')
+            offset += namelen
+            self.__dispatch(wd, mask, name)
+        return True
+
+    def __dispatch(self, wd, mask, name):
+        self.__lock.acquire()
+        if mask & _IN_Q_OVERFLOW:
+            # Events were lost; tell everyone
+            cbs = []
+            for wcbs in self.__watches.itervalues():
+                cbs.extend(wcbs)
+        else:
+            cbs = list(self.__watches.get(wd, ()))
+            if mask & _IN_IGNORED:
+                # The kernel removed the watch (e.g. the directory was deleted)
+                self.__watches.pop(wd, None)
+        self.__lock.release()
+        for cb in cbs:
+            try:
+                cb(mask, name)
+            except:
+                _logger.exception("Failed to dispatch inotify event")
+
+_inotify = None
+_inotify_lock = threading.Lock()
+def get_inotify():
+    """Return the shared Inotify instance, or None if inotify is unavailable."""
+    global _inotify
+    _inotify_lock.acquire()
+    try:
+        if _inotify is None and have_inotify:
+            try:
+                _inotify = Inotify()
+            except OSError, e:
+                _logger.debug("inotify unavailable", exc_info=True)
+                _inotify = False
+        return _inotify or None
+    finally:
+        _inotify_lock.release()
+
+class _CachedDir(object):
+    __slots__ = ['path', 'files', 'mtime', 'stamp', 'used', 'wd', 'stale', 'changed']
+    def __init__(self, path):
+        self.path = path
+        self.files = None
+        self.mtime = None
+        self.stamp = None
+        self.used = 0
+        self.wd = None
+        self.stale = False
+        self.changed = set()
+
+    def on_event(self, mask, name):
+        if (mask & _IN_ENTRY_CHANGED) and name:
+            self.changed.add(name)
+        else:
+            self.stale = True
+
+class DirectoryCache(object):
+    """Caches the File objects for recently listed directories, bounded to the
+most recently used few.  Entries are invalidated by inotify where available,
+and otherwise revalidated against the directory modification time."""
+    def __init__(self, fs, maxdirs=_max_cached_dirs):
+        super(DirectoryCache, self).__init__()
+        self.__fs = fs
+        self.__maxdirs = maxdirs
+        self.__lock = threading.Lock()
+        self.__dirs = {}
+        self.__ticks = 0
+
+    def get_files(self, dpath):
+        """Return a list of File objects for the entries of dpath, sorted by
+        name.  Metadata for each is retrieved (and then cached) on first
+        access.  Raises OSError if the directory can't be listed."""
+        inotify = get_inotify()
+        if inotify is not None:
+            inotify.sync()
+        self.__lock.acquire()
+        try:
+            ent = self.__dirs.get(dpath)
+            if ent is not None:
+                self.__ticks += 1
+                ent.used = self.__ticks
+                if ent.wd is not None and not ent.stale:
+                    self.__apply_changes(ent)
+                    self.__forget_subdirs(ent)
+                    return list(ent.files)
+        finally:
+            self.__lock.release()
+        mtime = os.stat(dpath).st_mtime
+        now = time.time()
+        if ent is not None and ent.wd is None and ent.mtime == mtime \
+           and now - mtime >= 1.0:
+            # The listing hasn't changed; refresh entries if they're old.
+            # Directories modified in the last second are always relisted,
+            # as the mtime might not have enough resolution to show a
+            # subsequent change.
+            if now - ent.stamp < _poll_stat_lifetime:
+                return list(ent.files)
+            files = [self.__fs.get_file_lazy(f.path) for f in ent.files]
+        else:
+            files = None
+        newent = _CachedDir(dpath)
+        if inotify is not None:
+            # Watch before listing, so we don't miss concurrent changes
+            newent.wd = inotify.add_watch(dpath, newent.on_event)
+        if files is None:
+            try:
+                files = [self.__fs.get_file_lazy(x) for x in iterd_sorted(dpath)]
+            except:
+                if newent.wd is not None:
+                    inotify.remove_watch(newent.wd, newent.on_event)
+                raise
+        newent.files = files
+        newent.mtime = mtime
+        newent.stamp = now
+        self.__store(newent)
+        return list(files)
+
+    def invalidate(self, dpath):
+        self.__lock.acquire()
+        try:
+            ent = self.__dirs.pop(dpath, None)
+        finally:
+            self.__lock.release()
+        if ent is not None:
+            self.__unwatch(ent)
+
+    def __apply_changes(self, ent):
+        # Called with the lock held
+        if not ent.changed:
+            return
+        # Pop rather than swap the set, since events arrive concurrently
+        changed = set()
+        while ent.changed:
+            changed.add(ent.changed.pop())
+        fs = self.__fs
+        ent.files = [(f.basename in changed) and fs.get_file_lazy(f.path) or f for f in ent.files]
+
+    def __forget_subdirs(self, ent):
+        # Called with the lock held.  A change inside a subdirectory alters
+        # its mtime and size without an event on this directory, so the
+        # metadata of subdirectories isn't kept.
+        fs = self.__fs
+        ent.files = [(f._stat is not None and stat.S_ISDIR(f._stat.st_mode)) and fs.get_file_lazy(f.path) or f 
+                     for f in ent.files]
+
+    def __store(self, newent):
+        evicted = []
+        self.__lock.acquire()
+        try:
+            old = self.__dirs.get(newent.path)
+            if old is not None:
+                evicted.append(old)
+            self.__ticks += 1
+            newent.used = self.__ticks
+            self.__dirs[newent.path] = newent
+            while len(self.__dirs) > self.__maxdirs:
+                lru = min(self.__dirs.itervalues(), key=lambda ent: ent.used)
+                del self.__dirs[lru.path]
+                evicted.append(lru)
+        finally:
+            self.__lock.release()
+        for ent in evicted:
+            self.__unwatch(ent)
+
+    def __unwatch(self, ent):
+        if ent.wd is not None:
+            get_inotify().remove_watch(ent.wd, ent.on_event)
+            ent.wd = None
+
+    def get_monitor(self, path, cb):
+        """Return a monitor object which calls cb (in the mainloop) after path
+        changes.  It has a single method cancel()."""
+        inotify = get_inotify()
+        if inotify is not None:
+            try:
+                return InotifyMonitor(inotify, path, cb)
+            except OSError, e:
+                _logger.debug("Failed to watch '%s', polling", path, exc_info=True)
+        return PollMonitor(path, cb)
+
+class InotifyMonitor(object):
+    """Watches a file or directory via inotify.  Files are watched through
+their parent directory, so replacement by rename is noticed."""
+    def __init__(self, inotify, path, cb):
+        super(InotifyMonitor, self).__init__()
+        self.__inotify = inotify
+        self.__cb = cb
+        self.__idle_id = 0
+        self.__timeout_id = 0
+        if os.path.isdir(path):
+            self.__name = None
+            wpath = path
+        else:
+            (wpath, self.__name) = os.path.split(path)
+            if not isinstance(self.__name, unicode):
+                self.__name = unicode(self.__name, sys.getfilesystemencoding() or 'utf-8', 'replace')
+        self.__wd = inotify.add_watch(wpath, self.__on_event)
+        if self.__wd is None:
+            raise OSError("Failed to watch '%s'" % (wpath,))
+
+    def __on_event(self, mask, name):
+        if self.__name is not None and name != self.__name:
+            return
+        if self.__idle_id == 0:
+            self.__idle_id = call_idle(self.__idle_queue_emit)
+
+    def __idle_queue_emit(self):
+        self.__idle_id = 0
+        if self.__wd is not None and self.__timeout_id == 0:
+            self.__timeout_id = call_timeout(_monitor_delay, self.__emit)
+
+    def __emit(self):
+        self.__timeout_id = 0
+        self.__cb()
+
+    def cancel(self):
+        if self.__timeout_id:
+            remove_idle(self.__timeout_id)
+            self.__timeout_id = 0
+        if self.__wd is not None:
+            self.__inotify.remove_watch(self.__wd, self.__on_event)
+            self.__wd = None
+
+class PollMonitor(object):
+    """Watches a file or directory by periodically checking its stat data."""
+    def __init__(self, path, cb):
+        super(PollMonitor, self).__init__()
+        self.__path = path
+        self.__cb = cb
+        self.__sig = self.__get_signature()
+        self.__poll_id = call_timeout(_poll_monitor_interval, self.__poll)
+
+    def __get_signature(self):
+        try:
+            st = os.stat(self.__path)
+        except OSError, e:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def __poll(self):
+        sig = self.__get_signature()
+        if sig != self.__sig:
+            self.__sig = sig
+            self.__cb()
+        return True
+
+    def cancel(self):
+        if self.__poll_id:
+            remove_idle(self.__poll_id)
+            self.__poll_id = 0
@@ -19,39 +19,54 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,shutil,stat,logging,tempfile,urllib
+import os,sys,shutil,stat,logging,tempfile,urllib,threading,Queue,locale
 from cStringIO import StringIO
+from collections import deque
 
 import hotwire
-from hotwire.fs import unix_basename, FilePath, path_expanduser, path_fromurl, path_tourl, atomic_rename, iterd_sorted
-from hotwire.async import MiniThreadPool
+from hotwire.fs import unix_basename, FilePath, path_expanduser, path_fromurl, path_tourl, atomic_rename, iterd_sorted, iterd_typed
+from hotwire.async import MiniThreadPool, PRIORITY_BACKGROUND
 from hotwire.logutil import log_except
 from hotwire.gutil import call_idle
 from hotwire.sysdep import is_windows, is_unix
+from hotwire.sysdep.dircache import DirectoryCache
+from hotwire.sysdep.pathindex import PathExecutableIndex
 from hotwire.externals.singletonmixin import Singleton
 import hotwire.sysdep.fs_impl
 from hotwire.externals.dispatch import dispatcher
 
 _logger = logging.getLogger("hotwire.sysdep.Filesystem")
 
+_stat_batch_size = 256
+_stat_max_threads = 4
+
 class BaseFilesystem(object):
     def __init__(self):
         self.fileklass = File
         self._override_conf_dir = None
         self._trashdir = os.path.expanduser('~/.Trash')
         self.makedirs_p(self._trashdir)
+        self.__dircache = DirectoryCache(self)
+        self.__path_index = PathExecutableIndex(self)
 
     def ls_dir(self, dir, show_all):
-        for x in iterd_sorted(dir):
-            fobj = self.get_file_sync(x)
-            if show_all or (not fobj.hidden):  
-                yield fobj
+        fobjs = self.list_dir(dir)
+        if not show_all:
+            fobjs = [fobj for fobj in fobjs if not fobj.hidden]
+        for fobj in self.stat_files(fobjs):
+            yield fobj
 
     def get_basename_is_ignored(self, bn):
         return False
     
+    def list_dir(self, dpath):
+        """Return a list of File objects for all entries of directory dpath,
+        sorted by name.  Listings and retrieved metadata are cached while the
+        directory is unchanged."""
+        return self.__dircache.get_files(dpath)
+
     def get_monitor(self, path, cb):
-        raise NotImplementedError()
+        return self.__dircache.get_monitor(path, cb)
     
     def get_bookmarks(self):
         return BaseBookmarks.getInstance()
@@ -65,6 +80,47 @@ class BaseFilesystem(object):
         f = self.fileklass(path, fs=self)
         f.get_stat_sync()
         return f
+
+    def get_file_lazy(self, path):
+        """Return a File for path without retrieving any metadata; it will
+        be retrieved when first accessed."""
+        return self.fileklass(path, fs=self)
+
+    def stat_files(self, files, threaded=True):
+        """Retrieve stat data for each of the given File objects, returning
+        a list of those which succeeded, in the original order.  Large batches
+        are split across a few threads."""
+        files = list(files)
+        nthreads = threaded and min(_stat_max_threads, len(files) // _stat_batch_size) or 0
+        if nthreads <= 1:
+            return [fobj for fobj in files if self.__stat_file(fobj)]
+        results = [None] * len(files)
+        threads = []
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self.__stat_files_slice, args=(files, results, i, nthreads))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return [fobj for (fobj, ok) in zip(files, results) if ok]
+
+    def __stat_files_slice(self, files, results, start, step):
+        for i in xrange(start, len(files), step):
+            results[i] = self.__stat_file(files[i])
+
+    def __stat_file(self, fobj):
+        try:
+            fobj.get_stat_sync()
+        except FileStatError, e:
+            return False
+        # May have been stat'ed (unsuccessfully) earlier
+        return not fobj.stat_error
+
+    def walk(self, path, show_all=False, threads=None):
+        """Return a TreeWalker generating File objects for all non-directory
+        entries beneath path."""
+        return TreeWalker(self, path, show_all=show_all, threads=threads)
         
     def launch_open_file(self, path, cwd=None):
         raise NotImplementedError()
@@ -107,7 +163,15 @@ class BaseFilesystem(object):
     def get_path_generator(self):
         raise NotImplementedError()
 
+    def get_path_executables(self, prefix=u''):
+        """Return a list of File objects for the executables in $PATH whose
+        names start with prefix."""
+        return self.__path_index.get_executables(prefix)
+
     def executable_on_path(self, execname):
+        if unix_basename(execname) == execname:
+            fobj = self.__path_index.lookup(execname)
+            return fobj and fobj.path or False
         for dpath in self.get_path_generator():
             epath = FilePath(execname, dpath)
             try:
@@ -162,16 +226,26 @@ class FileStatError(Exception):
         Exception.__init__(self, str(cause))
         self.cause = cause
 
+_RESOLVED_STAT = 1
+_RESOLVED_XACCESS = 2
+_RESOLVED_HIDDEN = 4
+_RESOLVED_ICON = 8
+_RESOLVED_ALL = 15
+
+def _get_file_lazy(path):
+    return Filesystem.getInstance().get_file_lazy(path)
+
 class File(object):
     """An extended crossplatform stat() container, essentially.  
-    Extra data retrieved includes symbolic link target (if applicable) and icon."""
+    Extra data retrieved includes symbolic link target (if applicable) and icon.
+    Each kind of data is retrieved the first time it is accessed."""
     
     path = property(lambda self: self._path, doc="""Complete path to file, expressed in Hotwire notation (always forward slashes)""")
     uri = property(lambda self: self._uri, doc="""URI notation for file""")
     basename = property(lambda self: self._basename, doc="""Name of file (without directory component)""")
     size = property(lambda self: self._get_size(), doc="""Size in bytes of file, or None if unknown""")
-    hidden = property(lambda self: self._hidden, doc="""Whether or not this file is normally visible in directory listings""")
-    icon = property(lambda self: self._icon, doc="""Icon name (internal Hotwire/GTK+ representation)""")
+    hidden = property(lambda self: self._get_hidden_lazy(), doc="""Whether or not this file is normally visible in directory listings""")
+    icon = property(lambda self: self._get_icon_lazy(), doc="""Icon name (internal Hotwire/GTK+ representation)""")
     is_directory = property(lambda self: self.test_directory(), doc="""Whether or not this object represents a directory""")
     is_executable = property(lambda self: self._is_executable(), doc="""Whether or not this object represents an OS-executable file""")
     is_link = property(lambda self: self._is_link(), doc="""Whether or not this object represents a symbolic link""")
@@ -180,8 +254,14 @@ class File(object):
     permissions_string = property(lambda self: self._get_permissions_string(), doc="""Unix-style compact permissions string""")
     mtime = property(lambda self: self._get_mtime(), doc="""Modification time, in seconds since the epoch""")
     mimetype = property(lambda self: self._get_mime(), doc="""MIME type""")
-
-    __slots__ = ['fs', 'stat', 'xaccess', 'icon_error', '_permstring', 'target_stat', 'stat_error']
+    # The raw metadata is retrieved on first access, so consumers only pay
+    # for what they use.
+    stat = property(lambda self: self._get_stat_lazy(), lambda self, v: self._set_stat(v), doc="""Result of lstat() (or stat() if unavailable)""")
+    target_stat = property(lambda self: self._get_target_stat_lazy(), lambda self, v: self._set_target_stat(v), doc="""Result of stat() on the target of a symbolic link""")
+    xaccess = property(lambda self: self._get_xaccess_lazy(), lambda self, v: self._set_xaccess(v), doc="""Whether the file may be executed""")
+
+    __slots__ = ['fs', '_path', '_uri', '_basename', '_stat', '_xaccess', '_hidden', '_icon', 'icon_error',
+                 '_permstring', '_target_stat', 'stat_error', '_resolved']
     def __init__(self, path, fs=None):
         super(File, self).__init__()
         if not isinstance(path, unicode):
@@ -190,15 +270,59 @@ class File(object):
         self._uri = 'file://' + urllib.pathname2url(path.encode(sys.getfilesystemencoding()))
         self._basename = unix_basename(path)
         self.fs = fs
-        self.stat = None
-        self.xaccess = None
+        self._stat = None
+        self._xaccess = None
         self._hidden = None
         self._icon = None
         self.icon_error = False
         self._permstring = None
-        self.target_stat = None
+        self._target_stat = None
         self.stat_error = None
+        # Bitmask of the _RESOLVED_* metadata groups already retrieved
+        self._resolved = 0
+
+    def _resolve(self, group, loader):
+        if not (self._resolved & group):
+            # Only mark the group once it's filled in, since File objects
+            # may be shared between threads.  Loaders must therefore not
+            # read the properties they're filling in.
+            loader()
+            self._resolved |= group
+
+    def _get_stat_lazy(self):
+        self._resolve(_RESOLVED_STAT, self._do_get_stat)
+        return self._stat
+
+    def _set_stat(self, value):
+        self._stat = value
+
+    def _get_target_stat_lazy(self):
+        self._resolve(_RESOLVED_STAT, self._do_get_stat)
+        return self._target_stat
+
+    def _set_target_stat(self, value):
+        self._target_stat = value
+
+    def _get_xaccess_lazy(self):
+        self._resolve(_RESOLVED_XACCESS, self._do_get_xaccess)
+        return self._xaccess
+
+    def _set_xaccess(self, value):
+        self._xaccess = value
+
+    def _get_hidden_lazy(self):
+        self._resolve(_RESOLVED_HIDDEN, self._do_get_hidden)
+        return self._hidden
+
+    def _get_icon_lazy(self):
+        self._resolve(_RESOLVED_ICON, self._do_get_icon)
+        return self._icon
         
+    def __reduce__(self):
+        # The filesystem object can't be pickled; a File is rebuilt from
+        # its path, retrieving the metadata again when first accessed
+        return (_get_file_lazy, (self._path,))
+
     def __cmp__(self, o):
         if isinstance(o, File):
             return cmp(self.path, o.path)
@@ -281,22 +405,31 @@ class File(object):
         self._get_stat_async()
 
     def _get_stat_async(self):
-        MiniThreadPool.getInstance().run(self.__get_stat_signal)
+        MiniThreadPool.getInstance().run(self.__get_stat_signal, priority=PRIORITY_BACKGROUND)
         
     def get_stat_sync(self):
-        self._do_get_stat(rethrow=True)
-        self._do_get_xaccess()
-        self._do_get_hidden()
-        self._do_get_icon()
+        """Retrieve stat data now, raising FileStatError on failure.  Other
+        metadata is still retrieved on demand."""
+        if not (self._resolved & _RESOLVED_STAT):
+            try:
+                self._do_get_stat(rethrow=True)
+            finally:
+                self._resolved |= _RESOLVED_STAT
+
+    def _resolve_all(self):
+        self._get_stat_lazy()
+        self._get_xaccess_lazy()
+        self._get_hidden_lazy()
+        self._get_icon_lazy()
 
     def _do_get_stat(self, rethrow=False):
         try:
-            self.stat = hasattr(os, 'lstat') and os.lstat(self.path) or os.stat(self.path)
-            if stat.S_ISLNK(self.stat[stat.ST_MODE]):
+            self._stat = hasattr(os, 'lstat') and os.lstat(self.path) or os.stat(self.path)
+            if stat.S_ISLNK(self._stat[stat.ST_MODE]):
                 try:
-                    self.target_stat = os.stat(self.path)
+                    self._target_stat = os.stat(self.path)
                 except OSError, e:
-                    self.target_stat = None		
+                    self._target_stat = None		
         except OSError, e:
             _logger.debug("Failed to stat '%s': %s", self.path, e)
             self.stat_error = str(e)
@@ -304,7 +437,7 @@ class File(object):
                 raise FileStatError(e)
             
     def _do_get_xaccess(self):
-        self.xaccess = os.access(self.path, os.X_OK)
+        self._xaccess = os.access(self.path, os.X_OK)
         
     def _do_get_hidden(self):
         pass 
@@ -319,7 +452,8 @@ class File(object):
 
     @log_except(_logger)
     def __get_stat_signal(self):
-        self.get_stat_sync()
+        # Do all of the work here, rather than in the mainloop thread
+        self._resolve_all()
         call_idle(self.__idle_emit_changed, priority=gobject.PRIORITY_LOW)        
         
     @log_except(_logger)
@@ -327,6 +461,142 @@ class File(object):
         responses = dispatcher.send(sender=self)
         _logger.debug("idle changed dispatch from %r, responses=%r", self, responses)
         
+_walk_max_threads = 4
+_walk_max_pending = 64
+class TreeWalker(object):
+    """Recursively generates File objects for the non-directory entries of a tree.
+By default, directories are scanned by a bounded set of worker threads, and
+File objects are generated as soon as they are discovered, in no particular
+order.  If threads is 1, the tree is traversed depth-first on the calling
+thread with the entries of each directory sorted by name."""
+
+    cancelled = property(lambda self: self.__cancelled, doc="""Whether the walk was stopped before completion.""")
+
+    def __init__(self, fs, path, show_all=False, threads=None):
+        super(TreeWalker, self).__init__()
+        self.__fs = fs
+        self.__path = path
+        self.__show_all = show_all
+        self.__threads = threads or _walk_max_threads
+        self.__cancelled = False
+        self.__dirs_cond = threading.Condition()
+        self.__dirs = deque()
+        self.__dirs_pending = 0
+        self.__results = None
+
+    def cancel(self):
+        self.__dirs_cond.acquire()
+        self.__cancelled = True
+        self.__dirs_cond.notifyAll()
+        self.__dirs_cond.release()
+
+    def __iter__(self):
+        if self.__threads <= 1:
+            return self.__iter_serial()
+        return self.__iter_parallel()
+
+    def __scan_dir(self, dpath, sort=False):
+        """Return a tuple (files, subdirectories) for the entries of dpath."""
+        files = []
+        subdirs = []
+        try:
+            entries = list(iterd_typed(dpath))
+        except OSError, e:
+            _logger.debug("Failed to list '%s': %s", dpath, e)
+            return (files, subdirs)
+        if sort:
+            entries.sort(lambda a,b: locale.strcoll(a[0], b[0]))
+        unknown = []
+        for (fpath, is_dir) in entries:
+            fobj = self.__fs.get_file_lazy(fpath)
+            if fobj.hidden and not self.__show_all:
+                continue
+            if is_dir:
+                # The entry type says this is a directory, so skip the stat.
+                subdirs.append(fpath)
+            else:
+                unknown.append(fobj)
+        # Worker threads already stat in parallel; only the serial walk
+        # benefits from splitting a large directory across threads.
+        for fobj in self.__fs.stat_files(unknown, threaded=sort):
+            if fobj.test_directory(follow_link=False):
+                subdirs.append(fobj.path)
+            elif not fobj.test_directory(follow_link=True):
+                # Like os.walk, symbolic links to directories are neither
+                # generated nor followed.
+                files.append(fobj)
+        return (files, subdirs)
+
+    def __iter_serial(self):
+        stack = [self.__path]
+        while stack and not self.__cancelled:
+            (files, subdirs) = self.__scan_dir(stack.pop(), sort=True)
+            for fobj in files:
+                if self.__cancelled:
+                    return
+                yield fobj
+            subdirs.reverse()
+            stack.extend(subdirs)
+
+    def __iter_parallel(self):
+        self.__results = Queue.Queue(_walk_max_pending)
+        self.__dirs.append(self.__path)
+        self.__dirs_pending = 1
+        for i in xrange(self.__threads):
+            thr = threading.Thread(target=self.__worker, name="TreeWalker Thread")
+            thr.setDaemon(True)
+            thr.start()
+        complete = False
+        try:
+            while not self.__cancelled:
+                try:
+                    files = self.__results.get(True, 0.5)
+                except Queue.Empty, e:
+                    continue
+                if files is None:
+                    break
+                for fobj in files:
+                    yield fobj
+            complete = True
+        finally:
+            # If our consumer went away, stop the workers
+            if not complete:
+                self.cancel()
+
+    def __put_result(self, files):
+        while not self.__cancelled:
+            try:
+                self.__results.put(files, True, 0.5)
+                return
+            except Queue.Full, e:
+                pass
+
+    def __worker(self):
+        while True:
+            self.__dirs_cond.acquire()
+            while not (self.__dirs or self.__cancelled or self.__dirs_pending == 0):
+                self.__dirs_cond.wait()
+            if self.__cancelled or not self.__dirs:
+                self.__dirs_cond.release()
+                return
+            dpath = self.__dirs.popleft()
+            self.__dirs_cond.release()
+            try:
+                (files, subdirs) = self.__scan_dir(dpath)
+            except:
+                _logger.exception("Failed to scan '%s'", dpath)
+                (files, subdirs) = ([], [])
+            if files:
+                self.__put_result(files)
+            self.__dirs_cond.acquire()
+            self.__dirs.extend(subdirs)
+            self.__dirs_pending += len(subdirs) - 1
+            done = self.__dirs_pending == 0
+            self.__dirs_cond.notifyAll()
+            self.__dirs_cond.release()
+            if done:
+                self.__put_result(None)
+
 class BaseBookmarks(Singleton):
     def __init__(self):
         self.__bookmarks_path = path_expanduser('~/.gtk-bookmarks')
@@ -29,7 +29,7 @@ try:
 except:
     have_gnomedesktop = False
 
-from hotwire.sysdep.fs import FileStatError
+from hotwire.sysdep.fs import FileStatError, _RESOLVED_STAT
 from hotwire.sysdep.fs_impl.fs_unix import UnixFilesystem, UnixFile
 from hotwire_ui.pixbufcache import PixbufCache
 
@@ -39,14 +39,25 @@ class GnomeVfsFile(UnixFile):
     """A File implementation based on the GnomeVFS virtual filesystem.
 Important members include the "vfsstat" and "uri"."""
     
-    __slots__ = ['vfsstat', 'target_vfsstat']
+    vfsstat = property(lambda self: self._get_vfsstat_lazy(), doc="""GnomeVFS file info""")
+    target_vfsstat = property(lambda self: self._get_target_vfsstat_lazy(), doc="""GnomeVFS file info for the target of a symbolic link""")
+
+    __slots__ = ['_vfsstat', '_target_vfsstat', 'target_vfsstat_error']
 
     def __init__(self, path, **kwargs):
         super(GnomeVfsFile, self).__init__(path, **kwargs)
-        self.vfsstat = None
-        self.target_vfsstat = None
+        self._vfsstat = None
+        self._target_vfsstat = None
         self.target_vfsstat_error = None 
 
+    def _get_vfsstat_lazy(self):
+        self._resolve(_RESOLVED_STAT, self._do_get_stat)
+        return self._vfsstat
+
+    def _get_target_vfsstat_lazy(self):
+        self._resolve(_RESOLVED_STAT, self._do_get_stat)
+        return self._target_vfsstat
+
     def test_directory(self, follow_link=True):
         if not self.vfsstat:
             return False
@@ -87,10 +98,10 @@ Important members include the "vfsstat" and "uri"."""
             
     def _do_get_stat(self, rethrow=False):
         try:
-            self.vfsstat = gnomevfs.get_file_info(self.uri, gnomevfs.FILE_INFO_GET_MIME_TYPE | gnomevfs.FILE_INFO_FORCE_FAST_MIME_TYPE)
-            if self.vfsstat.type == gnomevfs.FILE_TYPE_SYMBOLIC_LINK:
+            self._vfsstat = gnomevfs.get_file_info(self.uri, gnomevfs.FILE_INFO_GET_MIME_TYPE | gnomevfs.FILE_INFO_FORCE_FAST_MIME_TYPE)
+            if self._vfsstat.type == gnomevfs.FILE_TYPE_SYMBOLIC_LINK:
                 try:
-                    self.target_vfsstat = gnomevfs.get_file_info(self.uri, gnomevfs.FILE_INFO_GET_MIME_TYPE | gnomevfs.FILE_INFO_FOLLOW_LINKS)
+                    self._target_vfsstat = gnomevfs.get_file_info(self.uri, gnomevfs.FILE_INFO_GET_MIME_TYPE | gnomevfs.FILE_INFO_FOLLOW_LINKS)
                 except Exception, e:
                     _logger.debug("Failed to get file info for target of '%s'", self.uri, exc_info=True)
                     self.target_vfsstat_error = str(e)
@@ -116,7 +116,7 @@ class Win32File(File):
         
     def _do_get_xaccess(self):
         super(Win32File, self)._do_get_xaccess()
-        self.xaccess = self.xaccess and win_exec_re.search(self.path)
+        self._xaccess = self._xaccess and win_exec_re.search(self.path)
 
     def _do_get_hidden(self):
         path = self.path.encode(sys.getfilesystemencoding()).rstrip('/')#FindFiles on directories ending with '/' returns []
@@ -140,8 +140,9 @@ class Win32File(File):
                 _logger.debug("Trying our own wrapper of _stat32")
                 st = Stat32()
                 msvcrt._stat(self.path.encode(sys.getfilesystemencoding()), byref(st))
-                self.stat = (st.st_mode, st.st_ino, st.st_dev, st.st_nlink - 1, st.st_uid,
-                             st.st_gid, st.st_size, st.st_atime, st.st_mtime, st.st_ctime)
+                self._stat = (st.st_mode, st.st_ino, st.st_dev, st.st_nlink - 1, st.st_uid,
+                              st.st_gid, st.st_size, st.st_atime, st.st_mtime, st.st_ctime)
+                self.stat_error = None
             else:
                 if rethrow:
                     raise
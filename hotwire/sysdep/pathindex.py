@@ -0,0 +1,126 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os,sys,bisect,threading,logging
+
+_logger = logging.getLogger("hotwire.sysdep.PathIndex")
+
+class PathExecutableIndex(object):
+    """A sorted index of the executables in the directories of $PATH.
+A directory is relisted only when its modification time changes, and the
+whole index is rebuilt when $PATH itself changes.  Note that changing the
+permissions of an existing file does not alter the directory mtime."""
+    def __init__(self, fs):
+        super(PathExecutableIndex, self).__init__()
+        self.__fs = fs
+        self.__lock = threading.Lock()
+        self.__dirs = []
+        # dpath -> (mtime, [File])
+        self.__dir_entries = {}
+        # Sorted list of (basename, PATH position, File)
+        self.__entries = []
+        self.__names = []
+        self.__first = {}
+
+    def __dir_mtime(self, dpath):
+        if not os.access(dpath, os.X_OK):
+            return None
+        try:
+            return os.stat(dpath).st_mtime
+        except OSError, e:
+            return None
+
+    def __list_executables(self, dpath):
+        try:
+            fobjs = self.__fs.list_dir(dpath)
+        except OSError, e:
+            _logger.debug("Failed to list '%s'", dpath, exc_info=True)
+            return []
+        return [fobj for fobj in fobjs if fobj.is_executable]
+
+    def __validate(self):
+        # Called with the lock held
+        dirs = list(self.__fs.get_path_generator())
+        changed = dirs != self.__dirs
+        dir_entries = {}
+        for dpath in dirs:
+            if dpath in dir_entries:
+                continue
+            mtime = self.__dir_mtime(dpath)
+            prev = self.__dir_entries.get(dpath)
+            if prev is not None and prev[0] == mtime:
+                dir_entries[dpath] = prev
+                continue
+            changed = True
+            if mtime is None:
+                dir_entries[dpath] = (None, [])
+            else:
+                dir_entries[dpath] = (mtime, self.__list_executables(dpath))
+        if not changed:
+            return
+        _logger.debug("rebuilding executable index for %d directories", len(dirs))
+        entries = []
+        seen = set()
+        for (i, dpath) in enumerate(dirs):
+            if dpath in seen:
+                continue
+            seen.add(dpath)
+            for fobj in dir_entries[dpath][1]:
+                entries.append((fobj.basename, i, fobj))
+        entries.sort()
+        first = {}
+        for (name, i, fobj) in entries:
+            if name not in first:
+                first[name] = fobj
+        self.__dirs = dirs
+        self.__dir_entries = dir_entries
+        self.__entries = entries
+        self.__names = [entry[0] for entry in entries]
+        self.__first = first
+
+    def get_executables(self, prefix=u''):
+        """Return a list of File objects for executables whose name starts
+        with prefix, in $PATH order."""
+        if not isinstance(prefix, unicode):
+            prefix = unicode(prefix, 'utf-8')
+        self.__lock.acquire()
+        try:
+            self.__validate()
+            entries = self.__entries
+            names = self.__names
+        finally:
+            self.__lock.release()
+        start = end = bisect.bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        matches = entries[start:end]
+        matches.sort(key=lambda entry: (entry[1], entry[0]))
+        return [entry[2] for entry in matches]
+
+    def lookup(self, name):
+        """Return the File for the first executable named name in $PATH, or
+        None."""
+        self.__lock.acquire()
+        try:
+            self.__validate()
+            return self.__first.get(name)
+        finally:
+            self.__lock.release()
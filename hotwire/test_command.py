@@ -20,12 +20,16 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, unittest, tempfile, shutil
+import os, sys, unittest, tempfile, shutil, time, threading, Queue, datetime, subprocess
 
 import hotwire
 from hotwire.command import *
+from hotwire.async import MiniThreadPool, IterableQueue, PRIORITY_INTERACTIVE, PRIORITY_DEFAULT, PRIORITY_BACKGROUND
+import hotwire.state, hotwire.histimport
+from hotwire.state import History, StateWriter, Preferences, sqlite3
 from hotwire.sysdep import is_windows, is_unix
 from hotwire.sysdep.fs import File
+from hotwire.sysdep.dircache import get_inotify
 import hotwire.script
 from hotwire.fs import unix_basename, path_join, path_abs, path_dirname, path_fastnormalize
 
@@ -619,6 +623,55 @@ class PipelineRunTests(PipelineRunTestFramework):
         results = list(p.get_output())
         self.assertEquals([0,2,5,7,8,10], results)
 
+    def testSort2(self):
+        # Force the input through several spilled runs
+        import hotwire.builtins.sort
+        run_size = hotwire.builtins.sort._run_size
+        hotwire.builtins.sort._run_size = 7
+        try:
+            p = Pipeline.parse("py-eval '[(x % 5, x) for x in range(100)]' | iter | sort -r")
+            p.execute_sync()
+            results = list(p.get_output())
+        finally:
+            hotwire.builtins.sort._run_size = run_size
+        self.assertEquals(sorted([(x % 5, x) for x in range(100)], reverse=True), results)
+        p = Pipeline.parse("py-eval 'map(str, [10, 9, 100])' | iter | sort -n")
+        p.execute_sync()
+        self.assertEquals(['9', '10', '100'], list(p.get_output()))
+        p = Pipeline.parse("py-eval '[5,2,7,8,10,0]' | iter | sort -r | head -2")
+        p.execute_sync()
+        self.assertEquals([10, 8], list(p.get_output()))
+
+    def testSortSpillFiles(self):
+        # File objects are written to disk too
+        import hotwire.builtins.sort
+        self._setupTree2()
+        for (i, name) in enumerate(['testf2', 'testdir2/blah', 'otherfile', 'f3test', 'testf']):
+            f = open(path_join(self._tmpd, name), 'w')
+            f.write('x' * (i + 1))
+            f.close()
+        spilled = []
+        def spill_run(run):
+            f = orig_spill_run(run)
+            spilled.append(f is not None)
+            return f
+        run_size = hotwire.builtins.sort._run_size
+        orig_spill_run = hotwire.builtins.sort.spill_run
+        hotwire.builtins.sort._run_size = 2
+        hotwire.builtins.sort.spill_run = spill_run
+        try:
+            p = Pipeline.parse("walk | sort size", self._context)
+            p.execute_sync()
+            results = list(p.get_output())
+        finally:
+            hotwire.builtins.sort._run_size = run_size
+            hotwire.builtins.sort.spill_run = orig_spill_run
+        self.assertTrue(spilled)
+        self.assertTrue(False not in spilled)
+        self.assertEquals(['testf2', 'blah', 'otherfile', 'f3test', 'testf'],
+                          map(lambda x: unix_basename(x.path), results))
+        self.assertEquals([1, 2, 3, 4, 5], map(lambda x: x.size, results))
+
     def testUniq1(self):
         self._setupTree1()
         p = Pipeline.parse("py-eval '[1,1,2,4,5,4]' | iter | uniq")
@@ -626,6 +679,142 @@ class PipelineRunTests(PipelineRunTestFramework):
         results = list(p.get_output())
         self.assertEquals([1,2,4,5], results)
 
+    def testUniq2(self):
+        # Force the unique items to spill partway through
+        import hotwire.builtins.uniq
+        max_items = hotwire.builtins.uniq._max_memory_items
+        hotwire.builtins.uniq._max_memory_items = 3
+        try:
+            p = Pipeline.parse("py-eval '[1,1,2,4,5,4,7,1,8,7]' | iter | uniq")
+            p.execute_sync()
+            self.assertEquals([1,2,4,5,7,8], list(p.get_output()))
+            p = Pipeline.parse("py-eval '[1,1,2,4,5,4,7,1,8,7]' | iter | uniq -c")
+            p.execute_sync()
+            self.assertEquals([(3,1),(1,2),(2,4),(1,5),(2,7),(1,8)], list(p.get_output()))
+            p = Pipeline.parse("py-eval '[1,1,2,4,5,4,7,1,8,7]' | iter | uniq -d")
+            p.execute_sync()
+            self.assertEquals([6], list(p.get_output()))
+        finally:
+            hotwire.builtins.uniq._max_memory_items = max_items
+
+    def testUniq3(self):
+        # Unpicklable items, first in the initial spill then after it; pickled
+        # as soon as they're spilled, and only once the input ends
+        import hotwire.builtins.uniq, hotwire.spill
+        max_items = hotwire.builtins.uniq._max_memory_items
+        batch_size = hotwire.spill._batch_size
+        hotwire.builtins.uniq._max_memory_items = 3
+        named = lambda x: callable(x) and 'f' or x
+        try:
+            for spill_batch_size in (1, batch_size):
+                hotwire.spill._batch_size = spill_batch_size
+                for (items, unique, counts) in [('[f,1,f,2,4,5,4,7,1,8,7]', ['f',1,2,4,5,7,8],
+                                                 [(2,'f'),(2,1),(1,2),(2,4),(1,5),(2,7),(1,8)]),
+                                                ('[1,1,2,4,5,4,f,7,f,1,8,7]', [1,2,4,5,'f',7,8],
+                                                 [(3,1),(1,2),(2,4),(1,5),(2,'f'),(2,7),(1,8)])]:
+                    items = "(lambda f: %s)(lambda: 0)" % (items,)
+                    p = Pipeline.parse("py-eval '%s' | iter | uniq" % (items,))
+                    p.execute_sync()
+                    self.assertEquals(unique, map(named, p.get_output()))
+                    p = Pipeline.parse("py-eval '%s' | iter | uniq -c" % (items,))
+                    p.execute_sync()
+                    self.assertEquals(counts, [(count, named(item)) for (count, item) in p.get_output()])
+                    p = Pipeline.parse("py-eval '%s' | iter | uniq -d" % (items,))
+                    p.execute_sync()
+                    self.assertEquals([7], list(p.get_output()))
+        finally:
+            hotwire.builtins.uniq._max_memory_items = max_items
+            hotwire.spill._batch_size = batch_size
+
+    def testUniqSpillFiles(self):
+        # File objects are written to disk too
+        import hotwire.builtins.uniq
+        self._setupTree2()
+        spilled = []
+        def spill_run(run):
+            f = orig_spill_run(run)
+            spilled.append(f is not None)
+            return f
+        max_items = hotwire.builtins.uniq._max_memory_items
+        orig_spill_run = hotwire.builtins.uniq.spill_run
+        hotwire.builtins.uniq._max_memory_items = 2
+        hotwire.builtins.uniq.spill_run = spill_run
+        try:
+            p = Pipeline.parse("walk -s | uniq", self._context)
+            p.execute_sync()
+            results = map(lambda x: unix_basename(x.path), p.get_output())
+            p = Pipeline.parse("walk -s | uniq -c", self._context)
+            p.execute_sync()
+            counts = [(count, unix_basename(x.path)) for (count, x) in p.get_output()]
+        finally:
+            hotwire.builtins.uniq._max_memory_items = max_items
+            hotwire.builtins.uniq.spill_run = orig_spill_run
+        self.assertTrue(spilled)
+        self.assertTrue(False not in spilled)
+        self.assertEquals(['f3test', 'otherfile', 'testf', 'testf2', 'blah'], results)
+        self.assertEquals([(1, 'f3test'), (1, 'otherfile'), (1, 'testf'), (1, 'testf2'), (1, 'blah')], counts)
+
+    def testUniqApproximate(self):
+        p = Pipeline.parse("py-eval '[1,1,2,4,5,4]' | iter | uniq -a")
+        p.execute_sync()
+        self.assertEquals([1,2,4,5], list(p.get_output()))
+        p = Pipeline.parse("py-eval '[x % 7 for x in range(1000)] + [1] * 100' | iter | uniq -a -c")
+        p.execute_sync()
+        self.assertEquals((243, 1), list(p.get_output())[0])
+        p = Pipeline.parse("py-eval 'range(10000)' | iter | uniq -a -d")
+        p.execute_sync()
+        self.assertTrue(abs(list(p.get_output())[0] - 10000) < 100)
+
+    def testJson1(self):
+        try:
+            import simplejson
+        except ImportError, e:
+            # The json builtin isn't loaded then
+            return
+        for objs in ([], [1], [1, 'two', {'a': [3]}]):
+            p = Pipeline.parse("py-eval \"%r\" | iter | json" % (objs,), self._context)
+            p.execute_sync()
+            self.assertEquals(objs, simplejson.loads('\n'.join(p.get_output())))
+
+    def testJsonLines(self):
+        try:
+            import simplejson
+        except ImportError, e:
+            return
+        p = Pipeline.parse("py-eval \"[1, 'two', {'a': [3]}]\" | iter | json -l", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(3, len(results))
+        self.assertEquals([1, 'two', {'a': [3]}], map(simplejson.loads, results))
+
+    def testJsonSchemaCache(self):
+        # The members of a class are only listed once
+        try:
+            import simplejson
+        except ImportError, e:
+            return
+        import hotwire.builtins.json
+        self._setupTree2()
+        computed = []
+        class SchemaCache(dict):
+            def __setitem__(self, cls, schema):
+                computed.append(cls)
+                dict.__setitem__(self, cls, schema)
+        schema_cache = hotwire.builtins.json._schema_cache
+        hotwire.builtins.json._schema_cache = SchemaCache()
+        try:
+            p = Pipeline.parse("walk -s | json -l", self._context)
+            p.execute_sync()
+            results = map(simplejson.loads, p.get_output())
+        finally:
+            hotwire.builtins.json._schema_cache = schema_cache
+        self.assertEquals(5, len(results))
+        self.assertEquals(1, len(computed))
+        for result in results:
+            self.assertEquals(sorted(results[0].keys()), sorted(result.keys()))
+            self.assertTrue('path' in result)
+            self.assertTrue('get_stat' in result)
+
     def testHead1(self):
         self._setupTree1()
         p = Pipeline.parse("py-eval '[5,2,7,8,10,0,34]' | iter | head -5")
@@ -633,7 +822,482 @@ class PipelineRunTests(PipelineRunTestFramework):
         results = list(p.get_output())
         self.assertEquals([5,2,7,8,10], results)
 
-        
+    def testHeadAsync(self):
+        # The producer can't get far ahead, and must not be left waiting
+        # when the consumer stops reading
+        p = Pipeline.parse("py-eval 'range(20000)' | iter | head -5")
+        p.execute()
+        results = list(p.get_output())
+        self.assertEquals(range(5), results)
+
+    def testWalk1(self):
+        self._setupTree2()
+        open(path_join(self._tmpd, '.nosee'), 'w').close()
+        os.mkdir(path_join(self._tmpd, '.hiddendir'))
+        open(path_join(self._tmpd, '.hiddendir', 'foo'), 'w').close()
+        p = Pipeline.parse("walk", self._context)
+        p.execute_sync()
+        results = map(lambda x: x.path, p.get_output())
+        results.sort()
+        self.assertEquals(len(results), 5)
+        self.assertTrue(path_join(self._tmpd, 'testdir2', 'blah') in results)
+
+    def testWalk2(self):
+        self._setupTree2()
+        p = Pipeline.parse("walk -s", self._context)
+        p.execute_sync()
+        results = map(lambda x: unix_basename(x.path), p.get_output())
+        self.assertEquals(results, ['f3test', 'otherfile', 'testf', 'testf2', 'blah'])
+
+    def testWalk3(self):
+        self._setupTree2()
+        open(path_join(self._tmpd, '.nosee'), 'w').close()
+        p = Pipeline.parse("walk -a", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 6)
+
+    def testFSearch1(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testdir2', 'blah'), 'w')
+        f.write('hello\nworld\nhello world\n')
+        f.close()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('some\x00binary world')
+        f.close()
+        p = Pipeline.parse("fsearch world", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 2)
+        results.sort(lambda a,b: cmp(a.line_num, b.line_num))
+        self.assertEquals(results[0].path, path_join(self._tmpd, 'testdir2', 'blah'))
+        self.assertEquals(results[0].line, 'world')
+        self.assertEquals(results[0].line_num, 1)
+        self.assertEquals(results[1].line, 'hello world')
+        self.assertEquals(results[1].line_num, 2)
+        self.assertEquals(results[1].match_start, 6)
+        self.assertEquals(results[1].match_end, 11)
+
+    def testFSearch2(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('Hello\nfoo\nhello there')
+        f.close()
+        p = Pipeline.parse("fsearch -i '^hel+o'", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 2)
+        results.sort(lambda a,b: cmp(a.line_num, b.line_num))
+        self.assertEquals(results[1].line, 'hello there')
+        self.assertEquals(results[1].line_num, 2)
+        p = Pipeline.parse("fsearch '(?i)HELLO'", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 2)
+
+    def testFSearchIndex1(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testdir2', 'blah'), 'w')
+        f.write('hello\nworld\n')
+        f.close()
+        p = Pipeline.parse("index update", self._context)
+        p.execute_sync()
+        p = Pipeline.parse("fsearch world", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 1)
+        # The index is now stale for testf; it must still be searched
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('another world')
+        f.close()
+        p = Pipeline.parse("fsearch -i WORLD", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 2)
+        p = Pipeline.parse("index remove", self._context)
+        p.execute_sync()
+
+    def testFSearchIndex2(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('hello world')
+        f.close()
+        p = Pipeline.parse("fsearch --index world", self._context)
+        p.execute_sync()
+        self.assertEquals(len(list(p.get_output())), 1)
+        from hotwire.contentindex import ContentIndex
+        index = ContentIndex()
+        self.assertEquals(index.get_root(path_join(self._tmpd, 'testdir2')), self._tmpd)
+        walker = hotwire.sysdep.fs.Filesystem.getInstance().walk(self._tmpd)
+        paths = list(index.filter(self._tmpd, walker, 'world'))
+        self.assertEquals(paths, [path_join(self._tmpd, 'testf')])
+        index.remove_root(self._tmpd)
+        index.close()
+
+    def testLsCached(self):
+        self._setupTree1()
+        p = Pipeline.parse("ls", self._context)
+        p.execute_sync()
+        count = len(list(p.get_output()))
+        # The cached listing must notice additions and changes
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('hello')
+        f.close()
+        f = open(path_join(self._tmpd, 'newf'), 'w')
+        f.close()
+        inotify = get_inotify()
+        if inotify is not None:
+            inotify.sync()
+        p = Pipeline.parse("ls", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(len(results), count + 1)
+        sizes = dict([(unix_basename(x.path), x.size) for x in results])
+        self.assertEquals(sizes['testf'], 5)
+
+    def testParallel(self):
+        p = Pipeline.parse("py-eval 'range(2000)' | iter | py-map -P 'it*2' | py-filter -P 'it % 3 == 0'")
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(results, [x*2 for x in range(2000) if (x*2) % 3 == 0])
+        p = Pipeline.parse("py-eval 'range(2000)' | iter | py-map -P --unordered 'it+1'")
+        p.execute_sync()
+        results = list(p.get_output())
+        results.sort()
+        self.assertEquals(results, range(1, 2001))
+
+    def testParallelUnpicklable(self):
+        # Files hold a lock, so can't be sent to the worker processes as is
+        self._setupTree2()
+        p = Pipeline.parse("walk -s | filter -P 'test[^/]*$' path", self._context)
+        p.execute_sync()
+        self.assertEquals(map(lambda x: unix_basename(x.path), p.get_output()), ['f3test', 'testf', 'testf2'])
+        p = Pipeline.parse("walk -s | sechash -P", self._context)
+        p.execute_sync()
+        self.assertEquals(len(list(p.get_output())), 5)
+        p = Pipeline.parse("py-eval '[__import__(\"threading\").Lock()] * 3' | iter | py-map -P 'it.locked()'", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), [False, False, False])
+
+    def testFused(self):
+        p = Pipeline.parse("py-eval 'range(20)' | iter | py-map 'it*2' | py-filter 'it % 3 == 0' | stringify", self._context)
+        plan = [[cmd.builtin.name for cmd in stage] for stage in p.get_plan()]
+        self.assertEquals(plan, [['py-eval'], ['iter'], ['py-map', 'py-filter', 'stringify']])
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals(results, ['0', '6', '12', '18', '24', '30', '36'])
+        self.assertEquals(p.get_state(), 'complete')
+
+    def testFusedException(self):
+        # Reported against the command which raised it, not its reader
+        p = Pipeline.parse("py-eval 'range(3)' | iter | py-map '1/(it-1)' | stringify", self._context)
+        p.execute()
+        list(p.get_output())
+        self.assertEquals(p.get_state(), 'exception')
+        self.assertEquals(p.get_exception_info()[2].builtin.name, 'py-map')
+
+    def testFusedUnread(self):
+        # A fused command completes even if its reader never reads from it
+        from hotwire.externals.dispatch import dispatcher
+        p = Pipeline.parse("py-eval 'range(3)' | iter | py-map 'it' | stringify", self._context)
+        cmd = p.get_plan()[2][0]
+        completed = []
+        def on_complete(sender=None):
+            completed.append(sender)
+        dispatcher.connect(on_complete, 'complete', cmd)
+        CommandFusedQueue(cmd).close()
+        self.assertEquals(completed, [cmd])
+
+    def testProfile(self):
+        p = Pipeline.parse("profile \"py-eval 'range(100)' | iter | py-map 'it*2' | py-filter 'it % 3 == 0'\"", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        self.assertEquals([x.name for x in results], ['py-eval', 'iter', 'py-map', 'py-filter'])
+        self.assertEquals([(x.objects_in, x.objects_out) for x in results], [(0, 1), (1, 100), (100, 100), (100, 34)])
+        self.assertTrue(results[2].fused)
+        for profile in results:
+            self.assertTrue(profile.complete)
+
+    def testPyMapOnce(self):
+        # Each object is evaluated once, even when a later one raises
+        p = Pipeline.parse("py-eval '[[0],[0],[5]]' | iter | py-map '(it.__setitem__(0, it[0]+1), it[0], 1/(6-it[0]))[1]'", self._context)
+        self.assertRaises(ZeroDivisionError, p.execute_sync)
+        self.assertEquals(list(p.get_output().iter_avail()), [1, 1])
+        p = Pipeline.parse("py-eval '[[0],[0],[5]]' | iter | py-filter '(it.__setitem__(0, it[0]+1), 1/(6.0-it[0]))[1]'", self._context)
+        self.assertRaises(ZeroDivisionError, p.execute_sync)
+        self.assertEquals(list(p.get_output().iter_avail()), [[1], [1]])
+
+    def testPyMapRepeated(self):
+        # Cached code must not carry state between runs
+        for i in range(3):
+            p = Pipeline.parse("py-eval 'range(1000)' | iter | py-map 'it+%d' | py-filter 'it %% 2'" % (i,))
+            p.execute_sync()
+            results = list(p.get_output())
+            self.assertEquals(results, [x+i for x in range(1000) if (x+i) % 2])
+
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        # A pool of our own rather than the shared instance, with one thread
+        # kept busy so that jobs queue up behind it
+        self._pool = MiniThreadPool.__new__(MiniThreadPool)
+        self._pool.__init__()
+        self._pool.set_max_threads(1)
+        self._release = threading.Event()
+        started = threading.Event()
+        def block():
+            started.set()
+            self._release.wait()
+        self._pool.run(block)
+        started.wait(5)
+        self.assertTrue(started.isSet())
+
+    def tearDown(self):
+        self._release.set()
+        self._pool = None
+
+    def _run_queued(self):
+        # The background lane is taken last, so this job runs after the rest
+        done = threading.Event()
+        self._pool.run(done.set, priority=PRIORITY_BACKGROUND)
+        self._release.set()
+        done.wait(5)
+        self.assertTrue(done.isSet())
+
+    def testPoolPriority(self):
+        ran = []
+        self._pool.run(ran.append, ('low1',), priority=PRIORITY_BACKGROUND)
+        self._pool.run(ran.append, ('low2',), priority=PRIORITY_BACKGROUND)
+        self._pool.run(ran.append, ('default',), priority=PRIORITY_DEFAULT)
+        self._pool.run(ran.append, ('high',), priority=PRIORITY_INTERACTIVE)
+        self._run_queued()
+        self.assertEquals(['high', 'default', 'low1', 'low2'], ran)
+
+    def testPoolCancel(self):
+        ran = []
+        serial = self._pool.run(ran.append, ('cancelled',), priority=PRIORITY_INTERACTIVE)
+        self._pool.run(ran.append, ('kept',))
+        self.assertTrue(self._pool.cancel(serial))
+        self.assertFalse(self._pool.cancel(serial))
+        self._run_queued()
+        self.assertEquals(['kept'], ran)
+
+    def testPoolStats(self):
+        serial = self._pool.run(lambda: None, priority=PRIORITY_INTERACTIVE)
+        self._pool.run(lambda: None, priority=PRIORITY_INTERACTIVE)
+        self._pool.run(lambda: None, priority=PRIORITY_BACKGROUND)
+        stats = self._pool.get_stats()
+        self.assertEquals(2, stats['interactive']['depth'])
+        self.assertEquals(2, stats['interactive']['submitted'])
+        self.assertEquals(1, stats['background']['depth'])
+        self.assertEquals(1, stats['default']['submitted'])
+        self.assertEquals(0, stats['default']['completed'])
+        self._pool.cancel(serial)
+        self._run_queued()
+        # Counters are updated after each job returns
+        deadline = time.time() + 5
+        while self._pool.get_stats()['background']['completed'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        stats = self._pool.get_stats()
+        for name in ('interactive', 'default', 'background'):
+            self.assertEquals(0, stats[name]['depth'])
+        self.assertEquals((1, 1), (stats['interactive']['completed'], stats['interactive']['cancelled']))
+        self.assertEquals((1, 0), (stats['default']['completed'], stats['default']['cancelled']))
+        self.assertEquals((2, 2), (stats['background']['submitted'], stats['background']['completed']))
+        self.assertTrue(stats['interactive']['max_wait'] > 0)
+        self.assertTrue(stats['default']['total_run'] > 0)
+
+    def testQueuePut(self):
+        queue = IterableQueue(1)
+        queue.put(1)
+        self.assertRaises(Queue.Full, queue.put, 2, False)
+        self.assertRaises(Queue.Full, queue.put, 2, True, 0.05)
+        self.assertEquals([1], queue.get_many(10))
+        queue.put(2, timeout=0.05)
+        self.assertEquals([2], queue.get_many(10))
+
+class StateTests(unittest.TestCase):
+    def setUp(self):
+        self._tmpd = tempfile.mkdtemp(prefix='hotwiretest_state')
+        self._get_state_path = hotwire.state._get_state_path
+        hotwire.state._get_state_path = lambda name: os.path.join(self._tmpd, name)
+        # Don't import the history of whoever runs the tests
+        self._get_importers = hotwire.histimport.get_importers
+        hotwire.histimport.get_importers = lambda: []
+
+    def tearDown(self):
+        hotwire.state._get_state_path = self._get_state_path
+        hotwire.histimport.get_importers = self._get_importers
+        shutil.rmtree(self._tmpd, ignore_errors=True)
+
+    def _new_history(self):
+        # A History of our own rather than the shared instance
+        history = History.__new__(History)
+        history.__init__()
+        return history
+
+    def _connect(self, name):
+        return sqlite3.connect(os.path.join(self._tmpd, name), isolation_level=None)
+
+    def _create_old_history(self):
+        # The schema from before the search indexes
+        conn = self._connect('history.sqlite')
+        conn.execute('''CREATE TABLE Commands (bid INTEGER PRIMARY KEY AUTOINCREMENT, cmd TEXT, exectime DATETIME, dirpath TEXT, lang_uuid TEXT)''')
+        conn.execute('''CREATE INDEX CommandsIndex2 on Commands (cmd, lang_uuid)''')
+        conn.execute('''CREATE TABLE Directories (dbid INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE, count INTEGER, modtime DATETIME)''')
+        conn.execute('''CREATE TABLE CmdInput (dbid INTEGER PRIMARY KEY AUTOINCREMENT, cmd TEXT, line TEXT, modtime DATETIME)''')
+        conn.execute('''CREATE TABLE Meta (keyName TEXT UNIQUE, keyValue)''')
+        conn.executemany('''INSERT INTO Commands VALUES (NULL, ?, ?, '/', 'test')''',
+                         [('make install', datetime.datetime(2008, 1, 3)),
+                          ('ls -l', datetime.datetime(2008, 1, 1)),
+                          ('make check', datetime.datetime(2008, 1, 2))])
+        conn.execute('''INSERT INTO CmdInput VALUES (NULL, 'grep', 'foobar', ?)''', (datetime.datetime(2008, 1, 1),))
+        conn.close()
+
+    def _text_matches(self, conn, index, term):
+        sql = '''SELECT rowid FROM %s WHERE %s MATCH ?''' % (index, index)
+        return sorted([row[0] for row in conn.execute(sql, ('"%s"' % (term,),))])
+
+    def testHistoryIndexMigration(self):
+        self._create_old_history()
+        history = self._new_history()
+        history.flush(5)
+        conn = self._connect('history.sqlite')
+        result = conn.execute('''SELECT keyValue FROM Meta WHERE keyName = ?''', ('search_index',)).fetchone()
+        self.assertEquals(hotwire.state._search_index_version, result[0])
+        self.assertEquals(['make install', 'make check'], list(history.search_commands('test', 'make')))
+        self.assertEquals(['foobar'], list(history.search_command_input('grep', 'oba')))
+        if hotwire.state.have_fts:
+            # The existing rows were indexed
+            self.assertEquals([1, 3], self._text_matches(conn, 'CommandsText', 'ake'))
+            self.assertEquals([1], self._text_matches(conn, 'CmdInputText', 'oba'))
+
+    def testHistoryIndexTriggers(self):
+        if not hotwire.state.have_fts:
+            return
+        history = self._new_history()
+        history.append_command('test', 'echo hello', '/')
+        history.record_command_input('grep', 'foobar')
+        history.flush(5)
+        conn = self._connect('history.sqlite')
+        self.assertEquals(1, len(self._text_matches(conn, 'CommandsText', 'hello')))
+        self.assertEquals(['echo hello'], list(history.search_commands('test', 'ell')))
+        conn.execute('''UPDATE Commands SET cmd = ? WHERE cmd = ?''', ('echo world', 'echo hello'))
+        self.assertEquals([], self._text_matches(conn, 'CommandsText', 'hello'))
+        self.assertEquals(['echo world'], list(history.search_commands('test', 'orld')))
+        conn.execute('''DELETE FROM Commands''')
+        self.assertEquals([], self._text_matches(conn, 'CommandsText', 'orld'))
+        self.assertEquals([], list(history.search_commands('test', 'orld')))
+        self.assertEquals([1], self._text_matches(conn, 'CmdInputText', 'oba'))
+        conn.execute('''DELETE FROM CmdInput''')
+        self.assertEquals([], self._text_matches(conn, 'CmdInputText', 'oba'))
+
+    def testHistoryTimeIndex(self):
+        self._create_old_history()
+        history = self._new_history()
+        history.flush(5)
+        # Terms too short for the text index are matched with LIKE, reading
+        # the most recent commands first from the exectime index
+        self.assertEquals(['make install', 'ls -l'], list(history.search_commands('test', 'l')))
+        (sql, args) = history._History__search_limit_query('Commands', 'cmd', 'exectime', 'l', 50,
+                                                            filters=[(' lang_uuid = ? ', 'test')])
+        plan = self._connect('history.sqlite').execute('EXPLAIN QUERY PLAN ' + sql, args).fetchall()
+        self.assertTrue('CommandsTimeIndex' in str(plan))
+        self.assertTrue('TEMP B-TREE' not in str(plan))
+
+    def testStateWriterBatches(self):
+        conn = self._connect('test.sqlite')
+        conn.execute('''CREATE TABLE Test (value INTEGER)''')
+        # Each write notes how many rows had been committed by then; only
+        # the writer thread uses this connection
+        reader = sqlite3.connect(os.path.join(self._tmpd, 'test.sqlite'), isolation_level=None, check_same_thread=False)
+        seen = []
+        def insert(cursor, value):
+            seen.append(reader.execute('''SELECT COUNT(*) FROM Test''').fetchone()[0])
+            cursor.execute('''INSERT INTO Test VALUES (?)''', (value,))
+        # Hold the writer until everything is queued
+        started = threading.Event()
+        release = threading.Event()
+        def block(cursor):
+            started.set()
+            release.wait(5)
+        max_batch = hotwire.state._writer_max_batch
+        hotwire.state._writer_max_batch = 10
+        try:
+            writer = StateWriter(os.path.join(self._tmpd, 'test.sqlite'))
+            writer.submit(block)
+            started.wait(5)
+            for i in range(35):
+                writer.submit(insert, i)
+            release.set()
+            writer.flush(5)
+        finally:
+            hotwire.state._writer_max_batch = max_batch
+        self.assertEquals([i - i % 10 for i in range(35)], seen)
+        self.assertEquals(range(35), [row[0] for row in conn.execute('''SELECT value FROM Test ORDER BY rowid''')])
+
+    def testStateWriterExit(self):
+        # Writes still queued at exit are committed
+        script = '''import os, sys
+import hotwire.state, hotwire.histimport
+hotwire.state._get_state_path = lambda name: os.path.join(sys.argv[1], name)
+hotwire.state._writer_batch_delay = 10
+hotwire.histimport.get_importers = lambda: []
+history = hotwire.state.History.getInstance()
+for i in range(100):
+    history.append_command('test', 'echo %d' % (i,), '/')
+'''
+        env = dict(os.environ)
+        pythonpath = [os.path.dirname(os.path.dirname(os.path.abspath(hotwire.__file__)))]
+        if 'PYTHONPATH' in env:
+            pythonpath.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(pythonpath)
+        self.assertEquals(0, subprocess.call([sys.executable, '-c', script, self._tmpd], env=env))
+        conn = self._connect('history.sqlite')
+        self.assertEquals(100, conn.execute('''SELECT COUNT(*) FROM Commands''').fetchone()[0])
+
+    def testStateWriterReads(self):
+        # Once flushed, writes are seen by the connection of any thread
+        history = self._new_history()
+        history.append_command('test', 'echo hello', '/')
+        history.flush(5)
+        self.assertEquals(['echo hello'], list(history.search_commands('test', 'hello')))
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(history.search_commands('test', 'hello')))
+        thread.start()
+        thread.join(5)
+        self.assertEquals(['echo hello'], results)
+        history.append_command('test', 'echo hello again', '/')
+        history.flush(5)
+        self.assertEquals(['echo hello again', 'echo hello'], list(history.search_commands('test', 'hello')))
+
+    def testPrefsWriteBehind(self):
+        prefs = Preferences()
+        prefs.set_pref('test.bool', True)
+        prefs.set_pref('test.text', 'hello')
+        prefs.set_pref('test.text', 'world')
+        prefs.set_pref('test.number', 2.5)
+        # Values are kept as sqlite returns them
+        self.assertEquals((1, int), (prefs.get_pref('test.bool'), type(prefs.get_pref('test.bool'))))
+        self.assertEquals((u'world', unicode), (prefs.get_pref('test.text'), type(prefs.get_pref('test.text'))))
+        self.assertRaises(sqlite3.InterfaceError, prefs.set_pref, 'test.list', [1])
+        self.assertEquals(None, prefs.get_pref('test.list'))
+        prefs.flush(5)
+        conn = self._connect('prefs.sqlite')
+        self.assertEquals([(u'test.bool', 1), (u'test.number', 2.5), (u'test.text', u'world')],
+                          conn.execute('''SELECT keyName, keyValue FROM Prefs ORDER BY keyName''').fetchall())
+
+    def testPrefsRestart(self):
+        prefs = Preferences()
+        for (key, value) in [('test.bool', False), ('test.text', 'hello'), ('test.number', 3)]:
+            prefs.set_pref(key, value)
+        prefs.flush(5)
+        restarted = Preferences()
+        for key in ('test.bool', 'test.text', 'test.number'):
+            value = prefs.get_pref(key)
+            self.assertEquals((value, type(value)), (restarted.get_pref(key), type(restarted.get_pref(key))))
+        self.assertEquals('default', restarted.get_pref('test.missing', 'default'))
+
 def suite():
     loader = unittest.TestLoader()
     loader.loadTestsFromTestCase(PipelineParserTests)
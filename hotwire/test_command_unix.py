@@ -82,6 +82,25 @@ class PipelineRunTestsUnix(PipelineRunTestFramework):
         results = list(p.get_output())
         self.assertEquals(len(results), 0)
 
+    def testParallelStreams(self):
+        p = Pipeline.parse("sys sh -c 'echo 1; sleep 3; echo 2' | filter -P .", self._context)
+        start = time.time()
+        p.execute()
+        output = iter(p.get_output())
+        self.assertEquals(output.next(), '1\n')
+        self.assert_(time.time() - start < 2)
+        self.assertEquals(list(output), ['2\n'])
+
+    def testFusedStreams(self):
+        p = Pipeline.parse("sys sh -c 'echo 1; sleep 3; echo 2' | py-map it | py-map it", self._context)
+        self.assertEquals(len(p.get_plan()), 2)
+        start = time.time()
+        p.execute()
+        output = iter(p.get_output())
+        self.assertEquals(output.next(), '1\n')
+        self.assert_(time.time() - start < 2)
+        self.assertEquals(list(output), ['2\n'])
+
     def testRedir1(self):
         self._setupTree2()
         outpath = path_join(self._tmpd, 'redirtest.txt')
@@ -95,6 +114,18 @@ class PipelineRunTestsUnix(PipelineRunTestFramework):
         self.assertEquals(os.access(newoutpath, os.R_OK), True)
         same_testdata = open(newoutpath).read()
         self.assertEquals(same_testdata, testdata)
+
+    def testRedirBinary(self):
+        # Redirected data is passed through untouched, even if it isn't text
+        self._setupTree2()
+        testdata = ''.join(map(chr, range(256))) * 64
+        f = open(path_join(self._tmpd, 'redirtest.bin'), 'wb')
+        f.write(testdata)
+        f.close()
+        p = Pipeline.parse("sys cat < redirtest.bin > same_redirtest.bin", self._context)
+        p.execute_sync()
+        same_testdata = open(path_join(self._tmpd, 'same_redirtest.bin'), 'rb').read()
+        self.assertEquals(same_testdata, testdata)
         
     def testCatBinCat(self):
         self._setupTree1()
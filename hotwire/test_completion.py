@@ -196,3 +196,22 @@ class CompletionTests(unittest.TestCase):
         self.assertEquals(result.results[0].target.path, dpath)
         self.assertEquals(result.results[0].suffix, r'r\ with\ spaces/')        
 
+
+    def testPathVerbs(self):
+        self._setupTree1()
+        oldpath = os.environ['PATH']
+        os.environ['PATH'] = self._tmpd
+        try:
+            verbs = [x for x in self.vc.completions('tes', self._tmpd) if not x.target.is_directory]
+            self.assertEquals(len(verbs), 1)
+            self.assertEquals(verbs[0].target.path, self._test_exe_path)
+            if is_unix():
+                # A new executable must be picked up
+                newpath = path_join(self._tmpd, 'testnew')
+                open(newpath, 'w').close()
+                os.chmod(newpath, 0744)
+                os.utime(self._tmpd, (0, 0))
+                verbs = [x for x in self.vc.completions('tes', self._tmpd) if not x.target.is_directory]
+                self.assertEquals(len(verbs), 2)
+        finally:
+            os.environ['PATH'] = oldpath
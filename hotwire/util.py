@@ -45,6 +45,21 @@ def markup_for_match(text, start, end, matchtarget=None):
                                  escape_xml(source[start:end]),
                                  escape_xml(source[end:]),
                                  matchtarget and (' - <i>' + text + '</i>') or '')
+
+def markup_for_positions(text, positions):
+    """Return markup for text with the characters at the given indexes in bold."""
+    positions = set(positions)
+    result = []
+    start = 0
+    while start < len(text):
+        matched = start in positions
+        end = start + 1
+        while end < len(text) and (end in positions) == matched:
+            end += 1
+        chunk = escape_xml(text[start:end])
+        result.append(matched and ('<b>%s</b>' % (chunk,)) or chunk)
+        start = end
+    return ''.join(result)
     
 
 
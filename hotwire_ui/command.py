@@ -81,6 +81,7 @@ class CommandExecutionHeader(gtk.VBox):
         
         dispatcher.connect(self.__on_pipeline_state_change, 'state-changed', self.__pipeline)
         dispatcher.connect(self.__on_pipeline_metadata, 'metadata', self.__pipeline)
+        dispatcher.connect(self.__on_pipeline_profile, 'profile', self.__pipeline)
         
         self.__main_hbox = gtk.HBox()
         self.pack_start(self.__main_hbox, expand=True)
@@ -117,6 +118,12 @@ class CommandExecutionHeader(gtk.VBox):
         self.__action.connect("clicked", self.__on_action)
         self.__statusbox.pack_start(hotwidgets.Align(self.__action), expand=False)          
         self.__statusbox.pack_start(hotwidgets.Align(self.__status_right), expand=False)        
+        self.__profile_ebox = gtk.EventBox()
+        self.__profile_ebox.set_visible_window(False)
+        self.__profile_label = gtk.Label()
+        self.__profile_ebox.add(self.__profile_label)
+        self.__statusbox.pack_start(hotwidgets.Align(self.__profile_ebox, padding_left=8), expand=False)
+        self.__profile_ebox.set_no_show_all(True)
         
         self.__undoable = self.__pipeline.get_undoable() and (not self.__pipeline.get_idempotent())
 
@@ -315,6 +322,9 @@ class CommandExecutionHeader(gtk.VBox):
         if key == 'hotwire.status':
             self.__handle_status(cmdidx, meta)
             return
+        if key == 'hotwire.profile':
+            self.__handle_profile(meta)
+            return
         
     def __handle_basedir(self, cmdidx, meta):
         _logger.debug("got basedir %s", meta)
@@ -325,6 +335,22 @@ class CommandExecutionHeader(gtk.VBox):
         statusdisp.set_status(*meta)
         self.__update_titlebox()
 
+    def __on_pipeline_profile(self, profiles, sender=None):
+        self.__handle_profile(profiles)
+
+    def __handle_profile(self, profiles):
+        rates = []
+        details = []
+        for profile in profiles:
+            rates.append(_('%s %d/s') % (profile.name, profile.output_rate))
+            details.append(_('%s: %d in, %d out, %.2fs waiting for input, %.2fs for output') \
+                           % (profile.command, profile.objects_in, profile.objects_out,
+                              profile.input_wait, profile.output_wait))
+        self.__profile_label.set_text(' | '.join(rates))
+        self.__tooltips.set_tip(self.__profile_ebox, '\n'.join(details))
+        self.__profile_label.show()
+        self.__profile_ebox.show()
+
     def __isexecuting(self):
         state = self.__pipeline.get_state()           
         return (state == 'executing' or (state == 'complete' and not self.__primary_complete))
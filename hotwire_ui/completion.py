@@ -362,6 +362,7 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         self.__token = None
         self.__completer = None
         self.__complsys = CompletionSystem()
+        self.__completion_serial = None
         self.__current_completion = None
         self.__current_history = None
         self.__pending_completion_load = False
@@ -421,8 +422,12 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         self.invalidate()
         self.__token = text
         self.__completer = completer
+        # A queued request for the previous token is no longer needed
+        if self.__completion_serial is not None:
+            self.__complsys.cancel(self.__completion_serial)
+            self.__completion_serial = None
         if completer:
-            self.__complsys.async_complete(completer, text, context.get_cwd(), self.__completions_result)
+            self.__completion_serial = self.__complsys.async_complete(completer, text, context.get_cwd(), self.__completions_result)
         
     def completion_request(self):      
         if self.__current_completion is not None:
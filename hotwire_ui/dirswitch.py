@@ -25,7 +25,7 @@ from hotwire.logutil import log_except
 import hotwire_ui.widgets as hotwidgets
 from hotwire_ui.pixbufcache import PixbufCache
 from hotwire.state import History
-from hotwire.util import markup_for_match
+from hotwire.util import markup_for_match, markup_for_positions
 from hotwire_ui.quickfind import QuickFindWindow
 
 _logger = logging.getLogger("hotwire.ui.DirSwitch")
@@ -37,10 +37,5 @@ class DirSwitchWindow(QuickFindWindow):
 
     def _do_search(self, text):
         hist = History.getInstance()
-        text_lower = text.lower()
-        for usage in hist.search_dir_usage(text):
-            v = usage[0]
-            v_lower = v.lower()
-            markup = self._markup_search(v, text, v_lower, text_lower)
-            if markup is not None:      
-                yield (v, markup, 'gtk-directory')
+        for (path, score, positions) in hist.search_dir_usage(text):
+            yield (path, markup_for_positions(path, positions), 'gtk-directory')
@@ -0,0 +1,222 @@
+# This file is part of the Hotwire Shell user interface.
+#   
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import logging, operator, itertools
+from array import array
+
+import gtk, gobject
+
+_logger = logging.getLogger("hotwire.ui.ObjectModel")
+
+# Minimum delay before sorting newly appended rows into place, in milliseconds;
+# this grows with the number of rows, since each merge touches all of them.
+_merge_delay = 500
+_merge_rows_per_ms = 1000
+
+class ObjectListModel(gtk.GenericTreeModel):
+    """A list model holding Python objects, which only creates tree rows as
+the view asks for them.
+
+Sorting is done by key functions, each called once per row (keys are cached
+until the sort column changes), and is represented as an array of object
+indices in display order.  While a sort
+is active, appended rows are shown at the end and periodically merged
+into place."""
+    def __init__(self, ncolumns=1):
+        gtk.GenericTreeModel.__init__(self)
+        self.props.leak_references = False
+        self.__ncolumns = ncolumns
+        # With one column, rows are the objects themselves; otherwise tuples
+        self.__rows = []
+        # Object indices in display order for the first len(__order) rows;
+        # rows beyond that are shown in the order they were appended
+        self.__order = array('l')
+        self.__sort_keys = {}
+        # Sort keys by object index, for the column in __keys_column
+        self.__keys = []
+        self.__keys_column = None
+        self.__sort_column = None
+        self.__sort_order = gtk.SORT_ASCENDING
+        self.__merge_id = 0
+
+    def append(self, row):
+        if self.__ncolumns == 1:
+            self.__rows.append(row[0])
+        else:
+            self.__rows.append(tuple(row))
+        pos = len(self.__rows) - 1
+        path = (pos,)
+        self.row_inserted(path, self.get_iter(path))
+        if self.__sort_column is not None:
+            self.__queue_merge()
+
+    def clear(self):
+        if self.__merge_id:
+            gobject.source_remove(self.__merge_id)
+            self.__merge_id = 0
+        # Store the rows in display order, so each can be removed from the
+        # end before it is signalled
+        self.__rows = [self.__row_at(pos) for pos in xrange(len(self.__rows))]
+        self.__order = array('l')
+        self.__keys = []
+        while self.__rows:
+            self.__rows.pop()
+            self.row_deleted((len(self.__rows),))
+
+    def __row_at(self, pos):
+        if pos < len(self.__order):
+            return self.__rows[self.__order[pos]]
+        return self.__rows[pos]
+
+    def iter_objects(self):
+        """Generate the first column of each row, in display order."""
+        for pos in xrange(len(self.__rows)):
+            row = self.__row_at(pos)
+            if self.__ncolumns == 1:
+                yield row
+            else:
+                yield row[0]
+
+    def find_obj(self, obj, colidx=0):
+        """Return an iterator for the first row holding obj in column colidx,
+        or None."""
+        if self.__ncolumns == 1:
+            values = self.__rows
+        else:
+            values = [row[colidx] for row in self.__rows]
+        try:
+            idx = values.index(obj)
+        except ValueError, e:
+            return None
+        if idx < len(self.__order):
+            pos = self.__order.index(idx)
+        else:
+            pos = idx
+        return self.get_iter((pos,))
+
+    def set_sort_key_func(self, column_id, keyfunc, idx=0):
+        """Sort by keyfunc(value of column idx) when column_id is chosen."""
+        self.__sort_keys[column_id] = (keyfunc, idx)
+        if column_id == self.__keys_column:
+            self.__keys_column = None
+
+    def get_sort_column_id(self):
+        return (self.__sort_column, self.__sort_order)
+
+    def set_sort_column_id(self, column_id, order):
+        """Sort rows by the key function for column_id, or in the order they
+        were appended if column_id is None."""
+        self.__sort_column = column_id
+        self.__sort_order = order
+        self.__sort()
+
+    def __queue_merge(self):
+        if self.__merge_id == 0:
+            delay = max(_merge_delay, len(self.__rows) // _merge_rows_per_ms)
+            self.__merge_id = gobject.timeout_add(delay, self.__idle_merge, priority=gobject.PRIORITY_LOW)
+
+    def __idle_merge(self):
+        self.__merge_id = 0
+        self.__sort()
+        return False
+
+    def __sort(self):
+        if self.__merge_id:
+            gobject.source_remove(self.__merge_id)
+            self.__merge_id = 0
+        count = len(self.__rows)
+        if count < 2:
+            return
+        # Object indices in the current display order
+        displayed = self.__order.tolist() + range(len(self.__order), count)
+        if self.__sort_column is None:
+            keys = displayed
+        else:
+            if self.__keys_column != self.__sort_column:
+                self.__keys = []
+                self.__keys_column = self.__sort_column
+            (keyfunc, idx) = self.__sort_keys[self.__sort_column]
+            # Only rows appended since the last merge need keys
+            for row in itertools.islice(self.__rows, len(self.__keys), None):
+                if self.__ncolumns == 1:
+                    self.__keys.append(keyfunc(row))
+                else:
+                    self.__keys.append(keyfunc(row[idx]))
+            # In display order, so the existing sorted run is kept and the
+            # sort only merges the new tail into it
+            keys = operator.itemgetter(*displayed)(self.__keys)
+        new_order = range(count)
+        new_order.sort(key=keys.__getitem__, reverse=(self.__sort_order == gtk.SORT_DESCENDING))
+        if self.__sort_column is None:
+            self.__order = array('l')
+        else:
+            self.__order = array('l', operator.itemgetter(*new_order)(displayed))
+        self.rows_reordered(None, None, new_order)
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return self.__ncolumns
+
+    def on_get_column_type(self, n):
+        return gobject.TYPE_PYOBJECT
+
+    # Row references are display positions.
+    def on_get_iter(self, path):
+        pos = path[0]
+        if pos < len(self.__rows):
+            return pos
+        return None
+
+    def on_get_path(self, pos):
+        return (pos,)
+
+    def on_get_value(self, pos, column):
+        row = self.__row_at(pos)
+        if self.__ncolumns == 1:
+            return row
+        return row[column]
+
+    def on_iter_next(self, pos):
+        pos += 1
+        if pos < len(self.__rows):
+            return pos
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self.__rows:
+            return 0
+        return None
+
+    def on_iter_has_child(self, pos):
+        return False
+
+    def on_iter_n_children(self, pos):
+        if pos is None:
+            return len(self.__rows)
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.__rows):
+            return n
+        return None
+
+    def on_iter_parent(self, child):
+        return None
@@ -16,7 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os,sys,re,Queue,logging,inspect,locale
+import os,sys,re,Queue,logging,inspect,locale,time
 
 import gtk, gobject, pango
 
@@ -28,6 +28,39 @@ import hotwire_ui.widgets as hotwidgets
 
 _logger = logging.getLogger("hotwire.ui.ODisp")
 
+# Time to spend appending output per main loop iteration, in seconds
+_drain_frame_budget = 0.025
+_drain_min_batch = 16
+_drain_max_batch = 8192
+# Delay before handling newly queued output, in milliseconds
+_drain_delay = 50
+
+class DrainScheduler(object):
+    """Chooses how many objects to append per main loop iteration, adapting
+to their measured cost so that each batch stays within the frame budget."""
+
+    batch_size = property(lambda self: self.__batch_size, doc="""Number of objects to take next.""")
+
+    def __init__(self, budget=_drain_frame_budget):
+        super(DrainScheduler, self).__init__()
+        self.__budget = budget
+        self.__batch_size = 100
+
+    def update(self, count, elapsed):
+        """Note that appending count objects took elapsed seconds."""
+        if count == 0:
+            return
+        if elapsed > 0:
+            ideal = int(count * self.__budget / elapsed)
+        else:
+            ideal = self.__batch_size * 2
+        if count < self.__batch_size and ideal > self.__batch_size:
+            # The queue ran dry, so this says nothing about a bigger batch
+            return
+        # Grow gradually, but shrink right away
+        ideal = min(ideal, self.__batch_size * 2)
+        self.__batch_size = max(_drain_min_batch, min(_drain_max_batch, ideal))
+
 class ObjectsDisplay(gtk.VBox):
     __gsignals__ = {
         "object-input" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
@@ -52,6 +85,8 @@ class ObjectsDisplay(gtk.VBox):
         self.__doing_autoscroll = False
         self.__user_scrolled = False
         self.__autoscroll_id = 0
+        self.__batching = False
+        self.__batch_status_changed = False
         self._common_supertype = None
 
     def __add_display(self, output_spec, force=False):
@@ -67,6 +102,9 @@ class ObjectsDisplay(gtk.VBox):
             self.__output_type = output_spec
             
     def __on_status_changed(self, renderer):
+        if self.__batching:
+            self.__batch_status_changed = True
+            return
         self.emit('status-changed')
         self.do_autoscroll()
 
@@ -188,6 +226,18 @@ class ObjectsDisplay(gtk.VBox):
             kwargs['fmt'] = fmt
         self.__display.append_obj(obj, **kwargs)
             
+    def append_objects(self, objs, fmt=None, **kwargs):
+        """Append each of objs, signalling any status change once at the end."""
+        self.__batching = True
+        self.__batch_status_changed = False
+        try:
+            for obj in objs:
+                self.append_object(obj, fmt=fmt, **kwargs)
+        finally:
+            self.__batching = False
+        if self.__batch_status_changed:
+            self.emit('status-changed')
+            
     def __vadjust(self, pos, full, forceuser=False):
         adjustment = self.__scroll.get_vadjustment()
         if not full:
@@ -247,6 +297,7 @@ class MultiObjectsDisplay(gtk.Notebook):
         self.__queues = {}
         self.__ocount = 0
         self.__do_autoswitch = True
+        self.__drain = DrainScheduler()
         self.__suppress_noyield = not not list(pipeline.get_status_commands())
         self.set_show_tabs(False)
 
@@ -323,7 +374,7 @@ class MultiObjectsDisplay(gtk.Notebook):
         else:
             odisp = None
         self.__queues[queue] = (odisp, name, merged)
-        queue.connect(self.__idle_handle_output, priority=gobject.PRIORITY_LOW)
+        queue.connect(self.__idle_handle_output, delay=_drain_delay, priority=gobject.PRIORITY_LOW)
 
     def cancel(self):
         self.__cancelled = True
@@ -349,54 +400,50 @@ class MultiObjectsDisplay(gtk.Notebook):
         if self.__cancelled:
             _logger.debug("cancelled")
             return False
-        empty = False
-        changed = False
         (odisp, name, merged) = self.__queues[queue]
-        odisp_displayed = odisp in self.get_children()
-        active_odisp = False
-        maxitems = 100
-        i = 0
-        append_kwargs = {}
-        if queue.opt_type:
-            append_kwargs['fmt'] = queue.opt_type
+        starttime = time.time()
+        batch_size = self.__drain.batch_size
         try:
-            while i < maxitems:
-                i += 1
-                item = queue.get(False)
-                changed = True
-                if item is None:
-                    if name is None:
-                        self.emit("primary-complete")
-                    empty = True
-                    queue.disconnect()
-                    break
-                _logger.debug("appending item: %s", item)
-                if odisp:
-                    if not odisp_displayed:
-                        self.append_page(odisp)
-                        odisp.show_all()
-                        self.set_tab_label_text(odisp, name or 'Default')
-                        self.set_show_tabs(True)
-                        odisp_displayed = True
-                    odisp.append_object(item, **append_kwargs)
-                    self.__ocount += 1
-                    if self.__do_autoswitch:
-                        self.set_current_page(self.page_num(odisp))
-                        self.__do_autoswitch = False
-                    active_odisp = True
-                else:
-                    _logger.warn("Unexpected item %s from queue %s", item, name)
+            items = queue.get_many(batch_size, False)
         except Queue.Empty:
-            pass
+            return False
+        empty = False
+        for i,item in enumerate(items):
+            if item is None:
+                empty = True
+                items = items[:i]
+                break
+        active_odisp = False
+        if items:
+            if odisp:
+                if odisp not in self.get_children():
+                    self.append_page(odisp)
+                    odisp.show_all()
+                    self.set_tab_label_text(odisp, name or 'Default')
+                    self.set_show_tabs(True)
+                append_kwargs = {}
+                if queue.opt_type:
+                    append_kwargs['fmt'] = queue.opt_type
+                odisp.append_objects(items, **append_kwargs)
+                self.__ocount += len(items)
+                if self.__do_autoswitch:
+                    self.set_current_page(self.page_num(odisp))
+                    self.__do_autoswitch = False
+                active_odisp = True
+            else:
+                _logger.warn("Unexpected items from queue %s", name)
         if empty:
+            if name is None:
+                self.emit("primary-complete")
+            queue.disconnect()
             del self.__queues[queue]
         if active_odisp:
             odisp.do_autoscroll()
-        if changed:
-            self.emit("changed")
-        readd_idle = (not empty) and (i == maxitems)
-        _logger.debug("doing idle readd: %s", readd_idle)
-        return readd_idle
+        self.emit("changed")
+        self.__drain.update(len(items), time.time() - starttime)
+        more = (not empty) and len(items) == batch_size
+        _logger.debug("appended %d items, more: %s", len(items), more)
+        return more
 
     def scroll_up(self, full=False):
         self.get_nth_page(self.get_current_page()).scroll_up(full)
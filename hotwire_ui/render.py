@@ -23,6 +23,7 @@ import gtk, gobject
 import hotwire
 from hotwire.externals.singletonmixin import Singleton
 from hotwire_ui.pixbufcache import PixbufCache
+from hotwire_ui.objectmodel import ObjectListModel
 import hotwire_ui.widgets as hotwidgets
 
 _logger = logging.getLogger("hotwire.ui.Render")
@@ -104,8 +105,10 @@ class TreeObjectsRenderer(ObjectsRenderer):
         else:
             ctypes = [gobject.TYPE_PYOBJECT]
         self.context = context
-        self._liststore = gtk.ListStore(*ctypes)
-        self._model = gtk.TreeModelSort(self._liststore)
+        # Rows and sorting are held in one model; _liststore is kept as an
+        # alias for renderers which append to it directly.
+        self._model = ObjectListModel(len(ctypes))
+        self._liststore = self._model
         self._table = gtk.TreeView(self._model)
         #self._table.unset_flags(gtk.CAN_FOCUS)        
         self._table.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
@@ -139,11 +142,7 @@ class TreeObjectsRenderer(ObjectsRenderer):
         return self._table
 
     def get_objects(self):
-        iter = self._model.get_iter_first()
-        while iter:
-            val = self._model.get_value(iter, 0)
-            yield val
-            iter = self._model.iter_next(iter)
+        return self._model.iter_objects()
             
     def get_selected_objects(self):
         (model, rows) = self._table.get_selection().get_selected_rows()
@@ -160,7 +159,7 @@ class TreeObjectsRenderer(ObjectsRenderer):
     def _insert_column(self, name, proptype=None,
                          title=None, renderer=None, 
                          renderfunc=None, idx=0,
-                         valuefunc=None, sortfunc=None, **kwargs):
+                         valuefunc=None, sortkey=None, **kwargs):
         if title is None:
             target_title = (name[0].upper() + name[1:])
         else:
@@ -172,13 +171,33 @@ class TreeObjectsRenderer(ObjectsRenderer):
         col.set_data('hotwire-propname', name)
         col.set_data('hotwire-proptype', proptype)
         col.set_resizable(True)
-        col.set_sort_column_id(colidx - 1)        
-        if sortfunc:
-            self._model.set_sort_func(colidx-1, sortfunc)
-        else:
-            self._model.set_sort_func(colidx-1, self._default_compare, (idx, valuefunc or (lambda x: getattr(x, name))))
+        col.set_clickable(True)
+        col.connect('clicked', self.__on_column_clicked, colidx-1)
+        if not sortkey:
+            valuefunc = valuefunc or (lambda x: getattr(x, name))
+            def sortkey(obj):
+                # Rows without an object sort last
+                if obj is None:
+                    return (True, None)
+                return (False, valuefunc(obj))
+        self._model.set_sort_key_func(colidx-1, sortkey, idx)
         return col        
 
+    def _set_sort_column(self, colid, order):
+        for i,col in enumerate(self._table.get_columns()):
+            col.set_sort_indicator(i == colid)
+            if i == colid:
+                col.set_sort_order(order)
+        self._model.set_sort_column_id(colid, order)
+
+    def __on_column_clicked(self, col, colid):
+        (cur_colid, cur_order) = self._model.get_sort_column_id()
+        if cur_colid == colid and cur_order == gtk.SORT_ASCENDING:
+            order = gtk.SORT_DESCENDING
+        else:
+            order = gtk.SORT_ASCENDING
+        self._set_sort_column(colid, order)
+
     def _insert_proptext(self, name, title=None, **kwargs):
         return self._insert_column(name, proptype=unicode, title=title, renderfunc=self._render_proptext, **kwargs)
 
@@ -192,18 +211,6 @@ class TreeObjectsRenderer(ObjectsRenderer):
                 return column
         raise KeyError(name)
 
-    def _default_compare(self, model, iter1, iter2, args):
-        (idx, value_func) = args        
-        obj1 = model.get_value(iter1, idx)
-        obj2 = model.get_value(iter2, idx)
-        if obj1 is None and obj2 is not None:
-            return 1
-        elif obj1 is not None and obj2 is None:
-            return -1
-        value1 = value_func(obj1)
-        value2 = value_func(obj2)
-        return cmp(value1, value2)
-
     def _set_search_column(self, col):
         colidx = -1
         for i,c in enumerate(self._table.get_columns()):
@@ -257,12 +264,7 @@ class TreeObjectsRenderer(ObjectsRenderer):
         return True
 
     def _findobj(self, obj, colidx=0):
-        iter = self._model.get_iter_first()
-        while iter:
-            val = self._model.get_value(iter, colidx)
-            if val == obj:
-                return iter
-            iter = self._model.iter_next(iter)
+        return self._model.find_obj(obj, colidx)
 
     def _signal_obj_changed(self, obj, colidx=0):
         iter = self._findobj(obj, colidx=colidx)
@@ -364,6 +366,7 @@ import hotwire_ui.renderers.dict
 import hotwire_ui.renderers.filestringmatch
 import hotwire_ui.renderers.help
 import hotwire_ui.renderers.list
+import hotwire_ui.renderers.profile
 import hotwire_ui.renderers.ps
 import hotwire_ui.renderers.unicode
 #moddir = hotwire.ModuleDir(os.path.join(os.path.dirname(hotwire.__file__), 'renderers'))
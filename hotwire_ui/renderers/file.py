@@ -65,21 +65,12 @@ class FilePathRenderer(TreeObjectsRenderer):
         # return value intentionally reversed
         return not matches
 
-    def __compare_paths(self, model, iter1, iter2):
-        ob1 = self._file_for_iter(model, iter1)
-        ob2 = self._file_for_iter(model, iter2)
-
+    def __path_sortkey(self, fobj):
         # fixme: I guess this check shouldn't be necessary here
-        if (ob1 == None or ob2 == None):
-            return 0
-        
-        if (self.__folders_before_files):
-            if (ob1.is_directory and (not ob2.is_directory)):
-                return -1
-            if (ob2.is_directory and (not ob1.is_directory)):
-                return 1
-        
-        return cmp(ob1.path.lower(), ob2.path.lower())          
+        if fobj is None:
+            return (True, True, u'')
+        folders_first = self.__folders_before_files and fobj.is_directory
+        return (False, not folders_first, fobj.path.lower())          
 
     def _setup_view_columns(self):
         prefs = Preferences.getInstance()
@@ -92,7 +83,7 @@ class FilePathRenderer(TreeObjectsRenderer):
 
         self._insert_column('icon', title='', renderfunc=self._render_icon, renderer=gtk.CellRendererPixbuf(), valuefunc=lambda x: x.mimetype)
         self._insert_column('path', title=_('Path'), renderfunc=self._render_path,
-                                    sortfunc=self.__compare_paths, 
+                                    sortkey=self.__path_sortkey, 
                                     family='Monospace')
         self._insert_column('size', title=_('Size'), renderfunc=self._render_size, family='Monospace')
         self._insert_column('last_modified', title=_('Last Modified'), renderfunc=self._render_last_modified, family='Monospace',
@@ -109,7 +100,7 @@ class FilePathRenderer(TreeObjectsRenderer):
                             family='Monospace')
         
         # Sort on path by default
-        self._model.set_sort_column_id(1, gtk.SORT_ASCENDING)        
+        self._set_sort_column(1, gtk.SORT_ASCENDING)        
         
         self.__sync_visible_columns()
 
@@ -319,7 +310,7 @@ class FilePathRenderer(TreeObjectsRenderer):
         prefs = Preferences.getInstance()
         self.__folders_before_files = prefs.get_pref('hotwire.ui.render.File.general.foldersbeforefiles', default=True)
         # Redo sort
-        self._model.set_sort_column_id(1, gtk.SORT_ASCENDING)        
+        self._set_sort_column(1, gtk.SORT_ASCENDING)        
 
 ClassRendererMapping.getInstance().register(File, FilePathRenderer)
 ClassRendererMapping.getInstance().register(FilePath, FilePathRenderer)
@@ -0,0 +1,34 @@
+# This file is part of the Hotwire Shell user interface.
+#   
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from hotwire_ui.render import ClassRendererMapping, TreeObjectsRenderer
+from hotwire.command import CommandProfile
+
+class CommandProfileRenderer(TreeObjectsRenderer):
+    def _setup_view_columns(self):
+        cmdcol = self._insert_proptext('command', title=_('Command'), ellipsize=False)
+        self._insert_propcol('objects_in', title=_('In'), ellipsize=False)
+        self._insert_propcol('objects_out', title=_('Out'), ellipsize=False)
+        self._insert_propcol('wall_time', title=_('Time'), ellipsize=False)
+        self._insert_propcol('cpu_time', title=_('CPU'), ellipsize=False)
+        self._insert_propcol('input_wait', title=_('Input Wait'), ellipsize=False)
+        self._insert_propcol('output_wait', title=_('Output Wait'), ellipsize=False)
+        self._insert_propcol('peak_queue_depth', title=_('Peak Queue'), ellipsize=False)
+        self._set_search_column(cmdcol)
+
+ClassRendererMapping.getInstance().register(CommandProfile, CommandProfileRenderer)
@@ -16,7 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os,sys,logging,locale,codecs,gettext
+import os,sys,logging,locale,codecs,gettext,tempfile
 
 # Older webbrowser.py didn't check gconf
 from hotwire.sysdep import is_windows
@@ -31,12 +31,72 @@ import hotwire
 from hotwire.sysdep import is_unix, is_windows
 from hotwire.text import MarkupText
 from hotwire.logutil import log_except
+from hotwire.state import Preferences
 import hotwire_ui.widgets as hotwidgets
 from hotwire_ui.inlinesearch import InlineSearchArea
 from hotwire_ui.render import ObjectsRenderer, ClassRendererMapping
 
 _logger = logging.getLogger("hotwire.ui.render.Unicode")
 
+# Text arriving within this many milliseconds is inserted into the buffer at once
+_flush_delay = 40
+# Characters kept in the text buffer before older lines are moved to disk;
+# overridden by the hotwire.ui.render.Unicode.general.maxchars preference
+_default_max_chars = 4*1024*1024
+# Characters read back from disk at a time when scrolling to the top
+_page_in_chars = 256*1024
+
+class SpillFile(object):
+    """Holds text trimmed from the start of a buffer, oldest first, as a
+stack of UTF-8 chunks in an anonymous temporary file."""
+    def __init__(self):
+        self.__f = None
+        # (file offset, byte length, char length) of each chunk
+        self.__chunks = []
+        self.__charcount = 0
+
+    charcount = property(lambda self: self.__charcount)
+
+    def __len__(self):
+        return len(self.__chunks)
+
+    def push(self, text):
+        if self.__f is None:
+            self.__f = tempfile.TemporaryFile(prefix='hotwire-output')
+        data = text.encode('utf-8')
+        if self.__chunks:
+            (offset, bytelen, charlen) = self.__chunks[-1]
+            offset += bytelen
+        else:
+            offset = 0
+        self.__f.seek(offset)
+        self.__f.write(data)
+        self.__chunks.append((offset, len(data), len(text)))
+        self.__charcount += len(text)
+
+    def __read(self, offset, bytelen):
+        self.__f.seek(offset)
+        return self.__f.read(bytelen).decode('utf-8')
+
+    def pop(self):
+        """Remove and return the newest chunk."""
+        (offset, bytelen, charlen) = self.__chunks.pop()
+        text = self.__read(offset, bytelen)
+        self.__f.truncate(offset)
+        self.__charcount -= charlen
+        return text
+
+    def iter_chunks(self):
+        for (offset, bytelen, charlen) in list(self.__chunks):
+            yield self.__read(offset, bytelen)
+
+    def close(self):
+        if self.__f is not None:
+            self.__f.close()
+            self.__f = None
+        self.__chunks = []
+        self.__charcount = 0
+
 class InputArea(gtk.HBox):
     __gsignals__ = {
         "close" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, []),
@@ -124,6 +184,7 @@ class UnicodeRenderer(ObjectsRenderer):
         if monospace:
             self.__text.modify_font(pango.FontDescription("monospace"))
         self.__text.connect('event-after', self.__on_event_after)
+        self.__text.connect('set-scroll-adjustments', self.__on_set_scroll_adjustments)
         self._buf.connect('mark-set', self.__on_mark_set)
         self.__term = None
         self.__wrap_lines = True
@@ -139,8 +200,9 @@ class UnicodeRenderer(ObjectsRenderer):
         else:
             (lcode, locale_encoding) = locale.getdefaultlocale()
             if locale_encoding and locale_encoding.lower() == 'utf-8':
-                # This is the ideal, running on a UTF-8 system.
-                self.__locale_decoder = None
+                # This is the ideal, running on a UTF-8 system.  We still
+                # decode here, since chunks are joined before insertion.
+                self.__locale_decoder = codecs.getincrementaldecoder('utf-8')('replace')
             else:
                 if not locale_encoding:
                     _logger.debug("No locale set: using C locale")
@@ -152,6 +214,14 @@ class UnicodeRenderer(ObjectsRenderer):
         # and then poll it here for maximum efficiency. 
         self.__subproc_fd = None
         self.__subproc_stream = None
+
+        # Appended text and MarkupText waiting for the next flush
+        self.__pending = []
+        self.__flush_id = 0
+        prefs = Preferences.getInstance()
+        self.__max_chars = prefs.get_pref('hotwire.ui.render.Unicode.general.maxchars', default=_default_max_chars)
+        self.__spill = SpillFile()
+        self.__page_in_id = 0
         
         self._buf.insert_markup("<i>(No output)</i>")
         self.__search = InlineSearchArea(self.__text)
@@ -190,6 +260,7 @@ class UnicodeRenderer(ObjectsRenderer):
                 break
 
     def append_link(self, text, target):
+        self.__flush()
         self.__links[text] = target
         if not self.__support_links:
             self.__install_link_handlers()
@@ -240,10 +311,11 @@ class UnicodeRenderer(ObjectsRenderer):
         return self.__search
 
     def get_status_str(self):
+        self.__flush()
         if self.__empty:
             charcount = 0
         else:
-            charcount = self._buf.get_char_count()
+            charcount = self.__spill.charcount + self._buf.get_char_count()
         return gettext.ngettext('%d character' % (charcount,), '%d characters' % (charcount,), charcount)
 
     def __get_objects_from_iters(self, start, end):
@@ -264,8 +336,26 @@ class UnicodeRenderer(ObjectsRenderer):
             yield self._buf.get_slice(startline, iter)
 
     def get_objects(self):
+        self.__flush()
+        # Spilled text is always trimmed at line boundaries, except for a
+        # line longer than the whole buffer; carry any partial line over.
+        partial = u''
+        for chunk in self.__spill.iter_chunks():
+            lines = (partial + chunk).splitlines(True)
+            if lines and not lines[-1].endswith('\n'):
+                partial = lines.pop()
+            else:
+                partial = u''
+            for line in lines:
+                yield line
+        first = True
         for o in self.__get_objects_from_iters(self._buf.get_start_iter(), self._buf.get_end_iter()):
+            if first and partial:
+                o = partial + o
+                first = False
             yield o
+        if first and partial:
+            yield partial
     
     def get_selected_objects(self):
         bounds = self._buf.get_selection_bounds()
@@ -282,19 +372,109 @@ class UnicodeRenderer(ObjectsRenderer):
         
     def __append_locale_chunk(self, obj, flush=False):
         if self.__locale_decoder is None:
-            self.__append_chunk(obj)
+            self.__append_chunk(obj.decode('utf-8', 'replace'))
         else:
             decoded = self.__locale_decoder.decode(obj, flush)
             self.__append_chunk(decoded)
 
     def __append_chunk(self, obj):
+        if not obj:
+            return
+        self.__pending.append(obj)
+        if self.__flush_id == 0:
+            self.__flush_id = gobject.timeout_add(_flush_delay, self.__idle_flush)
+
+    def __idle_flush(self):
+        self.__flush_id = 0
+        self.__flush()
+        return False
+
+    def __insert_markup_text(self, obj):
+        buf = self._buf
+        prev_tagend = 0
+        olen = len(obj)
+        for (tagname, start, end) in obj.markup:
+           buf.insert(buf.get_end_iter(), obj[prev_tagend:start])
+           real_end = (end == -1) and olen or end
+           buf.insert_with_tags_by_name(buf.get_end_iter(), obj[start:real_end], tagname)
+           prev_tagend = real_end
+        buf.insert(buf.get_end_iter(), obj[prev_tagend:])
+
+    def __flush(self):
+        """Insert pending text into the buffer, joining runs of plain text
+        into a single insertion."""
+        if self.__flush_id:
+            gobject.source_remove(self.__flush_id)
+            self.__flush_id = 0
+        if not self.__pending:
+            return
+        pending = self.__pending
+        self.__pending = []
         buf = self._buf
         if self.__empty:
             buf.delete(buf.get_start_iter(), buf.get_end_iter())
             self.__empty = False
-        buf.insert(buf.get_end_iter(), obj)
+        text = []
+        for obj in pending:
+            if isinstance(obj, MarkupText):
+                if text:
+                    buf.insert(buf.get_end_iter(), u''.join(text))
+                    text = []
+                self.__insert_markup_text(obj)
+            else:
+                text.append(obj)
+        if text:
+            buf.insert(buf.get_end_iter(), u''.join(text))
+        self.__trim()
         self.emit('status-changed')
 
+    def __trim(self):
+        """Move the oldest lines to the spill file if the buffer has grown
+        past its maximum size."""
+        if not self.__max_chars:
+            return
+        buf = self._buf
+        count = buf.get_char_count()
+        if count <= self.__max_chars:
+            return
+        # Trim to three quarters, so we don't spill on every flush
+        iter = buf.get_iter_at_offset(count - (self.__max_chars * 3 // 4))
+        if not iter.starts_line():
+            end = iter.copy()
+            if end.forward_line():
+                iter = end
+        start = buf.get_start_iter()
+        self.__spill.push(buf.get_slice(start, iter))
+        buf.delete(start, iter)
+        _logger.debug("spilled to disk, %d chars in spill", self.__spill.charcount)
+
+    def __on_set_scroll_adjustments(self, textview, hadj, vadj):
+        if vadj is not None:
+            vadj.connect('value-changed', self.__on_vadj_changed)
+
+    def __on_vadj_changed(self, vadj):
+        if len(self.__spill) == 0 or self.__page_in_id:
+            return
+        if vadj.get_value() <= vadj.lower:
+            self.__page_in_id = gobject.idle_add(self.__idle_page_in)
+
+    def __idle_page_in(self):
+        """Read back spilled text in front of the buffer, keeping the
+        current top line in view."""
+        self.__page_in_id = 0
+        buf = self._buf
+        mark = buf.create_mark(None, buf.get_start_iter(), False)
+        text = []
+        charcount = 0
+        while len(self.__spill) > 0 and charcount < _page_in_chars:
+            chunk = self.__spill.pop()
+            text.insert(0, chunk)
+            charcount += len(chunk)
+        buf.insert(buf.get_start_iter(), u''.join(text))
+        self.__text.scroll_to_mark(mark, 0, True, 0, 0)
+        buf.delete_mark(mark)
+        return False
+
     def append_obj(self, obj, fmt=None):
         # If you change format types, be sure to update odisp.py:append_object
         if fmt == 'bytearray/chunked':
@@ -304,22 +484,7 @@ class UnicodeRenderer(ObjectsRenderer):
             self.__subproc_fd = obj
             self.__monitor_fd(obj)
             return        
-        if self.__empty:
-            self._buf.delete(self._buf.get_start_iter(), self._buf.get_end_iter())
-            self.__empty = False
-        allinsert_start = self._buf.get_start_iter().get_offset()
-        if isinstance(obj, MarkupText):
-            tags = []
-            prev_tagend = 0
-            olen = len(obj)
-            for (tagname, start, end) in obj.markup:
-               self._buf.insert(self._buf.get_end_iter(), obj[prev_tagend:start])
-               real_end = (end == -1) and olen or end
-               self._buf.insert_with_tags_by_name(self._buf.get_end_iter(), obj[start:real_end], tagname)
-               prev_tagend = real_end
-            self._buf.insert(self._buf.get_end_iter(), obj[prev_tagend:])
-        else:
-            self.__append_chunk(obj)
+        self.__append_chunk(obj)
         
     def __spawn_terminal(self, fd, buf):
         # Undo terminal mode changes from sys_builtin.py
@@ -336,6 +501,7 @@ class UnicodeRenderer(ObjectsRenderer):
         from hotwire.sysdep.term import Terminal
         term = Terminal.getInstance().get_terminal_widget_ptyfd(None, fd, title, initbuf=buf)
         hotwin.new_win_widget(term, title)
+        self.__flush()
         self._buf.insert_markup('\n\n<b>(%s)</b>' % (_('Entered Terminal Compatibility Mode'),))
 
     @log_except(_logger)
@@ -402,7 +568,10 @@ class UnicodeRenderer(ObjectsRenderer):
             path = dlg.get_filename()
             f = open(path, 'w')
             try:
-                if not self.__empty:             
+                self.__flush()
+                if not self.__empty:
+                    for chunk in self.__spill.iter_chunks():
+                        f.write(chunk.encode('utf-8'))
                     f.write(self._buf.get_property('text'))
             finally:
                 f.close()
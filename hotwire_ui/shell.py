@@ -33,7 +33,7 @@ from hotwire.sysdep.term import Terminal
 from hotwire.builtin import BuiltinRegistry
 from hotwire.cmdalias import Alias, AliasRegistry
 from hotwire.gutil import *
-from hotwire.util import markup_for_match, quote_arg
+from hotwire.util import markup_for_match, markup_for_positions, quote_arg
 from hotwire.fs import path_unexpanduser, path_expanduser, unix_basename, path_fromurl
 from hotwire.sysdep import is_unix
 from hotwire.sysdep.fs import File, Filesystem
@@ -204,6 +204,8 @@ class ShellCommandResolver(BaseCommandResolver):
         return super(ShellCommandResolver, self)._expand_verb_completion(completion)
         
 class CwdSelectorWindow(gtk.Dialog):
+    # Response when a directory is chosen from the frequently used ones
+    RESPONSE_FREQUENT = 1
     def __init__(self, parent, model):
         super(CwdSelectorWindow, self).__init__(title=_('Switch Recent Directory'),
                                                 parent=parent,
@@ -237,11 +239,63 @@ class CwdSelectorWindow(gtk.Dialog):
         self.__selection = self.__results.get_selection()
         self.__selection.set_mode(gtk.SELECTION_SINGLE)
         self.__results.set_headers_visible(False)
+        
+        self.__frequent_value = None
+        label = gtk.Label()
+        label.set_markup_with_mnemonic(_('<b>_Frequent Directories</b>'))
+        label.set_alignment(0.0, 0.5)
+        self.__vbox.pack_start(label, expand=False)
+        self.__frequent_entry = gtk.Entry()
+        self.__frequent_entry.connect('notify::text', lambda *args: self.__refresh_frequent())
+        self.__frequent_entry.connect('activate', self.__on_frequent_entry_activate)
+        label.set_mnemonic_widget(self.__frequent_entry)
+        self.__vbox.pack_start(self.__frequent_entry, expand=False)
+        self.__frequent_scroll = gtk.ScrolledWindow()
+        self.__frequent_scroll.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        self.__frequent_model = gtk.ListStore(gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)
+        self.__frequent = gtk.TreeView(self.__frequent_model)
+        self.__frequent.connect('row-activated', self.__on_frequent_row_activated)
+        self.__frequent_scroll.add(self.__frequent)
+        colidx = self.__frequent.insert_column_with_data_func(-1, '',
+                                                              gtk.CellRendererPixbuf(),
+                                                              self.__render_icon)
+        colidx = self.__frequent.insert_column_with_data_func(-1, '',
+                                                              hotwidgets.CellRendererText(ellipsize=True),
+                                                              self.__render_frequent)
+        self.__frequent.set_headers_visible(False)
+        self.__vbox.pack_start(hotwidgets.Border(self.__frequent_scroll), expand=True)
+        self.connect('show', lambda *args: self.__refresh_frequent())
         self.__results.grab_focus()
         
     def __on_row_activated(self, *args):
         self.response(gtk.RESPONSE_ACCEPT)
         
+    def __refresh_frequent(self):
+        text = self.__frequent_entry.get_property('text')
+        self.__frequent_model.clear()
+        for (path, score, positions) in History.getInstance().search_dir_usage(text):
+            self.__frequent_model.append((path, markup_for_positions(path, positions)))
+        
+    def __activate_frequent(self, path):
+        self.__frequent_value = path
+        self.response(self.RESPONSE_FREQUENT)
+        
+    def __on_frequent_row_activated(self, tv, path, vc):
+        self.__activate_frequent(self.__frequent_model.get_value(self.__frequent_model.get_iter(path), 0))
+        
+    def __on_frequent_entry_activate(self, entry):
+        (model, iter) = self.__frequent.get_selection().get_selected()
+        if iter is None:
+            iter = model.get_iter_first()
+        if iter is not None:
+            self.__activate_frequent(model.get_value(iter, 0))
+        
+    def __render_frequent(self, col, cell, model, iter):
+        cell.set_property('markup', model.get_value(iter, 1))
+        
+    def get_frequent_value(self):
+        return self.__frequent_value
+        
     def __render_icon(self, col, cell, model, iter):
         cell.set_property('icon-name', gtk.STOCK_DIRECTORY)
         
@@ -255,6 +309,7 @@ class CwdSelectorWindow(gtk.Dialog):
 class CwdDisplay(gtk.Button):
     __gsignals__ = {
         "changed" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, []),
+        "jump" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_STRING,)),
     }
     def __init__(self):
         super(CwdDisplay, self).__init__()
@@ -300,6 +355,8 @@ class CwdDisplay(gtk.Button):
         self.__sync_label()
         if resp == gtk.RESPONSE_ACCEPT:
             self.emit('changed')
+        elif resp == CwdSelectorWindow.RESPONSE_FREQUENT:
+            self.emit('jump', self.__selector_window.get_frequent_value())
             
     def set_active(self, idx):
         self.__selector_window.get_selection().select_path((idx,))
@@ -401,6 +458,8 @@ class Hotwire(gtk.VBox):
         self.__welcome_align = hotwidgets.Align(self.__welcome, yscale=1.0, xscale=1.0)
         self.__paned.pack_start(self.__welcome_align, expand=True)
         self.pack_start(self.__paned, expand=True)
+        dispatcher.connect(self.__on_history_import_progress, 'import-progress', self.context.history)
+        dispatcher.connect(self.__on_history_import_complete, 'import-complete', self.context.history)
 
         self.__navigation_bar = NavigationBar(self.context)
         # Visibility is synced by __sync_navbar_display
@@ -452,6 +511,7 @@ class Hotwire(gtk.VBox):
         store = gtk.ListStore(gobject.TYPE_STRING, gobject.TYPE_STRING)
         self.__recentdirs = CwdDisplay()
         self.__recentdirs.connect('changed', self.__on_recentdir_selected)
+        self.__recentdirs.connect('jump', lambda w, path: self.internal_execute('cd', path))
         self.__inputline.pack_start(hotwidgets.Align(self.__recentdirs), expand=False)           
         
         self.__bottom.pack_start(self.__inputline, expand=False)        
@@ -793,6 +853,18 @@ class Hotwire(gtk.VBox):
         self.__outputs.add_pipeline(pipeline)
         pipeline.execute(opt_formats=self.__outputs.get_current().get_opt_formats())
         
+    def __on_history_import_progress(self, name, fraction):
+        # Sent from the history writer thread
+        gobject.idle_add(self.__show_history_import, _('Importing %s history: %d%%') % (name, int(fraction * 100)))
+
+    def __on_history_import_complete(self, count):
+        gobject.idle_add(self.__show_history_import, 'Welcome to Hotwire.')
+
+    def __show_history_import(self, text):
+        if self.__welcome:
+            self.__welcome.set_text(text)
+        return False
+        
     def __unset_welcome(self):
         if not self.__welcome:
             return